@@ -0,0 +1,273 @@
+"""Нагрузочный тест /chat: задержки, пропускная способность и смешение сессий.
+
+Запуск против работающего сервиса:
+    python -m benchmarks.chat_load --url http://localhost:8000 --sessions 50
+
+Запуск в одном процессе с приложением (нужны SECRET_TOKEN и API_URL,
+например заглушка benchmarks.llm_standin):
+    python -m benchmarks.chat_load --in-process --sessions 20 \\
+        --standin-url http://localhost:8001
+
+Каждая сессия проходит сценарий из нескольких ходов: первый запрос,
+ответы на уточнения и правки схемы. В каждое сообщение подставляется
+уникальный маркер сессии; если маркер чужой сессии появился в ответе,
+это считается смешением сессий. Итог: пропускная способность, p50/p95/p99
+по эндпоинтам, время по этапам конвейера (из /stats/stages) и число вызовов
+LLM на ход (из /stats заглушки, если она указана).
+"""
+import argparse
+import asyncio
+import re
+import statistics
+import time
+import uuid
+from contextlib import AsyncExitStack
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+SCENARIOS: Dict[str, List[str]] = {
+    "api_message": [
+        "type=TEXT, content=Прими из апи сообщение sessionId={marker}",
+        "Название схемы api-{marker}, сохранить в кафку topic=out-{marker}",
+    ],
+    "clarify": [
+        "Хочу перекладывать сообщения из кафки в кафку {marker}",
+        "Топик источника in-{marker}, bootstrapServers=kafka.local:9092, без авторизации",
+        "Топик назначения out-{marker}, имя схемы kafka-{marker}",
+    ],
+    "edit": [
+        "Мне нужна схема для rest запроса {marker}: GET https://api.local/{marker},"
+        " имя rest-{marker}, запуск по расписанию каждый час",
+        "Поменяй url на https://api.local/v2/{marker}",
+        "Добавь заголовок X-Trace={marker}",
+    ],
+}
+MARKER_RE = re.compile(r"marker-[0-9a-f]{8}")
+SCHEMA_EDITS_RE = re.compile(
+    r'^json_generator_schema_edits_total\{outcome="(\w+)"\} ([0-9.e+]+)$'
+)
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль по ближайшему рангу."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(q / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+class LoadResult:
+    """Накопленные результаты нагрузочного теста."""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.turns = 0
+        self.contaminated: List[str] = []
+
+    def add(self, endpoint: str, seconds: float, status: int) -> None:
+        self.latencies.setdefault(endpoint, []).append(seconds)
+        if status >= 400:
+            key = f"{endpoint}:{status}"
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+
+async def run_session(
+    client: httpx.AsyncClient,
+    scenario: str,
+    result: LoadResult,
+    timeout: float,
+) -> None:
+    """Прогоняет сценарий в новой сессии и проверяет ответы на чужие маркеры."""
+    session_id = "load-" + uuid.uuid4().hex[:12]
+    marker = "marker-" + uuid.uuid4().hex[:8]
+
+    started = time.perf_counter()
+    response = await client.post("/clear", json={"session_id": session_id})
+    result.add("/clear", time.perf_counter() - started, response.status_code)
+
+    for template in SCENARIOS[scenario]:
+        payload = {"session_id": session_id, "message": template.format(marker=marker)}
+        started = time.perf_counter()
+        try:
+            response = await client.post("/chat", json=payload, timeout=timeout)
+            status = response.status_code
+        except httpx.HTTPError:
+            response, status = None, 599
+        result.add("/chat", time.perf_counter() - started, status)
+        result.turns += 1
+        if response is None or status >= 400:
+            continue
+        foreign = set(MARKER_RE.findall(response.text)) - {marker}
+        if foreign:
+            result.contaminated.append(f"{session_id}: {', '.join(sorted(foreign))}")
+
+
+async def fetch_json(client: httpx.AsyncClient, url: str) -> Optional[Dict[str, Any]]:
+    try:
+        response = await client.get(url)
+        response.raise_for_status()
+        return response.json()
+    except httpx.HTTPError:
+        return None
+
+
+async def fetch_text(client: httpx.AsyncClient, url: str) -> Optional[str]:
+    try:
+        response = await client.get(url)
+        response.raise_for_status()
+        return response.text
+    except httpx.HTTPError:
+        return None
+
+
+def stage_totals(report: Optional[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+    """Переводит /stats/stages в суммарное время и число вызовов по этапам."""
+    totals: Dict[str, Dict[str, float]] = {}
+    for stage, models in (report or {}).items():
+        for model, stats in models.items():
+            entry = totals.setdefault(f"{stage} ({model})", {"calls": 0, "total_s": 0})
+            entry["calls"] += stats["calls"]
+            entry["total_s"] += stats["calls"] * stats["mean_s"]
+    return totals
+
+
+def schema_edits(text: Optional[str]) -> Dict[str, float]:
+    """Счётчик json_generator_schema_edits_total из /metrics по исходам."""
+    found: Dict[str, float] = {}
+    for line in (text or "").splitlines():
+        match = SCHEMA_EDITS_RE.match(line)
+        if match:
+            found[match.group(1)] = float(match.group(2))
+    return found
+
+
+def standin_calls(report: Optional[Dict[str, Any]]) -> int:
+    if not report:
+        return 0
+    return sum(n for key, n in report["calls"].items() if key.startswith("chat:"))
+
+
+async def run_load(args: argparse.Namespace) -> None:
+    async with AsyncExitStack() as stack:
+        if args.in_process:
+            from json_generator.server import app
+
+            # ASGITransport не выполняет lifespan: без него не запускаются
+            # фоновая запись сессий, вытеснение и снимок при остановке
+            await stack.enter_async_context(app.router.lifespan_context(app))
+            transport = httpx.ASGITransport(app=app)
+            base_url = "http://in-process"
+        else:
+            transport = None
+            base_url = args.url
+        await measure(args, base_url, transport)
+
+
+async def measure(
+    args: argparse.Namespace,
+    base_url: str,
+    transport: Optional[httpx.AsyncBaseTransport],
+) -> None:
+    limits = httpx.Limits(max_connections=args.sessions)
+    async with httpx.AsyncClient(
+        base_url=base_url, transport=transport, limits=limits, timeout=args.timeout
+    ) as client, httpx.AsyncClient(timeout=10) as side_client:
+        stages_before = stage_totals(await fetch_json(client, "/stats/stages"))
+        edits_before = schema_edits(await fetch_text(client, "/metrics"))
+        standin_before = (
+            await fetch_json(side_client, args.standin_url + "/stats")
+            if args.standin_url
+            else None
+        )
+
+        result = LoadResult()
+        scenarios = list(SCENARIOS) if args.scenario == "all" else [args.scenario]
+        semaphore = asyncio.Semaphore(args.concurrency or args.sessions)
+
+        async def limited(index: int) -> None:
+            async with semaphore:
+                await run_session(
+                    client, scenarios[index % len(scenarios)], result, args.timeout
+                )
+
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(i) for i in range(args.sessions)))
+        elapsed = time.perf_counter() - started
+
+        stages_after = stage_totals(await fetch_json(client, "/stats/stages"))
+        edits_after = schema_edits(await fetch_text(client, "/metrics"))
+        standin_after = (
+            await fetch_json(side_client, args.standin_url + "/stats")
+            if args.standin_url
+            else None
+        )
+
+    print(f"Сессий: {args.sessions}, ходов: {result.turns}, время: {elapsed:.1f}с")
+    print(f"Пропускная способность: {result.turns / elapsed:.2f} ходов/с")
+    for endpoint, values in result.latencies.items():
+        print(
+            f"{endpoint:>7}: n={len(values)} p50={percentile(values, 50):.2f}s "
+            f"p95={percentile(values, 95):.2f}s p99={percentile(values, 99):.2f}s "
+            f"mean={statistics.mean(values):.2f}s"
+        )
+    if result.errors:
+        print(
+            "Ошибки:", ", ".join(f"{k}={v}" for k, v in sorted(result.errors.items()))
+        )
+    if stages_after:
+        print("Этапы конвейера (вызовы, суммарное и среднее время):")
+        for stage, after in sorted(stages_after.items()):
+            before = stages_before.get(stage, {"calls": 0, "total_s": 0})
+            calls = after["calls"] - before["calls"]
+            total = after["total_s"] - before["total_s"]
+            if calls:
+                print(f"  {stage}: {calls} вызовов, {total:.1f}с, {total / calls:.2f}с")
+    applied, fallback = (
+        edits_after.get(outcome, 0) - edits_before.get(outcome, 0)
+        for outcome in ("applied", "fallback")
+    )
+    if applied or fallback:
+        # Без этого время сценария edit можно принять за время правки, хотя
+        # при неудачной правке схема генерируется заново
+        print(
+            f"Правки схемы: применено {applied:.0f},"
+            f" сгенерировано заново {fallback:.0f}"
+        )
+    if standin_after is not None and result.turns:
+        calls = standin_calls(standin_after) - standin_calls(standin_before)
+        print(f"Вызовов LLM на ход: {calls / result.turns:.2f}")
+    if result.contaminated:
+        print(f"Смешение сессий: {len(result.contaminated)} ответов")
+        for line in result.contaminated[:10]:
+            print("  " + line)
+    else:
+        print("Смешение сессий не обнаружено")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--url", default="http://localhost:8000")
+    target.add_argument("--in-process", action="store_true")
+    parser.add_argument("--sessions", type=int, default=10)
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=0,
+        help="Сколько сессий выполняется одновременно (по умолчанию все)",
+    )
+    parser.add_argument(
+        "--scenario", choices=["all", *SCENARIOS], default="all", type=str
+    )
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument(
+        "--standin-url", default="", help="Адрес benchmarks.llm_standin для /stats"
+    )
+    asyncio.run(run_load(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
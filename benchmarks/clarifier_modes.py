@@ -0,0 +1,92 @@
+"""Сравнение режимов уточняющего агента по задержке и числу вызовов LLM.
+
+Запуск (нужны SECRET_TOKEN и доступный API_URL):
+    python -m benchmarks.clarifier_modes --repeat 3
+
+Для каждого режима ("agent" и "fast") прогоняются одни и те же первые
+сообщения в новых сессиях. Вызовы LLM считаются на уровне клиента openai,
+поэтому учитываются и запросы autogen, и utils.generate. Ответы из
+дискового кэша autogen запросами не считаются.
+"""
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+from typing import Dict, List
+
+from openai.resources.chat.completions import Completions
+
+from json_generator.agents import ChatManager
+from json_generator.constants import CLARIFIER_MODES
+from json_generator.sessions import SessionContext
+
+MESSAGES = [
+    "type=TEXT, content=Прими из апи сообщение sessionId=cyjqiay3",
+    "Мне нужно написать запрос через rest api",
+    "Хочу перекладывать сообщения из кафки в кафку",
+]
+
+
+class CallCounter:
+    """Считает синхронные вызовы chat.completions.create."""
+
+    def __init__(self):
+        self.calls = 0
+        self._original = Completions.create
+
+    def __enter__(self):
+        counter = self
+        original = self._original
+
+        def counting_create(self, *args, **kwargs):
+            counter.calls += 1
+            return original(self, *args, **kwargs)
+
+        Completions.create = counting_create
+        return self
+
+    def __exit__(self, *exc):
+        Completions.create = self._original
+
+
+def run_mode(mode: str, repeat: int) -> Dict[str, float]:
+    """Прогоняет все сообщения в заданном режиме и собирает статистику."""
+    manager = ChatManager(clarifier_mode=mode)
+    latencies: List[float] = []
+    calls: List[int] = []
+    for _ in range(repeat):
+        for message in MESSAGES:
+            session = SessionContext()
+            session.update_with_user(message)
+            with CallCounter() as counter:
+                start = time.perf_counter()
+                asyncio.run(manager._detect_missing_params(session))
+                latencies.append(time.perf_counter() - start)
+            calls.append(counter.calls)
+    return {
+        "runs": len(latencies),
+        "p50_s": statistics.median(latencies),
+        "max_s": max(latencies),
+        "mean_calls": statistics.mean(calls),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument(
+        "--modes", nargs="+", default=list(CLARIFIER_MODES), choices=CLARIFIER_MODES
+    )
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    for mode in args.modes:
+        stats = run_mode(mode, args.repeat)
+        print(
+            f"{mode:>6}: runs={stats['runs']} p50={stats['p50_s']:.2f}s "
+            f"max={stats['max_s']:.2f}s llm_calls/turn={stats['mean_calls']:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
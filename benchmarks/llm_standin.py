@@ -0,0 +1,570 @@
+"""OpenAI-совместимая заглушка LLM и эмбеддингов для нагрузочного тестирования.
+
+Запуск:
+    python -m benchmarks.llm_standin --port 8001 --latency 0.8 --jitter 0.3
+    API_URL=http://localhost:8001 SECRET_TOKEN=local python -m json_generator
+
+Отдаёт /v1/chat/completions (в том числе вызовы инструментов,
+response_format с json_schema и потоковую выдачу) и /v1/embeddings, те же
+маршруты без префикса /v1 для autogen, а также /stats со счётчиками вызовов.
+Задержка складывается из времени до первого токена (распределение fixed,
+uniform или lognormal) и времени генерации при заданной скорости в токенах в
+секунду. С вероятностью --error-rate возвращается 429 или 503.
+
+Запросы генератора, которые ждут json, получают корректный json: правка
+схемы - merge patch, исправление схемы - значения полей из списка ошибок,
+генерация по определению из дерева правил (в json_schema или в тексте
+"Схема: ...") - объект с обязательными полями этого определения. Так тест
+проходит те же ветви конвейера, что и с настоящей моделью, а не откаты.
+
+Строковые поля ответов содержат маркеры вида marker-<id> и sessionId=<id>,
+найденные в запросе, чтобы нагрузочный тест мог заметить смешение сессий.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
+
+MARKER_RE = re.compile(r"(marker-[A-Za-z0-9_-]+|sessionId=[A-Za-z0-9_-]+)")
+CHARS_PER_TOKEN = 4
+# Признаки запросов генератора: правка схемы (SCHEMA_EDIT_TASK), список
+# ошибок для исправления (_repair_block) и определение в тексте промпта
+EDIT_HINT = '"merge_patch"'
+REPAIR_HEADER = "Ошибки:"
+REPAIR_LINE_RE = re.compile(r"^(\S+): (.+?)\. .*Сейчас: (.*)$")
+DEFINITION_PREFIX = "Схема: "
+STRING_TYPE_RE = re.compile(r"^String(\d+)?$")
+
+
+class StandinConfig(BaseModel):
+    """Параметры поведения заглушки."""
+
+    latency: float = 0.5
+    jitter: float = 0.2
+    distribution: str = "lognormal"
+    tokens_per_second: float = 50.0
+    error_rate: float = 0.0
+    embedding_dim: int = 1024
+    can_generate_rate: float = 0.5
+    seed: Optional[int] = None
+
+
+class StandinStats:
+    """Счётчики вызовов заглушки по маршрутам и моделям."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.calls: Counter = Counter()
+            self.errors: Counter = Counter()
+            self.prompt_tokens = 0
+            self.completion_tokens = 0
+
+    def record(
+        self, kind: str, model: str, prompt_tokens: int, completion_tokens: int
+    ) -> None:
+        with self._lock:
+            self.calls[f"{kind}:{model}"] += 1
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+    def record_error(self, kind: str, status: int) -> None:
+        with self._lock:
+            self.errors[f"{kind}:{status}"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "calls": dict(self.calls),
+                "errors": dict(self.errors),
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+            }
+
+
+def estimate_tokens(text: str) -> int:
+    """Приблизительное число токенов в тексте."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def _message_text(message: Dict[str, Any]) -> str:
+    content = message.get("content")
+    if isinstance(content, list):
+        return " ".join(
+            part.get("text", "") for part in content if isinstance(part, dict)
+        )
+    return content or ""
+
+
+def _markers(messages: List[Dict[str, Any]]) -> List[str]:
+    found: List[str] = []
+    for message in messages:
+        for marker in MARKER_RE.findall(_message_text(message)):
+            if marker not in found:
+                found.append(marker)
+    return found
+
+
+def example_from_schema(
+    schema: Any,
+    rng: random.Random,
+    config: StandinConfig,
+    markers: List[str],
+    root: Optional[Dict[str, Any]] = None,
+    depth: int = 0,
+) -> Any:
+    """Строит пример значения, удовлетворяющий json-схеме.
+
+    Поддерживаются object, array, string, integer, number, boolean, enum,
+    const, anyOf/oneOf и ссылки $ref на $defs. Для неизвестных схем
+    возвращается пустой объект.
+    """
+    root = root if root is not None else schema
+    if not isinstance(schema, dict) or depth > 8:
+        return {}
+    if "$ref" in schema:
+        target: Any = root
+        for part in schema["$ref"].lstrip("#/").split("/"):
+            target = target.get(part, {}) if isinstance(target, dict) else {}
+        return example_from_schema(target, rng, config, markers, root, depth + 1)
+    if "const" in schema:
+        return schema["const"]
+    if schema.get("enum"):
+        return schema["enum"][0]
+    for key in ("anyOf", "oneOf", "allOf"):
+        if schema.get(key):
+            return example_from_schema(
+                schema[key][0], rng, config, markers, root, depth + 1
+            )
+    kind = schema.get("type")
+    if isinstance(kind, list):
+        kind = next((k for k in kind if k != "null"), "null")
+    if kind == "object" or (kind is None and "properties" in schema):
+        return {
+            name: example_from_schema(prop, rng, config, markers, root, depth + 1)
+            for name, prop in schema.get("properties", {}).items()
+        }
+    if kind == "array":
+        return []
+    if kind == "string":
+        return " ".join(["Ответ заглушки", *markers])
+    if kind == "integer":
+        return 1
+    if kind == "number":
+        return 1.0
+    if kind == "boolean":
+        return rng.random() < config.can_generate_rate
+    if kind == "null":
+        return None
+    return {}
+
+
+def is_definition(schema: Any) -> bool:
+    """Определение из дерева правил (parameters), а не json-схема."""
+    return (
+        isinstance(schema, dict)
+        and isinstance(schema.get("parameters"), dict)
+        and "properties" not in schema
+    )
+
+
+def example_from_definition(
+    definition: Dict[str, Any], markers: List[str], depth: int = 0
+) -> Dict[str, Any]:
+    """Строит документ с обязательными полями определения из дерева правил.
+
+    Значения берутся из value/default и valid_values, строки содержат
+    маркеры и укладываются в длину типа StringN, вложенные поля строятся по
+    subcomponents. Поля с условием обязательности тоже заполняются: лишнее
+    поле валидатор не считает ошибкой.
+    """
+    return _fields_example(definition.get("parameters"), markers, depth)
+
+
+def _fields_example(group: Any, markers: List[str], depth: int) -> Dict[str, Any]:
+    if not isinstance(group, dict) or depth > 8:
+        return {}
+    return {
+        name: _field_example(node, markers, depth + 1)
+        for name, node in group.items()
+        if isinstance(node, dict) and node.get("required") is True
+    }
+
+
+def _field_example(node: Dict[str, Any], markers: List[str], depth: int) -> Any:
+    default = node.get("value", node.get("default"))
+    if isinstance(default, (str, int, float)):
+        return default
+    values = node.get("valid_values") or node.get("values")
+    if isinstance(values, list) and values:
+        return values[0]
+    if isinstance(node.get("subcomponents"), dict):
+        return _fields_example(node["subcomponents"], markers, depth)
+    type_name = str(node.get("type", ""))
+    if type_name == "Int":
+        return 1
+    if type_name == "Float":
+        return 1.0
+    if type_name == "JsonObject":
+        return {}
+    if type_name == "Array" or type_name.endswith(" array"):
+        return []
+    text = " ".join(["Ответ заглушки", *markers])
+    match = STRING_TYPE_RE.match(type_name)
+    if match and match.group(1):
+        return text[: int(match.group(1))]
+    return text
+
+
+def repair_example(text: str, markers: List[str]) -> Optional[Dict[str, Any]]:
+    """Исправления для списка ошибок схемы: путь -> значение по сообщению."""
+    if REPAIR_HEADER not in text:
+        return None
+    fixes: Dict[str, Any] = {}
+    for line in text.split(REPAIR_HEADER, 1)[1].splitlines():
+        match = REPAIR_LINE_RE.match(line.strip())
+        if not match:
+            continue
+        path, message, current = match.groups()
+        fixes[path] = _repair_value(message, current, markers)
+    return fixes
+
+
+def _repair_value(message: str, current: str, markers: List[str]) -> Any:
+    if message.startswith("допустимые значения: "):
+        return message[len("допустимые значения: ") :].split(", ")[0]
+    if message == "ожидается целое число":
+        return 1
+    if message == "ожидается число":
+        return 1.0
+    if message == "ожидается объект":
+        return {}
+    if message == "ожидается массив":
+        return []
+    limit = re.match(r"строка длиннее (\d+) символов", message)
+    if limit:
+        try:
+            return str(json.loads(current))[: int(limit.group(1))]
+        except ValueError:
+            return ""
+    return " ".join(["Ответ заглушки", *markers])
+
+
+def definition_from_text(text: str) -> Optional[Dict[str, Any]]:
+    """Определение, переданное в тексте промпта после "Схема: "."""
+    start = text.find(DEFINITION_PREFIX)
+    if start < 0:
+        return None
+    try:
+        value, _ = json.JSONDecoder().raw_decode(text, start + len(DEFINITION_PREFIX))
+    except ValueError:
+        return None
+    return value if is_definition(value) else None
+
+
+def json_reply(
+    messages: List[Dict[str, Any]], markers: List[str]
+) -> Optional[Dict[str, Any]]:
+    """Json-ответ на запрос генератора без response_format или None.
+
+    Распознаются правка схемы, исправление полей по списку ошибок и
+    генерация по определению в тексте промпта.
+    """
+    system = " ".join(_message_text(m) for m in messages if m.get("role") == "system")
+    user = "\n".join(_message_text(m) for m in messages if m.get("role") == "user")
+    if EDIT_HINT in system:
+        return {"merge_patch": {"description": " ".join(["Правка заглушки", *markers])}}
+    fixes = repair_example(user, markers)
+    if fixes is not None:
+        return fixes
+    definition = definition_from_text(user)
+    if definition is not None:
+        return example_from_definition(definition, markers)
+    return None
+
+
+class LLMStandin:
+    """Заглушка OpenAI-совместимого API."""
+
+    def __init__(self, config: StandinConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.stats = StandinStats()
+
+    def sample_latency(self) -> float:
+        """Время до первого токена по заданному распределению."""
+        config = self.config
+        if config.distribution == "fixed" or config.latency <= 0:
+            return max(config.latency, 0.0)
+        if config.distribution == "uniform":
+            return max(
+                self.rng.uniform(
+                    config.latency - config.jitter, config.latency + config.jitter
+                ),
+                0.0,
+            )
+        sigma = config.jitter / config.latency if config.latency else 0.0
+        return self.rng.lognormvariate(np.log(config.latency), sigma)
+
+    def generation_time(self, completion_tokens: int) -> float:
+        if self.config.tokens_per_second <= 0:
+            return 0.0
+        return completion_tokens / self.config.tokens_per_second
+
+    def maybe_error(self, kind: str) -> Optional[JSONResponse]:
+        """С заданной вероятностью возвращает ошибку апстрима."""
+        if self.rng.random() >= self.config.error_rate:
+            return None
+        status = self.rng.choice((429, 503))
+        self.stats.record_error(kind, status)
+        return JSONResponse(
+            status_code=status,
+            headers={"Retry-After": "1"},
+            content={
+                "error": {
+                    "message": "Смоделированная ошибка заглушки",
+                    "type": "rate_limit_error" if status == 429 else "server_error",
+                    "code": status,
+                }
+            },
+        )
+
+    def completion_message(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        """Формирует ответ ассистента на запрос chat.completions."""
+        messages = body.get("messages", [])
+        markers = _markers(messages)
+        tools = body.get("tools") or []
+        used_tool = any(m.get("role") == "tool" for m in messages)
+        if tools and not used_tool:
+            user_text = next(
+                (
+                    _message_text(m)
+                    for m in reversed(messages)
+                    if m.get("role") == "user"
+                ),
+                "",
+            )
+            function = tools[0].get("function", {})
+            return {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [
+                    {
+                        "id": "call_" + uuid.uuid4().hex[:12],
+                        "type": "function",
+                        "function": {
+                            "name": function.get("name", "tool"),
+                            "arguments": json.dumps(
+                                {"query": user_text[:200]}, ensure_ascii=False
+                            ),
+                        },
+                    }
+                ],
+            }
+        response_format = body.get("response_format") or {}
+        if response_format.get("type") == "json_schema":
+            schema = response_format.get("json_schema", {}).get("schema", {})
+            # Генератор передаёт как json_schema определение из дерева правил
+            if is_definition(schema):
+                example = example_from_definition(schema, markers)
+            else:
+                example = example_from_schema(schema, self.rng, self.config, markers)
+            content = json.dumps(example, ensure_ascii=False)
+        elif response_format.get("type") == "json_object":
+            content = json.dumps({"answer": " ".join(markers)}, ensure_ascii=False)
+        else:
+            reply = None if tools else json_reply(messages, markers)
+            if reply is not None:
+                content = json.dumps(reply, ensure_ascii=False)
+            else:
+                content = " ".join(["Ответ заглушки.", *markers])
+                if tools:
+                    content += " TERMINATE"
+        return {"role": "assistant", "content": content}
+
+    async def chat_completions(self, request: Request):
+        body = await request.json()
+        model = body.get("model", "unknown")
+        error = self.maybe_error("chat")
+        if error is not None:
+            await asyncio.sleep(self.sample_latency())
+            return error
+        message = self.completion_message(body)
+        prompt_tokens = sum(
+            estimate_tokens(_message_text(m)) for m in body.get("messages", [])
+        )
+        content = message.get("content") or json.dumps(message.get("tool_calls"))
+        completion_tokens = estimate_tokens(content)
+        if body.get("max_tokens"):
+            completion_tokens = min(completion_tokens, int(body["max_tokens"]))
+        self.stats.record("chat", model, prompt_tokens, completion_tokens)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        completion_id = "chatcmpl-" + uuid.uuid4().hex
+        created = int(time.time())
+        finish_reason = "tool_calls" if message.get("tool_calls") else "stop"
+        if body.get("stream") and not message.get("tool_calls"):
+            return StreamingResponse(
+                self._stream(completion_id, created, model, content, usage),
+                media_type="text/event-stream",
+            )
+        await asyncio.sleep(
+            self.sample_latency() + self.generation_time(completion_tokens)
+        )
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [
+                {"index": 0, "message": message, "finish_reason": finish_reason}
+            ],
+            "usage": usage,
+        }
+
+    async def _stream(
+        self,
+        completion_id: str,
+        created: int,
+        model: str,
+        content: str,
+        usage: Dict[str, int],
+    ):
+        await asyncio.sleep(self.sample_latency())
+        step = CHARS_PER_TOKEN * 4
+        for start in range(0, len(content), step):
+            piece = content[start : start + step]
+            await asyncio.sleep(self.generation_time(estimate_tokens(piece)))
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [
+                    {"index": 0, "delta": {"content": piece}, "finish_reason": None}
+                ],
+            }
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+        final = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            "usage": usage,
+        }
+        yield f"data: {json.dumps(final)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    def embed(self, text: str) -> List[float]:
+        """Детерминированный единичный вектор для текста."""
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+        vector = np.random.default_rng(seed).standard_normal(self.config.embedding_dim)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    async def embeddings(self, request: Request):
+        body = await request.json()
+        model = body.get("model", "unknown")
+        error = self.maybe_error("embeddings")
+        if error is not None:
+            return error
+        inputs = body.get("input", [])
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        texts = [
+            text if isinstance(text, str) else " ".join(map(str, text))
+            for text in inputs
+        ]
+        prompt_tokens = sum(estimate_tokens(text) for text in texts)
+        self.stats.record("embeddings", model, prompt_tokens, 0)
+        await asyncio.sleep(self.sample_latency() / 4)
+        return {
+            "object": "list",
+            "model": model,
+            "data": [
+                {"object": "embedding", "index": i, "embedding": self.embed(text)}
+                for i, text in enumerate(texts)
+            ],
+            "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+        }
+
+
+def create_app(config: Optional[StandinConfig] = None) -> FastAPI:
+    """Создаёт приложение заглушки."""
+    standin = LLMStandin(config or StandinConfig())
+    app = FastAPI(title="LLM stand-in")
+    app.state.standin = standin
+    for prefix in ("", "/v1"):
+        app.add_api_route(
+            prefix + "/chat/completions", standin.chat_completions, methods=["POST"]
+        )
+        app.add_api_route(prefix + "/embeddings", standin.embeddings, methods=["POST"])
+
+    @app.get("/stats")
+    async def stats():
+        return standin.stats.snapshot()
+
+    @app.post("/stats/reset")
+    async def reset_stats():
+        standin.stats.reset()
+        return {"detail": "reset"}
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    defaults = StandinConfig()
+    parser.add_argument("--latency", type=float, default=defaults.latency)
+    parser.add_argument("--jitter", type=float, default=defaults.jitter)
+    parser.add_argument(
+        "--distribution",
+        choices=("fixed", "uniform", "lognormal"),
+        default=defaults.distribution,
+    )
+    parser.add_argument(
+        "--tokens-per-second", type=float, default=defaults.tokens_per_second
+    )
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate)
+    parser.add_argument("--embedding-dim", type=int, default=defaults.embedding_dim)
+    parser.add_argument(
+        "--can-generate-rate", type=float, default=defaults.can_generate_rate
+    )
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    config = StandinConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        distribution=args.distribution,
+        tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate,
+        embedding_dim=args.embedding_dim,
+        can_generate_rate=args.can_generate_rate,
+        seed=args.seed,
+    )
+    uvicorn.run(create_app(config), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""Локальный заменитель Redis для проверки RedisBackend без сервера Redis.
+
+Запуск:
+    python -m benchmarks.redis_standin --port 6390
+
+Поддерживает команды, которыми пользуется RedisBackend (PING, GET, SET с EX
+и PX, DEL, EXISTS, SELECT, AUTH), а также FLUSHDB и DBSIZE. Данные хранятся
+в памяти процесса. С флагом --check запускает сервер, прогоняет запись и
+чтение сессий через RedisBackend и печатает скорость.
+"""
+import argparse
+import asyncio
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+class RespServer:
+    """Сервер протокола RESP2 с хранением строк в памяти."""
+
+    def __init__(self):
+        # база -> ключ -> (значение, момент истечения или None)
+        self.dbs: Dict[int, Dict[bytes, Tuple[bytes, Optional[float]]]] = {}
+
+    def _db(self, index: int) -> Dict[bytes, Tuple[bytes, Optional[float]]]:
+        return self.dbs.setdefault(index, {})
+
+    def _get(self, db: Dict, key: bytes) -> Optional[bytes]:
+        item = db.get(key)
+        if item is None:
+            return None
+        value, expires = item
+        if expires is not None and expires <= time.monotonic():
+            del db[key]
+            return None
+        return value
+
+    @staticmethod
+    async def _read_command(reader: asyncio.StreamReader) -> Optional[List[bytes]]:
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.strip().split()
+        args = []
+        for _ in range(int(line[1:])):
+            header = await reader.readline()
+            length = int(header[1:])
+            args.append((await reader.readexactly(length + 2))[:-2])
+        return args
+
+    @staticmethod
+    def _bulk(value: Optional[bytes]) -> bytes:
+        if value is None:
+            return b"$-1\r\n"
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def execute(self, state: Dict[str, int], args: List[bytes]) -> bytes:
+        name = args[0].upper()
+        db = self._db(state["db"])
+        if name == b"PING":
+            return b"+PONG\r\n"
+        if name == b"AUTH":
+            return b"+OK\r\n"
+        if name == b"SELECT":
+            state["db"] = int(args[1])
+            return b"+OK\r\n"
+        if name == b"GET":
+            return self._bulk(self._get(db, args[1]))
+        if name == b"SET":
+            expires = None
+            options = [a.upper() for a in args[3::2]]
+            for option, value in zip(options, args[4::2]):
+                if option == b"EX":
+                    expires = time.monotonic() + int(value)
+                elif option == b"PX":
+                    expires = time.monotonic() + int(value) / 1000
+            db[args[1]] = (args[2], expires)
+            return b"+OK\r\n"
+        if name == b"DEL":
+            return b":%d\r\n" % sum(db.pop(key, None) is not None for key in args[1:])
+        if name == b"EXISTS":
+            return b":%d\r\n" % sum(self._get(db, key) is not None for key in args[1:])
+        if name == b"FLUSHDB":
+            db.clear()
+            return b"+OK\r\n"
+        if name == b"DBSIZE":
+            return b":%d\r\n" % len(db)
+        return b"-ERR unknown command '%s'\r\n" % name.lower()
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        state = {"db": 0}
+        try:
+            while True:
+                args = await self._read_command(reader)
+                if args is None:
+                    break
+                if args:
+                    writer.write(self.execute(state, args))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(host: str, port: int, started: Optional[threading.Event] = None):
+    server = await asyncio.start_server(RespServer().handle, host, port)
+    if started is not None:
+        started.set()
+    async with server:
+        await server.serve_forever()
+
+
+def check(port: int, sessions: int) -> None:
+    """Запись и чтение сессий через RedisBackend на запущенном заменителе."""
+    from json_generator.session_backends import (
+        RedisBackend,
+        SessionWriter,
+        dumps_session,
+        loads_session,
+    )
+    from json_generator.sessions import SessionContext
+
+    backend = RedisBackend(f"redis://localhost:{port}/1", idle_ttl=60)
+    writer = SessionWriter(backend)
+    session = SessionContext()
+    for i in range(5):
+        session.update_with_user(f"Сообщение {i} " * 20)
+        session.update_with_assistant(f"Ответ {i} " * 20)
+    session.collected_params = {"kafkaConsumer.topic": "orders"}
+    data = dumps_session(session)
+
+    started = time.perf_counter()
+    for start in range(0, sessions, 100):
+        backend.save_many(
+            {f"s{i}": data for i in range(start, min(start + 100, sessions))}
+        )
+    written = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for i in range(sessions):
+        restored = loads_session(writer.load(f"s{i}"))
+    read = time.perf_counter() - started
+    assert restored.to_dict() == session.to_dict()
+    writer.save("s0", None)
+    assert writer.load("s0") is None
+    backend.close()
+    print(
+        f"Сессий: {sessions}, размер: {len(data)} байт, "
+        f"запись пачками по 100: {sessions / written:.0f}/с, "
+        f"чтение: {sessions / read:.0f}/с"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--sessions", type=int, default=10000)
+    args = parser.parse_args()
+    if not args.check:
+        asyncio.run(serve(args.host, args.port))
+        return
+    started = threading.Event()
+    threading.Thread(
+        target=asyncio.run, args=(serve(args.host, args.port, started),), daemon=True
+    ).start()
+    started.wait()
+    check(args.port, args.sessions)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Память, которую занимают сессии ChatManager.
+
+Запуск:
+    python -m benchmarks.session_memory --sessions 100000
+
+Создаёт N сессий, похожих на рабочие: несколько ходов диалога, контекст из
+базы (одно из нескольких определений), собранные параметры, своя для каждой
+сессии текущая схема и расход токенов по этапам. Тексты, которые в работе
+приходят из ответов поиска и LLM, копируются для каждой сессии, как при
+восстановлении из хранилища. Печатает память на сессию по tracemalloc, оценку
+SessionContext.estimate_size и размер сериализованной сессии.
+"""
+import argparse
+import json
+import time
+import tracemalloc
+from typing import List
+
+from json_generator.session_backends import dumps_session
+from json_generator.sessions import SessionContext
+
+DEFINITIONS = 8
+
+
+def fresh(text: str) -> str:
+    """Копия строки: отдельный объект с тем же содержимым."""
+    return text.encode("utf-8").decode("utf-8")
+
+
+def make_definition(index: int) -> str:
+    parameters = {
+        f"field{i}": {"type": "string", "required": True, "maxLength": 255}
+        for i in range(40)
+    }
+    return json.dumps({"name": f"definition{index}", "parameters": parameters})
+
+
+def make_schema(index: int) -> str:
+    """Схема сессии: у каждой сессии своя, как после генерации LLM."""
+    return json.dumps(
+        {"type": "complex", "name": f"schema{index}", "activities": list(range(60))}
+    )
+
+
+def build_sessions(count: int) -> List[SessionContext]:
+    definitions = [make_definition(i) for i in range(DEFINITIONS)]
+    sessions = []
+    for i in range(count):
+        session = SessionContext()
+        session.update_with_user(f"Нужна схема для kafka consumer, сессия {i}")
+        session.update_with_assistant("Уточните топик и группу потребителя")
+        session.update_with_user(f"Топик orders-{i % 100}, группа billing")
+        session.update_with_assistant("Схема готова")
+        session.update_with_bd_context(fresh(definitions[i % DEFINITIONS]))
+        session.add_collected_param("kafkaConsumer.topic", f"orders-{i % 100}")
+        session.add_collected_param("kafkaConsumer.groupId", "billing")
+        session.set_missing([])
+        session.current_schema = make_schema(i)
+        for stage in ("clarifier", "required_fields", "generation"):
+            session.token_usage.add(stage, 1200, 300)
+        sessions.append(session)
+    return sessions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=100000)
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    sessions = build_sessions(args.sessions)
+    elapsed = time.perf_counter() - started
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    estimated = sum(session.estimate_size() for session in sessions)
+    serialized = sum(len(dumps_session(s)) for s in sessions[:1000])
+    print(
+        f"Сессий: {args.sessions}, создание: {elapsed:.2f}с\n"
+        f"Память: {used / 2**20:.1f} МБ, {used / args.sessions:.0f} байт на сессию\n"
+        f"Оценка estimate_size: {estimated / args.sessions:.0f} байт на сессию\n"
+        f"Сериализованная сессия: {serialized / min(1000, args.sessions):.0f} байт"
+    )
+
+
+if __name__ == "__main__":
+    main()
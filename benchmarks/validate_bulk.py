@@ -0,0 +1,83 @@
+"""Массовая проверка готовых схем по дереву правил и её пропускная способность.
+
+Запуск:
+    python -m benchmarks.validate_bulk workflows/ --definition wf_definition
+
+Проверяются все *.json в указанных файлах и каталогах (рекурсивно). Файл
+может содержать одну схему или массив схем. Для каждой схемы с ошибками
+печатаются пути и причины, в конце - число схем и схем в секунду.
+Флаг --repeat прогоняет проверку несколько раз для замера скорости.
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Any, Iterator, List, Tuple
+
+from json_generator.validation import validator_cache
+
+
+def iter_documents(paths: List[str]) -> Iterator[Tuple[str, Any]]:
+    """Схемы из файлов и каталогов: имя (с индексом в массиве) и документ."""
+    for path in map(Path, paths):
+        files = sorted(path.rglob("*.json")) if path.is_dir() else [path]
+        for file in files:
+            try:
+                data = json.loads(file.read_text(encoding="utf-8"))
+            except (OSError, json.JSONDecodeError) as e:
+                print(f"{file}: не удалось прочитать ({e})", file=sys.stderr)
+                continue
+            if isinstance(data, list):
+                for index, document in enumerate(data):
+                    yield f"{file}[{index}]", document
+            else:
+                yield str(file), data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument(
+        "--definition",
+        default="wf_definition",
+        help="Имя определения в дереве правил",
+    )
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument(
+        "--quiet", action="store_true", help="Не печатать ошибки по схемам"
+    )
+    args = parser.parse_args()
+
+    try:
+        validator = validator_cache.by_name(args.definition)
+    except KeyError:
+        parser.error(f"Определение {args.definition} не найдено в дереве правил")
+    documents = list(iter_documents(args.paths))
+    if not documents:
+        parser.error("Схемы не найдены")
+
+    invalid = 0
+    started = time.perf_counter()
+    for run in range(args.repeat):
+        for name, document in documents:
+            issues = validator.validate(document)
+            if run or not issues:
+                continue
+            invalid += 1
+            if not args.quiet:
+                print(name)
+                for issue in issues:
+                    print(f"  {issue.path or '<корень>'}: {issue.message}")
+    elapsed = time.perf_counter() - started
+
+    checked = len(documents) * args.repeat
+    print(
+        f"Схем: {len(documents)}, с ошибками: {invalid}, "
+        f"проверок: {checked} за {elapsed:.3f}с ({checked / elapsed:.0f} схем/с)"
+    )
+    sys.exit(1 if invalid else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,12 @@
 import uvicorn
 
+from .constants import WORKERS
+
 if __name__ == "__main__":
-    uvicorn.run("json_generator.server:app", host="0.0.0.0", port=8000)
+    # Несколько воркеров делят сессии через SESSION_BACKEND=sqlite или redis
+    uvicorn.run(
+        "json_generator.server:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=WORKERS,
+    )
@@ -0,0 +1,182 @@
+"""Допуск запросов к конвейеру и ограничение темпа вызовов апстрима.
+
+AdmissionController ограничивает число ходов диалога, которые выполняются
+одновременно, и длину очереди перед ними. Когда очередь заполнена или
+ожидание не укладывается в дедлайн, запрос сразу получает OverloadedError с
+оценкой Retry-After, а не ждёт, замедляя всех.
+
+TokenBucket ограничивает темп вызовов LLM (вызовов в секунду с запасом
+burst), чтобы всплеск запросов не упирался в лимит апстрима и не превращался
+в каскад 429 и размыкание выключателя.
+"""
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Deque, Optional
+
+from .metrics import ADMISSION, UPSTREAM_THROTTLE_WAIT
+
+
+class OverloadedError(Exception):
+    """Очередь ходов заполнена или ожидание не укладывается в дедлайн."""
+
+    def __init__(self, retry_after: float):
+        super().__init__("Сервер перегружен, повторите запрос позже")
+        self.retry_after = retry_after
+
+
+class RateLimitedError(Exception):
+    """Бюджет вызовов апстрима исчерпан на всё оставшееся время запроса."""
+
+    def __init__(self, retry_after: float):
+        super().__init__("Превышен темп вызовов LLM, повторите запрос позже")
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Ограничение одновременных ходов с ограниченной очередью FIFO.
+
+    Args:
+        max_concurrent (int): Сколько ходов выполняется одновременно,
+            0 - без ограничения.
+        max_queue (int): Сколько ходов может ждать своей очереди.
+    """
+
+    # Вес нового наблюдения в скользящем среднем длительности хода
+    EWMA_ALPHA = 0.2
+
+    def __init__(self, max_concurrent: int, max_queue: int):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self._active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._avg_duration = 0.0
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def retry_after(self) -> float:
+        """Оценка, через сколько секунд в очереди появится место."""
+        if not self.max_concurrent:
+            return 1
+        waves = (len(self._waiters) + 1) / self.max_concurrent
+        return max(1, math.ceil(self._avg_duration * waves))
+
+    @asynccontextmanager
+    async def admit(self, timeout: Optional[float] = None) -> AsyncIterator[None]:
+        """Занимает место для хода на время блока.
+
+        Args:
+            timeout (Optional[float]): Сколько секунд можно ждать в очереди.
+
+        Raises:
+            OverloadedError: Если очередь заполнена или место не освободилось
+                за timeout.
+        """
+        if not self.max_concurrent:
+            yield
+            return
+        if self._active < self.max_concurrent and not self._waiters:
+            self._active += 1
+            ADMISSION.inc(outcome="admitted")
+        else:
+            await self._wait(timeout)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - started
+            self._avg_duration += self.EWMA_ALPHA * (duration - self._avg_duration)
+            self._release()
+
+    async def _wait(self, timeout: Optional[float]) -> None:
+        if len(self._waiters) >= self.max_queue:
+            ADMISSION.inc(outcome="rejected")
+            raise OverloadedError(self.retry_after())
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # Место передали одновременно с отменой: вернуть его
+                self._release()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                ADMISSION.inc(outcome="timeout")
+                raise OverloadedError(self.retry_after()) from e
+            raise
+        ADMISSION.inc(outcome="queued")
+
+    def _release(self) -> None:
+        # Место передаётся первому ожидающему, счётчик занятых не меняется
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._active -= 1
+
+
+class TokenBucket:
+    """Ведро токенов: rate вызовов в секунду, до burst подряд.
+
+    Токены резервируются в порядке запросов: вызов, которому не хватило
+    токена, ждёт своего и не обгоняет пришедших раньше.
+
+    Args:
+        rate (float): Вызовов в секунду, 0 - без ограничения.
+        burst (float): Ёмкость ведра.
+        clock (Callable[[], float]): Источник времени.
+    """
+
+    def __init__(
+        self, rate: float, burst: float, clock: Callable[[], float] = time.monotonic
+    ):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._clock = clock
+        self._tokens = self.burst
+        self._updated = clock()
+
+    def reserve(self, cost: float = 1) -> float:
+        """Резервирует cost токенов и возвращает, сколько секунд ждать."""
+        if self.rate <= 0:
+            return 0
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= cost
+        return max(0.0, -self._tokens / self.rate)
+
+    def refund(self, cost: float = 1) -> None:
+        """Возвращает зарезервированные, но не использованные токены."""
+        if self.rate > 0:
+            self._tokens = min(self.burst, self._tokens + cost)
+
+    async def acquire(self, cost: float = 1, timeout: Optional[float] = None):
+        """Ждёт токены для cost вызовов апстрима.
+
+        Raises:
+            RateLimitedError: Если ожидание дольше timeout.
+        """
+        delay = self.reserve(cost)
+        if not delay:
+            return
+        if timeout is not None and delay > timeout:
+            self.refund(cost)
+            raise RateLimitedError(math.ceil(delay))
+        UPSTREAM_THROTTLE_WAIT.observe(delay)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.refund(cost)
+            raise
@@ -0,0 +1,102 @@
+"""Пул пар агентов autogen для одновременных диалогов уточнения.
+
+initiate_chat хранит историю диалога в самих агентах, поэтому одна пара
+агентов не может вести два диалога сразу. Каждый запуск уточнения берёт
+свободную пару из пула и возвращает её после сброса истории (reset).
+Размер пула ограничивает и число одновременных диалогов: если все пары
+заняты, запуск ждёт освобождения.
+"""
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Generic, List, Optional, TypeVar
+
+from .metrics import AGENT_POOL_IN_USE, AGENT_POOL_WAIT
+
+T = TypeVar("T")
+
+
+class AgentPoolTimeoutError(Exception):
+    """Свободная пара агентов не появилась за отведённое время."""
+
+
+class AgentPool(Generic[T]):
+    """Пул переиспользуемых агентов (или пар агентов).
+
+    Args:
+        factory (Callable[[], T]): Создаёт новую пару агентов.
+        reset (Callable[[T], None]): Сбрасывает состояние пары после диалога.
+        max_size (int): Максимальное число пар и одновременных диалогов.
+    """
+
+    def __init__(
+        self, factory: Callable[[], T], reset: Callable[[T], None], max_size: int
+    ):
+        if max_size < 1:
+            raise ValueError("Размер пула агентов должен быть не меньше 1")
+        self.factory = factory
+        self.reset = reset
+        self.max_size = max_size
+        self._idle: List[T] = []
+        self._created = 0
+        self._in_use = 0
+        self._semaphore = asyncio.Semaphore(max_size)
+
+    @property
+    def in_use(self) -> int:
+        return self._in_use
+
+    @property
+    def size(self) -> int:
+        """Число созданных пар."""
+        return self._created
+
+    @asynccontextmanager
+    async def checkout(self, timeout: Optional[float] = None) -> AsyncIterator[T]:
+        """Выдаёт свободную пару на время диалога и возвращает её в пул.
+
+        Если диалог завершился ошибкой (в том числе по дедлайну, когда поток
+        с initiate_chat ещё работает), пара не возвращается: её может
+        продолжать менять этот поток. Так же удаляется пара, которую не
+        удалось сбросить. Вместо удалённых пар при необходимости создаются
+        новые.
+
+        Args:
+            timeout (Optional[float]): Сколько секунд ждать свободную пару.
+
+        Raises:
+            AgentPoolTimeoutError: Если свободная пара не появилась за timeout.
+        """
+        with AGENT_POOL_WAIT.time():
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout)
+            except asyncio.TimeoutError as e:
+                raise AgentPoolTimeoutError() from e
+        try:
+            if self._idle:
+                agents = self._idle.pop()
+            else:
+                agents = self.factory()
+                self._created += 1
+            self._in_use += 1
+            AGENT_POOL_IN_USE.inc()
+        except BaseException:
+            self._semaphore.release()
+            raise
+        reusable = False
+        try:
+            yield agents
+            reusable = True
+        finally:
+            self._in_use -= 1
+            AGENT_POOL_IN_USE.dec()
+            if reusable:
+                try:
+                    self.reset(agents)
+                    self._idle.append(agents)
+                except Exception as e:
+                    logging.error(f"Не удалось сбросить агентов, пара удалена: {e}")
+                    reusable = False
+            if not reusable:
+                self._created -= 1
+            self._semaphore.release()
@@ -1,44 +1,109 @@
 """Файл с реализацией системы агентов для работы программы"""
+import asyncio
 import json
 import logging
-import re
 import time
-from typing import Annotated, Any, Dict, List
+from typing import Annotated, Any, Callable, Dict, Iterator, List, Optional, Tuple
 
-from autogen import Cache, ConversableAgent
+from autogen import Cache, ConversableAgent, register_function
 from autogen_agentchat.agents import AssistantAgent
 from autogen_ext.models.openai import OpenAIChatCompletionClient
 
+from .admission import AdmissionController, TokenBucket
+from .agent_pool import AgentPool, AgentPoolTimeoutError
+from .blocking import BlockingExecutor
 from .constants import (
     API_URL,
+    BLOCKING_POOL_SIZE,
+    CHAT_QUEUE_SIZE,
+    CIRCUIT_FAILURE_THRESHOLD,
+    CIRCUIT_RESET_TIMEOUT,
     CLARIFIER_DESCRIPTION,
+    CLARIFIER_MODE,
+    CLARIFIER_MODES,
+    CLARIFIER_POOL_SIZE,
     CLARIFIER_TASK,
     CLARIFY_JSON_TASK,
+    HISTORY_MAX_TURNS,
+    HISTORY_SUMMARY_TASK,
+    HISTORY_TOKEN_BUDGET,
     JSON_DESCRIPTION,
+    JSON_ONLY_TASK,
     JSON_TASK,
+    LLM_MAX_RETRIES,
+    LLM_RETRY_BASE_DELAY,
+    LLM_RETRY_MAX_DELAY,
+    MAX_CONCURRENT_CHATS,
     MODEL_NAME,
+    SCHEMA_EDIT_TASK,
+    SCHEMA_REPAIR_ATTEMPTS,
+    SCHEMA_REPAIR_TASK,
+    SESSION_BACKEND,
+    SESSION_BACKEND_URL,
+    SESSION_COMPACT_TOKENS,
+    SESSION_FLUSH_INTERVAL,
+    SESSION_IDLE_TTL,
+    SESSION_MAX_BYTES,
+    SESSION_MAX_COUNT,
+    SESSION_MAX_PENDING,
+    SESSION_SNAPSHOT_PATH,
+    SESSION_TOKEN_BUDGET,
     SYSTEM_CLARIFIER,
     SYSTEM_CLARIFIER_WITHOUT_TERMINATE,
+    SYSTEM_HISTORY_SUMMARIZER,
     SYSTEM_JSON_CREATOR,
+    SYSTEM_SCHEMA_EDITOR,
+    SYSTEM_SCHEMA_REPAIR,
+    TEMPLATE_MAX_LLM_FIELDS,
+    UPSTREAM_BURST,
+    UPSTREAM_RATE_LIMIT,
+    WORKERS,
 )
+from .deadline import Deadline, DeadlineExceededError
+from .json_extract import extract_json
 from .logging_config import configure_logging
+from .metrics import (
+    RETRIEVAL_DURATION,
+    SCHEMA_EDITS,
+    STAGE_DURATION,
+    current_stage,
+    record_llm_usage,
+)
 from .model_info import custom_model_info
+from .patching import PatchError, apply_json_patch, apply_merge_patch
+from .pipeline import StageGraph
+from .prompts import PromptBuilder, prefix_report
+from .required_fields import extract_required_fields
+from .resilience import CircuitBreaker, CircuitOpenError, RetryPolicy
 from .retrieval import get_retriever
+from .routing import (
+    CLARIFIER_STAGE,
+    CLARIFIER_TOOL_STAGE,
+    GENERATION_STAGE,
+    HISTORY_SUMMARY_STAGE,
+    REQUIRED_FIELDS_STAGE,
+    SCHEMA_EDIT_STAGE,
+    SCHEMA_REPAIR_STAGE,
+    ModelRouter,
+)
+from .session_backends import (
+    SessionWriter,
+    create_backend,
+    dumps_session,
+    loads_session,
+)
+from .session_gate import SessionGate
+from .session_snapshot import SessionSnapshot
+from .session_store import SessionStore
 from .sessions import SessionContext
-from .utils import SECRET_TOKEN, ClarifierSchema, generate
+from .templates import assemble_schema
+from .usage import TokenBudgetExceededError, current_usage
+from .utils import SECRET_TOKEN, ClarifierSchema, generate, generate_json
+from .validation import ValidationIssue, get_path, set_path, validator_cache
 
 configure_logging()
 
 
-def extract_braces(answer: str) -> str:
-    """
-    Возвращает подстроку от первого '{' до первого '}' после него включительно.
-    Если ни одной пары скобок не найдено, вернёт исходную строку.
-    """
-    match = re.search(r"\{.*?\}", answer, re.DOTALL)
-    return match.group(0) if match else answer
-
-
 logging.debug("Инициализация OpenAIChatCompletionClient")
 
 retriever = get_retriever()
@@ -51,16 +116,21 @@ model_client = OpenAIChatCompletionClient(
     base_url=API_URL,
     model_info=custom_model_info,
 )
+router = ModelRouter()
+clarifier_tool_config = router.config_for(CLARIFIER_TOOL_STAGE)
 llm_config = {
     "config_list": [
         {
-            "model": MODEL_NAME,
+            "model": clarifier_tool_config.model,
             "api_key": SECRET_TOKEN,
             "base_url": API_URL,
         }
     ],
+    "temperature": clarifier_tool_config.temperature,
     "timeout": 300,
 }
+if clarifier_tool_config.max_tokens is not None:
+    llm_config["max_tokens"] = clarifier_tool_config.max_tokens
 # Инициализация агентов
 schema_agent = AssistantAgent(
     name="schema_generator",
@@ -69,25 +139,26 @@ schema_agent = AssistantAgent(
     model_client=model_client,
 )
 
-clarification_agent = ConversableAgent(
-    name="clarifier",
-    system_message=SYSTEM_CLARIFIER,
-    description=CLARIFIER_DESCRIPTION,
-    llm_config=llm_config,
-)
-user_proxy = ConversableAgent(
-    name="User",
-    llm_config=False,
-    is_termination_msg=lambda msg: isinstance(msg, dict)
-    and msg.get("content") is not None
-    and "TERMINATE" in msg["content"],
-    max_consecutive_auto_reply=10,
-    human_input_mode="NEVER",
-)
+
+def retrieve_with_catalog(query: str) -> Dict[str, Any]:
+    """Ищет документ и возвращает его вместе с каталогом обязательных полей.
+
+    Returns:
+        Dict[str, Any]: original_value, required_fields и required_prompt
+            лучшего документа. Пустой словарь, если ничего не найдено.
+    """
+    with RETRIEVAL_DURATION.time():
+        answer = retriever.hybrid_search(query=query)
+    if not answer:
+        return {}
+    metadata = answer[0]["metadata"]
+    return {
+        "original_value": metadata["original_value"],
+        "required_fields": json.loads(metadata.get("required_fields") or "{}"),
+        "required_prompt": metadata.get("required_prompt", ""),
+    }
 
 
-@user_proxy.register_for_execution()
-@clarification_agent.register_for_llm(description="Получить json-документацию")
 def retrieve_documents(
     query: Annotated[
         str,
@@ -99,40 +170,271 @@ def retrieve_documents(
     if isinstance(query, dict) and "query" in query:
         query = str(query["query"])
     query = str(query)
-    answer = retriever.hybrid_search(query=query)
-    docs = answer[0]["metadata"]["original_value"]
-    return docs
+    # Каталог обязательных полей остаётся в индексе и достаётся по original_value,
+    # агенту отдаём только саму схему.
+    return retrieve_with_catalog(query).get("original_value", "")
+
+
+def create_clarifier_agents() -> Tuple[ConversableAgent, ConversableAgent]:
+    """Создаёт пару агентов для одного диалога уточнения: уточнитель и
+    исполнитель его вызовов поиска."""
+    clarification_agent = ConversableAgent(
+        name="clarifier",
+        system_message=SYSTEM_CLARIFIER,
+        description=CLARIFIER_DESCRIPTION,
+        llm_config=llm_config,
+    )
+    user_proxy = ConversableAgent(
+        name="User",
+        llm_config=False,
+        is_termination_msg=lambda msg: isinstance(msg, dict)
+        and msg.get("content") is not None
+        and "TERMINATE" in msg["content"],
+        max_consecutive_auto_reply=10,
+        human_input_mode="NEVER",
+    )
+    register_function(
+        retrieve_documents,
+        caller=clarification_agent,
+        executor=user_proxy,
+        description="Получить json-документацию",
+    )
+    return clarification_agent, user_proxy
+
+
+def reset_clarifier_agents(agents: Tuple[ConversableAgent, ConversableAgent]):
+    """Очищает историю и счётчики автоответов пары после диалога."""
+    for agent in agents:
+        agent.reset()
 
 
 logging.info("Агенты schema_generator и clarifier готовы")
+# Ключ очистки в очереди сессии, не совпадает ни с одним сообщением
+CLEAR_REQUEST = ("clear",)
+# Вызовы LLM одного диалога уточнения autogen: два хода и итог рефлексии
+CLARIFIER_CHAT_CALLS = 3
 
 
 class ChatManager:
     """Менеджер чата, осуществляющий управление"""
 
-    def __init__(self):
-        self.sessions: Dict[str, SessionContext] = {}
-        logging.info("ChatManager создан")
-        self.model_name = "gemma-3-27b-it"
-        self.max_api_retries = 3
-        self.retry_delay = 1
+    def __init__(self, clarifier_mode: str = CLARIFIER_MODE):
+        if clarifier_mode not in CLARIFIER_MODES:
+            raise ValueError(
+                f"Неизвестный режим уточнения {clarifier_mode}, "
+                f"допустимые: {', '.join(CLARIFIER_MODES)}"
+            )
+        self.sessions = SessionStore(
+            max_sessions=SESSION_MAX_COUNT,
+            max_bytes=SESSION_MAX_BYTES,
+            idle_ttl=SESSION_IDLE_TTL,
+        )
+        self.session_gate = SessionGate(max_pending=SESSION_MAX_PENDING)
+        # Внешнее хранилище нужно, только если сессии делят несколько воркеров
+        self.session_writer: Optional[SessionWriter] = None
+        if SESSION_BACKEND != "memory":
+            self.session_writer = SessionWriter(
+                create_backend(SESSION_BACKEND, SESSION_BACKEND_URL, SESSION_IDLE_TTL),
+                flush_interval=SESSION_FLUSH_INTERVAL,
+            )
+        self.snapshot: Optional[SessionSnapshot] = None
+        if SESSION_SNAPSHOT_PATH and self.session_writer is None:
+            if WORKERS > 1:
+                # Каждый воркер восстановил бы те же сессии, а при остановке
+                # перезаписал бы файл снимками только своих сессий
+                logging.warning(
+                    "Снимок сессий отключён: при WORKERS > 1 сессии делят"
+                    " через SESSION_BACKEND=sqlite или redis"
+                )
+            else:
+                self.snapshot = SessionSnapshot(SESSION_SNAPSHOT_PATH)
+        logging.info("ChatManager создан, режим уточнения: %s", clarifier_mode)
+        self.router = router
+        self.clarifier_mode = clarifier_mode
+        self.executor = BlockingExecutor(BLOCKING_POOL_SIZE)
+        self.admission = AdmissionController(MAX_CONCURRENT_CHATS, CHAT_QUEUE_SIZE)
+        self.upstream_budget = TokenBucket(UPSTREAM_RATE_LIMIT, UPSTREAM_BURST)
+        self.agent_pool = AgentPool(
+            create_clarifier_agents, reset_clarifier_agents, CLARIFIER_POOL_SIZE
+        )
+        self.retry_policy = RetryPolicy(
+            max_attempts=LLM_MAX_RETRIES,
+            base_delay=LLM_RETRY_BASE_DELAY,
+            max_delay=LLM_RETRY_MAX_DELAY,
+            breaker=CircuitBreaker(
+                failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+                reset_timeout=CIRCUIT_RESET_TIMEOUT,
+            ),
+        )
+
+    def usage_report(self, limit: int = 20) -> Dict[str, Any]:
+        """
+        Расход токенов по сессиям, начиная с самых затратных.
+
+        Args:
+            limit (int): Сколько сессий вернуть.
+        """
+        reports = {
+            session_id: session.token_usage.report()
+            for session_id, session in self.sessions.items()
+        }
+        top = sorted(reports, key=lambda k: reports[k]["total_tokens"], reverse=True)
+        return {
+            "sessions": len(reports),
+            "total_tokens": sum(r["total_tokens"] for r in reports.values()),
+            "top": {session_id: reports[session_id] for session_id in top[:limit]},
+        }
+
+    async def _load_session(self, session_id: str) -> Optional[SessionContext]:
+        """Сессия из памяти или, при общем хранилище, из внешнего хранилища.
+
+        Общее хранилище читается на каждом запросе: предыдущий ход сессии мог
+        обработать другой воркер.
+        """
+        if self.session_writer is None:
+            session = self.sessions.get(session_id)
+            if session is None and self.snapshot and session_id in self.snapshot:
+                session = await asyncio.to_thread(self.snapshot.pop, session_id)
+                if session is not None:
+                    self.sessions.put(session_id, session)
+            return session
+        data = await asyncio.to_thread(self.session_writer.load, session_id)
+        if data is None:
+            self.sessions.delete(session_id)
+            return None
+        session = loads_session(data)
+        self.sessions.put(session_id, session)
+        return session
+
+    def _save_session(self, session_id: str, session: SessionContext) -> None:
+        # Пересчитать размер сессии после изменения
+        self.sessions.put(session_id, session)
+        if self.session_writer is not None:
+            self.session_writer.save(session_id, dumps_session(session))
 
-    def clear_messages(self, session_id: str):
-        """Очистить сообщения в памяти сессии"""
+    def restore_snapshot(self) -> int:
+        """Читает индекс снимка сессий; сами сессии восстанавливаются при
+        первом обращении."""
+        if self.snapshot is None:
+            return 0
+        count = self.snapshot.open(self.sessions.idle_ttl)
+        logging.info("В снимке %s сессий для восстановления", count)
+        return count
+
+    def save_snapshot(self) -> int:
+        """Записывает сессии из памяти в снимок при остановке."""
+        if self.snapshot is None:
+            return 0
+        count = self.snapshot.write(self._snapshot_items())
+        logging.info("В снимок записано %s сессий", count)
+        return count
+
+    def _snapshot_items(self) -> Iterator[Tuple[str, bytes, float]]:
+        # Сессия, которую не удалось сериализовать, не срывает весь снимок
+        now = time.time()
+        for session_id, session, idle in self.sessions.idle_items():
+            try:
+                data = dumps_session(session)
+            except (TypeError, ValueError) as e:
+                logging.error(f"Сессия {session_id[:64]!r} пропущена в снимке: {e}")
+                continue
+            yield session_id, data, now - idle
+
+    async def clear_messages(self, session_id: str):
+        """Очистить сообщения в памяти сессии. Неизвестная сессия не создаётся.
+
+        Очистка встаёт в очередь запросов сессии, чтобы ход, который
+        выполняется сейчас, не сохранил сессию поверх очищенной.
+        """
         try:
-            session = self.sessions.setdefault(session_id, SessionContext())
-            session.clear_session()
+            await self.session_gate.run(
+                session_id, CLEAR_REQUEST, lambda: self._clear_session(session_id)
+            )
             return True
         except Exception:
             return False
 
-    async def handle_message(self, session_id: str, message: str) -> Dict[str, Any]:
-        """Обработчик сообщений"""
-        session = self.sessions.setdefault(session_id, SessionContext())
+    async def _clear_session(self, session_id: str) -> None:
+        session = await self._load_session(session_id)
+        if session is not None:
+            session.clear_session()
+            self._save_session(session_id, session)
+
+    async def handle_message(
+        self, session_id: str, message: str, deadline: Optional[Deadline] = None
+    ) -> Dict[str, Any]:
+        """Обработчик сообщений
+
+        Запросы одной сессии выполняются по очереди. Такое же сообщение той же
+        сессии, пока предыдущее ещё в очереди или обрабатывается, получает его
+        результат без повторной обработки.
+
+        Args:
+            session_id (str): Идентификатор сессии.
+            message (str): Сообщение пользователя.
+            deadline (Optional[Deadline]): Дедлайн запроса, который проверяется
+                на каждом этапе и ограничивает таймауты вызовов LLM.
+
+        Raises:
+            DeadlineExceededError: Если время на обработку запроса истекло.
+            TokenBudgetExceededError: Если сессия израсходовала бюджет токенов.
+            SessionBusyError: Если очередь запросов сессии заполнена.
+            OverloadedError: Если очередь ходов всего процесса заполнена.
+            RateLimitedError: Если бюджет вызовов апстрима не укладывается в
+                дедлайн.
+        """
+        return await self.session_gate.run(
+            session_id,
+            message,
+            lambda: self._handle_turn(session_id, message, deadline),
+        )
+
+    async def _handle_turn(
+        self, session_id: str, message: str, deadline: Optional[Deadline]
+    ) -> Dict[str, Any]:
+        """Ход диалога под блокировкой сессии.
+
+        Конвейер запускается после допуска self.admission: ожидание места в
+        очереди ограничено дедлайном запроса.
+        """
+        session = await self._load_session(session_id)
+        if session is None:
+            session = SessionContext()
+        used = session.token_usage.total_tokens
+        if SESSION_TOKEN_BUDGET and used >= SESSION_TOKEN_BUDGET:
+            raise TokenBudgetExceededError(used, SESSION_TOKEN_BUDGET)
+        timeout = deadline.remaining() if deadline is not None else None
+        async with self.admission.admit(timeout):
+            return await self._run_turn(session_id, session, message, deadline)
+
+    async def _run_turn(
+        self,
+        session_id: str,
+        session: SessionContext,
+        message: str,
+        deadline: Optional[Deadline],
+    ) -> Dict[str, Any]:
+        session.token_usage.start_turn()
+        token = current_usage.set(session.token_usage)
+        try:
+            return await self._process_message(session, message, deadline)
+        finally:
+            current_usage.reset(token)
+            self._save_session(session_id, session)
+            logging.info(
+                "Токены сессии %s: %s",
+                session_id,
+                session.token_usage.report(),
+            )
+
+    async def _process_message(
+        self, session: SessionContext, message: str, deadline: Optional[Deadline]
+    ) -> Dict[str, Any]:
+        """Один ход диалога: уточнение параметров и генерация схемы."""
         session.update_with_user(message)
-        result = self._detect_missing_params(session)
+        result = await self._detect_missing_params(session, deadline)
         try:
-            json_result = json.loads(result)
+            json_result = json.loads(extract_json(result))
         except json.JSONDecodeError:
             logging.error("Ошибка конвертации в Json")
             return {
@@ -145,91 +447,468 @@ class ChatManager:
             session.add_collected_param(field, desc)
         if not json_result["can_generate_schema"]:
             # session.awaiting_clarification = True
-            session.update_with_user(json_result["message"])
+            session.update_with_assistant(json_result["message"])
             return {
                 "message": "Отсутствующие поля:"
                 + ", ".join(json_result["missing"])
                 + json_result["message"],
                 "json_schema": "",
             }
+        history = " ".join(session.get_prompt_history())
+        answer = None
+        if session.current_schema:
+            with STAGE_DURATION.time(stage=SCHEMA_EDIT_STAGE):
+                answer = await self._edit_schema(session, history, deadline)
+            SCHEMA_EDITS.inc(outcome="fallback" if answer is None else "applied")
         else:
-            schema = ""
-            if not (session.current_schema is None):
-                schema = "текущая схема: " + str(session.current_schema)
+            with STAGE_DURATION.time(stage="template"):
+                answer = self._assemble_schema(session)
+        if answer is None:
+            with STAGE_DURATION.time(stage=GENERATION_STAGE):
+                answer = await self._generate_schema(session, history, deadline)
+        answer = await self._validate_and_repair(session, answer, history, deadline)
+        session.current_schema = answer
+        return {"message": "Полученная схема", "json_schema": answer}
+
+    def _assemble_schema(self, session: SessionContext) -> Optional[str]:
+        """
+        Собирает схему по шаблону из дерева правил и collected_params.
+
+        Поля, которые не удалось заполнить, дописывает _validate_and_repair
+        точечным вызовом LLM. Если таких полей больше TEMPLATE_MAX_LLM_FIELDS,
+        возвращается None и схема генерируется целиком.
+
+        Returns:
+            Optional[str]: Собранная схема или None.
+        """
+        if TEMPLATE_MAX_LLM_FIELDS < 0 or not session.collected_params:
+            return None
+        try:
+            definition = json.loads(session.bd_context)
+        except (json.JSONDecodeError, TypeError):
+            return None
+        if not isinstance(definition, dict):
+            return None
+        document, used = assemble_schema(definition, session.collected_params)
+        if not used:
+            return None
+        issues = validator_cache.get(definition).validate(document)
+        allowed = TEMPLATE_MAX_LLM_FIELDS if SCHEMA_REPAIR_ATTEMPTS > 0 else 0
+        if len(issues) > allowed:
+            logging.info(
+                "Шаблон не заполнен: %s, схема генерируется целиком",
+                ", ".join(issue.path for issue in issues),
+            )
+            return None
+        logging.info("Схема собрана по шаблону, полей из диалога: %d", used)
+        return json.dumps(document, ensure_ascii=False)
+
+    async def _generate_schema(
+        self,
+        session: SessionContext,
+        history: str,
+        deadline: Optional[Deadline] = None,
+    ) -> str:
+        """Генерирует схему целиком по найденной документации."""
+        current_schema = self._current_schema_block(session)
+        try:
+            print(session.bd_context)
+            return await self._generate_with_retry(
+                PromptBuilder(GENERATION_STAGE, SYSTEM_JSON_CREATOR)
+                .static(JSON_TASK)
+                .dynamic(current_schema, history)
+                .build(),
+                json_schema=json.loads(session.bd_context),
+                deadline=deadline,
+            )
+        except (CircuitOpenError, DeadlineExceededError):
+            raise
+        except Exception:
+            logging.warning("Json schema не валидна")
+            return await self._generate_with_retry(
+                PromptBuilder(GENERATION_STAGE, SYSTEM_JSON_CREATOR)
+                .static(JSON_TASK, JSON_ONLY_TASK)
+                .dynamic("Схема: " + session.bd_context, current_schema, history)
+                .build(),
+                deadline=deadline,
+                func=generate_json,
+            )
+
+    async def _edit_schema(
+        self,
+        session: SessionContext,
+        history: str,
+        deadline: Optional[Deadline] = None,
+    ) -> Optional[str]:
+        """
+        Вносит правку в текущую схему через JSON Patch или merge patch.
+
+        Модель возвращает только правку, она применяется локально. Если
+        правку получить или применить не удалось, возвращается None и схема
+        генерируется целиком.
+
+        Returns:
+            Optional[str]: Схема с правкой или None.
+        """
+        try:
+            document = json.loads(session.current_schema)
+        except (json.JSONDecodeError, TypeError):
+            return None
+        if not isinstance(document, dict):
+            return None
+        try:
+            answer = await self._generate_with_retry(
+                PromptBuilder(SCHEMA_EDIT_STAGE, SYSTEM_SCHEMA_EDITOR)
+                .static(SCHEMA_EDIT_TASK)
+                .dynamic(
+                    self._current_schema_block(session),
+                    "Сообщения пользователя: " + history,
+                )
+                .build(),
+                deadline=deadline,
+                stage=SCHEMA_EDIT_STAGE,
+                func=generate_json,
+            )
+            edit = json.loads(answer)
+            if isinstance(edit, dict) and "patch" in edit:
+                document = apply_json_patch(document, edit["patch"])
+            elif isinstance(edit, dict) and "merge_patch" in edit:
+                document = apply_merge_patch(document, edit["merge_patch"])
+            else:
+                raise PatchError("В ответе нет patch или merge_patch")
+        except (CircuitOpenError, DeadlineExceededError):
+            raise
+        except Exception as e:
+            logging.warning(
+                f"Правка схемы не применилась, схема генерируется заново: {e}"
+            )
+            return None
+        if not isinstance(document, dict):
+            return None
+        return json.dumps(document, ensure_ascii=False)
+
+    async def _validate_and_repair(
+        self,
+        session: SessionContext,
+        answer: str,
+        history: str,
+        deadline: Optional[Deadline] = None,
+    ) -> str:
+        """
+        Проверяет схему по определению из дерева правил и исправляет ошибки.
+
+        В LLM отправляются только пути с ошибками, ответ - значения этих
+        полей, которые подставляются в схему локально. Если исправить не
+        удалось, возвращается схема как есть.
+
+        Returns:
+            str: Исправленная схема или исходный ответ.
+        """
+        try:
+            document = json.loads(answer)
+            definition = json.loads(session.bd_context)
+        except (json.JSONDecodeError, TypeError):
+            return answer
+        if not isinstance(document, dict) or not isinstance(definition, dict):
+            return answer
+        validator = validator_cache.get(definition)
+        issues = validator.validate(document)
+        repaired = False
+        for _ in range(SCHEMA_REPAIR_ATTEMPTS):
+            if not issues:
+                break
+            logging.info(
+                "Схема не прошла проверку: %s", ", ".join(i.path for i in issues)
+            )
             try:
-                print(session.bd_context)
-                answer = self._generate_with_retry(  # Изменено на метод с retry
-                    schema + JSON_TASK + " ".join(session.get_messages()),
-                    system_prompt=SYSTEM_JSON_CREATOR,
-                    model=self.model_name,
-                    json_schema=json.loads(session.bd_context),
+                fixes = json.loads(
+                    await self._generate_with_retry(
+                        PromptBuilder(SCHEMA_REPAIR_STAGE, SYSTEM_SCHEMA_REPAIR)
+                        .static(SCHEMA_REPAIR_TASK)
+                        .dynamic(self._repair_block(document, issues), history)
+                        .build(),
+                        deadline=deadline,
+                        stage=SCHEMA_REPAIR_STAGE,
+                        func=generate_json,
+                    )
                 )
-            except Exception:
-                logging.warning("Json schema не валидна")
-                answer = self._generate_with_retry(  # Изменено на метод с retry
-                    schema
-                    + JSON_TASK
-                    + " ".join(session.get_messages())
-                    + "В ответе должен быть только Json, без ``` и других подобных символов. Схема: "
-                    + session.bd_context,
-                    system_prompt=SYSTEM_JSON_CREATOR,
-                    model=self.model_name,
+            except (CircuitOpenError, DeadlineExceededError):
+                raise
+            except Exception as e:
+                logging.warning(f"Не удалось исправить схему: {e}")
+                break
+            if not isinstance(fixes, dict):
+                break
+            paths = {issue.path for issue in issues}
+            for path, value in fixes.items():
+                if path not in paths:
+                    continue
+                try:
+                    set_path(document, path, value)
+                    repaired = True
+                except ValueError as e:
+                    logging.warning(e)
+            issues = validator.validate(document)
+        if issues:
+            logging.warning(
+                "В схеме остались ошибки: %s", ", ".join(i.path for i in issues)
+            )
+        return json.dumps(document, ensure_ascii=False) if repaired else answer
+
+    @staticmethod
+    def _repair_block(document: Dict[str, Any], issues: List[ValidationIssue]) -> str:
+        """Список ошибок схемы с текущими значениями полей для промпта."""
+        lines = ["Ошибки:"]
+        for issue in issues:
+            current = json.dumps(get_path(document, issue.path), ensure_ascii=False)
+            lines.append(
+                f"{issue.path}: {issue.message}. {issue.description}"
+                f" Сейчас: {current}"
+            )
+        return "\n".join(lines)
+
+    def _current_schema_block(self, session: SessionContext) -> str:
+        """Блок промпта с текущей схемой сессии, если она уже есть."""
+        if session.current_schema is None:
+            return ""
+        return "текущая схема: " + str(session.current_schema)
+
+    async def _compact_history(
+        self, session: SessionContext, deadline: Optional[Deadline] = None
+    ) -> None:
+        """
+        Сворачивает старые сообщения сессии в краткое содержание, чтобы размер
+        промпта не рос с длиной диалога. Собранные параметры хранятся отдельно
+        в collected_params и не зависят от свёртки.
+
+        Свёртка выполняется и тогда, когда промпты предыдущего хода по данным
+        API заняли больше SESSION_COMPACT_TOKENS токенов.
+        """
+        over_budget = (
+            SESSION_COMPACT_TOKENS > 0
+            and session.token_usage.last_turn_prompt_tokens > SESSION_COMPACT_TOKENS
+        )
+        keep_turns = HISTORY_MAX_TURNS // 2
+        if not over_budget and not session.needs_compaction(
+            HISTORY_MAX_TURNS, HISTORY_TOKEN_BUDGET, keep_turns
+        ):
+            return
+        old_messages = session.get_messages_to_compact(keep_turns)
+        if not old_messages:
+            return
+        prompt = (
+            PromptBuilder(HISTORY_SUMMARY_STAGE, SYSTEM_HISTORY_SUMMARIZER)
+            .static(HISTORY_SUMMARY_TASK)
+            .dynamic(
+                "Текущее краткое содержание: " + (session.summary or "нет"),
+                "Новые сообщения:\n" + "\n".join(old_messages),
+            )
+            .build()
+        )
+        try:
+            summary = await self._generate_with_retry(
+                prompt,
+                deadline=deadline,
+                stage=HISTORY_SUMMARY_STAGE,
+            )
+        except (CircuitOpenError, DeadlineExceededError):
+            raise
+        except Exception as e:
+            logging.warning(f"Не удалось свернуть историю сессии: {e}")
+            return
+        session.apply_summary(summary, len(old_messages))
+        logging.info("Свёрнуто %d сообщений истории", len(old_messages))
+
+    async def _detect_missing_params(
+        self, session: SessionContext, deadline: Optional[Deadline] = None
+    ) -> str:
+        """
+        проверить, каких параметров не хватает или всех хватает
+
+        Этапы выполняются как граф зависимостей: свёртка истории не зависит от
+        поиска документации и обязательных полей и идёт параллельно с ними,
+        структурированное уточнение ждёт все три этапа.
+        """
+        graph = StageGraph()
+
+        async def history_stage() -> None:
+            with STAGE_DURATION.time(stage=HISTORY_SUMMARY_STAGE):
+                await self._compact_history(session, deadline)
+
+        async def retrieval_stage() -> Tuple[str, str]:
+            with STAGE_DURATION.time(stage="retrieval"):
+                return await self._retrieve_context(session, deadline)
+
+        async def required_fields_stage(retrieval: Tuple[str, str]) -> str:
+            bd_context, _ = retrieval
+            if not bd_context:
+                return ""
+            with STAGE_DURATION.time(stage=REQUIRED_FIELDS_STAGE):
+                required_prompt = await self._lookup_required_prompt(
+                    bd_context, deadline
                 )
-                trimmed = extract_braces(answer)
-                answer = trimmed
-            session.current_schema = answer
-            return {"message": "Полученная схема", "json_schema": answer}
-
-    def _detect_missing_params(self, session: SessionContext) -> str:
-        """проверить, каких параметров не хватает или всех хватает"""
-        chat_text = None
-        history = session.get_messages()
-        buf = history.copy()
-        buf.append(CLARIFIER_TASK)
-        msg = " ".join(buf)
-        if session.bd_context == "":
-            with Cache.disk() as cache:
-                chat_result = user_proxy.initiate_chat(
+            logging.info("required prompt " + required_prompt)
+            return required_prompt
+
+        async def clarifier_stage(
+            history: None, retrieval: Tuple[str, str], required_fields: str
+        ) -> str:
+            bd_context, chat_text = retrieval
+            session.update_with_bd_context(bd_context=bd_context)
+            msg = "\n".join(session.get_prompt_history())
+            if session.awaiting_clarification:
+                msg += "\n" + session.get_collected_params_as_str()
+                session.clear_missing()
+            with STAGE_DURATION.time(stage=CLARIFIER_STAGE):
+                return await self._generate_with_retry(
+                    self._clarifier_prompt(session, required_fields, msg, chat_text),
+                    json_schema=ClarifierSchema.model_json_schema(),
+                    deadline=deadline,
+                    stage=CLARIFIER_STAGE,
+                )
+
+        graph.add("history", history_stage)
+        graph.add("retrieval", retrieval_stage)
+        graph.add("required_fields", required_fields_stage, deps=("retrieval",))
+        graph.add(
+            "clarifier",
+            clarifier_stage,
+            deps=("history", "retrieval", "required_fields"),
+        )
+        results = await graph.run()
+        return results["clarifier"]
+
+    async def _retrieve_context(
+        self, session: SessionContext, deadline: Optional[Deadline] = None
+    ) -> Tuple[str, str]:
+        """
+        Находит документацию для сессии.
+
+        В режиме "agent" документацию ищет агент-уточнитель через вызов
+        инструмента, в режиме "fast" поиск выполняется напрямую. Если
+        документация уже найдена на прошлых ходах, она переиспользуется.
+
+        Returns:
+            Tuple[str, str]: Найденная схема и текст диалога агента (пустой,
+                если диалога не было).
+        """
+        if session.bd_context != "":
+            return session.bd_context, ""
+        history = " ".join(session.get_prompt_history())
+        if self.clarifier_mode == "fast":
+            found = await self._run_blocking(
+                retrieve_with_catalog,
+                history,
+                stage="retrieval",
+                stage_deadline=deadline,
+            )
+            return found.get("original_value", ""), ""
+
+        agent_message = CLARIFIER_TASK + "\n\n" + history
+        prefix_report.record(
+            CLARIFIER_TOOL_STAGE,
+            [
+                {"role": "system", "content": SYSTEM_CLARIFIER},
+                {"role": "user", "content": agent_message},
+            ],
+        )
+        started = time.perf_counter()
+        with Cache.disk() as cache:
+            chat_result = await self.retry_policy.run(
+                self._clarifier_chat,
+                agent_message,
+                cache,
+                stage_deadline=deadline,
+                deadline=deadline,
+            )
+        self.router.record(
+            CLARIFIER_TOOL_STAGE,
+            clarifier_tool_config.model,
+            time.perf_counter() - started,
+        )
+        self._record_agent_usage(chat_result)
+        return (
+            self._extract_tool_responses(chat_result),
+            self._extract_content(chat_result),
+        )
+
+    async def _clarifier_chat(
+        self, message: str, cache: Any, stage_deadline: Optional[Deadline]
+    ) -> Any:
+        """Один диалог уточнения на паре агентов из пула.
+
+        Каждая попытка повтора берёт пару заново, поэтому начинает с чистой
+        истории.
+        """
+        timeout = None
+        if stage_deadline is not None:
+            timeout = stage_deadline.timeout_for(CLARIFIER_TOOL_STAGE)
+        await self.upstream_budget.acquire(CLARIFIER_CHAT_CALLS, timeout)
+        if stage_deadline is not None:
+            timeout = stage_deadline.timeout_for(CLARIFIER_TOOL_STAGE)
+        try:
+            async with self.agent_pool.checkout(timeout) as agents:
+                clarification_agent, user_proxy = agents
+                # cost в ChatResult накапливается клиентом агента, а пара
+                # переиспользуется: без сброса в него попадут прошлые диалоги
+                for agent in agents:
+                    if agent.client is not None:
+                        agent.client.clear_usage_summary()
+                return await self._run_blocking(
+                    user_proxy.initiate_chat,
                     clarification_agent,
-                    message=msg,
+                    message=message,
                     max_turns=2,
                     summary_method="reflection_with_llm",
                     cache=cache,
+                    stage=CLARIFIER_TOOL_STAGE,
+                    stage_deadline=stage_deadline,
                 )
+        except AgentPoolTimeoutError as e:
+            raise DeadlineExceededError(CLARIFIER_TOOL_STAGE) from e
 
-            chat_text = self._extract_content(chat_result)
-        if session.awaiting_clarification or session.bd_context != "":
-            tool_extract = session.bd_context
-        else:
-            tool_extract = self._extract_tool_responses(chat_result)
-        if session.awaiting_clarification:
-            buf = history.copy()
-            buf.append(session.get_collected_params_as_str())
-            msg = "\n".join(buf)
-            session.clear_missing()
-
-        required_prompt = self.get_required_fields(
-            tool_extract,
-        )
-        logging.info("required prompt " + required_prompt)
-        session.update_with_bd_context(bd_context=tool_extract)
-        schema = ""
-        if not (session.current_schema is None):
-            schema = "текущая схема" + str(session.current_schema)
-        prompt = (
-            schema + required_prompt + CLARIFY_JSON_TASK + chat_text
-            if chat_text
-            else ""
-        )
-        logging.info("MEssage for final solution " + prompt)
-        raw_answer = generate(
-            "Предыдущие сообщения пользователя и уже введённые поля: " + msg + prompt,
-            model=self.model_name,
-            system_prompt=SYSTEM_CLARIFIER_WITHOUT_TERMINATE,
-            json_schema=ClarifierSchema.model_json_schema(),
+    def _record_agent_usage(self, chat_result: Any) -> None:
+        """Учитывает токены диалога агента-уточнителя в метриках.
+
+        Берётся usage_excluding_cached_inference: ответы из дискового кэша
+        autogen не расходуют токены апстрима. Счётчики пары агентов
+        сбрасываются перед диалогом, поэтому cost относится только к нему.
+        """
+        usage = (getattr(chat_result, "cost", None) or {}).get(
+            "usage_excluding_cached_inference", {}
         )
+        for model, stats in usage.items():
+            if not isinstance(stats, dict):
+                continue
+            record_llm_usage(
+                model,
+                stats.get("prompt_tokens", 0),
+                stats.get("completion_tokens", 0),
+                stage=CLARIFIER_TOOL_STAGE,
+            )
 
-        return raw_answer
+    def _clarifier_prompt(
+        self,
+        session: SessionContext,
+        required_prompt: str,
+        history: str,
+        chat_text: str = "",
+    ) -> List[Dict[str, str]]:
+        """
+        Собирает промпт структурированного уточнения: инструкции в начале,
+        затем данные сессии от самых стабильных к меняющимся каждый ход.
+        """
+        return (
+            PromptBuilder(CLARIFIER_STAGE, SYSTEM_CLARIFIER_WITHOUT_TERMINATE)
+            .static(CLARIFY_JSON_TASK)
+            .dynamic(
+                required_prompt,
+                self._current_schema_block(session),
+                chat_text,
+                "Предыдущие сообщения пользователя и уже введённые поля: " + history,
+            )
+            .build()
+        )
 
     def _extract_summary(self, task_result: dict | Any) -> str:
         """извлечь пересказ чата"""
@@ -285,32 +964,104 @@ class ChatManager:
                     return answer
         return ""
 
-    def _generate_with_retry(self, *args, **kwargs) -> Any:
+    async def _run_blocking(
+        self,
+        func: Callable[..., Any],
+        *args,
+        stage: str,
+        stage_deadline: Optional[Deadline] = None,
+        **kwargs,
+    ) -> Any:
         """
-        Повторяет вызов API с задержкой при ошибках.
+        Выполняет синхронный вызов в пуле потоков self.executor с учётом
+        дедлайна.
+
+        Если дедлайн истекает раньше, ожидание прерывается и следующий этап
+        не запускается. Сам поток дорабатывает до таймаута своего клиента;
+        вызов, который ещё ждал потока в очереди, не выполняется.
+
+        Args:
+            func: Синхронная функция
+            *args: Аргументы для func
+            stage: Название этапа для ошибки о дедлайне
+            stage_deadline: Дедлайн запроса
+            **kwargs: Ключевые аргументы для func
+
+        Raises:
+            DeadlineExceededError: Если дедлайн истёк до или во время вызова
+        """
+        call = self.executor.run(func, *args, **kwargs)
+        if stage_deadline is None:
+            return await call
+        try:
+            return await asyncio.wait_for(call, stage_deadline.timeout_for(stage))
+        except asyncio.TimeoutError as e:
+            raise DeadlineExceededError(stage) from e
+
+    async def _generate_with_retry(
+        self,
+        *args,
+        deadline: Optional[Deadline] = None,
+        stage: str = GENERATION_STAGE,
+        func: Callable[..., str] = generate,
+        **kwargs,
+    ) -> Any:
+        """
+        Повторяет вызов API с экспоненциальной задержкой при ошибках апстрима.
+
+        Модель, max_tokens и temperature берутся из таблицы маршрутизации
+        этапа, если не переданы явно.
 
         Args:
             *args: Аргументы для функции generate
+            deadline: Дедлайн запроса, оставшееся время передаётся как таймаут
+            stage: Название этапа для маршрутизации и ошибки о дедлайне
+            func: Функция вызова модели, generate или generate_json
             **kwargs: Ключевые аргументы для функции generate
 
         Returns:
             Результат выполнения generate()
 
         Raises:
+            CircuitOpenError: Если апстрим недоступен и выключатель разомкнут
+            DeadlineExceededError: Если время на обработку запроса истекло
+            RateLimitedError: Если бюджет вызовов апстрима не укладывается в дедлайн
             Exception: Если все попытки подключения исчерпаны
         """
-        for attempt in range(self.max_api_retries):
+
+        config = self.router.config_for(stage)
+        kwargs.setdefault("model", config.model)
+        kwargs.setdefault("temperature", config.temperature)
+        kwargs.setdefault("max_tokens", config.max_tokens)
+
+        async def call() -> str:
+            # Каждая попытка, включая повторы, расходует бюджет апстрима
+            await self.upstream_budget.acquire(
+                timeout=deadline.timeout_for(stage) if deadline is not None else None
+            )
+            timeout = deadline.timeout_for(stage) if deadline is not None else None
+            started = time.perf_counter()
+            # Поток пула получает копию контекста, generate учтёт токены
+            # на этом этапе
+            token = current_stage.set(stage)
             try:
-                return generate(*args, **kwargs)
-            except Exception as e:
-                if attempt < self.max_api_retries - 1:
-                    logging.warning(
-                        f"Ошибка API (попытка {attempt + 1}): {str(e)}. Повтор через {self.retry_delay}с"
-                    )
-                    time.sleep(self.retry_delay)
-                else:
-                    logging.error("Все попытки подключения к API исчерпаны")
-                    raise
+                answer = await self._run_blocking(
+                    func,
+                    *args,
+                    timeout=timeout,
+                    stage=stage,
+                    stage_deadline=deadline,
+                    **kwargs,
+                )
+            except Exception:
+                self.router.record_error(stage, kwargs["model"])
+                raise
+            finally:
+                current_stage.reset(token)
+            self.router.record(stage, kwargs["model"], time.perf_counter() - started)
+            return answer
+
+        return await self.retry_policy.run(call, deadline=deadline)
 
     def _generate_missing_params_prompt(self, required_fields: Dict) -> str:
         """
@@ -330,7 +1081,24 @@ class ChatManager:
 
         return "\n".join(prompt_lines)
 
-    def get_required_fields(self, schema: str) -> str:
+    async def _lookup_required_prompt(
+        self, schema: str, deadline: Optional[Deadline] = None
+    ) -> str:
+        """
+        Возвращает список обязательных полей для найденной схемы.
+
+        Берётся предрассчитанный при построении индекса каталог, и только если
+        схема не из индекса, поля выписываются через LLM.
+        """
+        catalog = retriever.get_catalog(schema)
+        if catalog is not None:
+            return catalog["required_prompt"]
+        logging.warning("Каталог обязательных полей не найден, запрос к LLM")
+        return await self.get_required_fields(schema, deadline)
+
+    async def get_required_fields(
+        self, schema: str, deadline: Optional[Deadline] = None
+    ) -> str:
         prompt = "Вот пример, как нужно выписать переменные."
         example = """type (обязательно) — тип Workflow (WF), например: complex, await_for_message, rest_call и др.
 name (обязательно) — уникальное имя WF.
@@ -356,13 +1124,15 @@ sendToSapConfig (обязательно, если type равен 'send_to_sap')
 flowEditorConfig (опционально) — вспомогательная информация, предназначенная исключительно для визуального редактора и не оказывающая влияния на исполнение самого workflow."""
         prompt = (
             prompt + example + ". Тебе нужно из Json файла в таком же формате выписать"
-            "все поля, которые отмечены required как обязательные вместе с их описанием. Json: "
-            + schema
+            "все поля, которые отмечены required как обязательные вместе с их описанием."
         )
-        return self._generate_with_retry(
-            prompt,
-            system_prompt="Ты специалист по json схемам.",
-            model=self.model_name,
+        return await self._generate_with_retry(
+            PromptBuilder(REQUIRED_FIELDS_STAGE, "Ты специалист по json схемам.")
+            .static(prompt)
+            .dynamic("Json: " + schema)
+            .build(),
+            deadline=deadline,
+            stage=REQUIRED_FIELDS_STAGE,
         )
 
     def another_get_required_fields(self, schema: Dict[str, Any]) -> Dict[str, str]:
@@ -376,79 +1146,4 @@ flowEditorConfig (опционально) — вспомогательная и
             Dict[str, str]: A mapping where keys are dot-separated paths to required fields,
                             and values are their descriptions.
         """
-        logging.info("Starting extraction of required fields")
-        required_fields: Dict[str, str] = {}
-
-        def traverse(node: Any, path: List[str]):
-            logging.debug(
-                "Traversing path %s with node type %s", path, type(node).__name__
-            )
-            # Only process dictionaries
-            if not isinstance(node, dict):
-                logging.debug("Skipping non-dict node at %s: %r", path, node)
-                return
-
-            # Validate required and description
-            if "required" in node and "description" in node:
-                if node.get("required") is True:
-                    field_path = ".".join(path)
-                    required_fields[field_path] = node["description"]
-                    logging.debug(
-                        "Found required field: %s -> %s",
-                        field_path,
-                        node["description"],
-                    )
-                else:
-                    logging.debug("Field at %s marked required=False", path)
-            else:
-                if "required" in node:
-                    logging.warning("Node at %s missing description", path)
-                if "description" in node:
-                    logging.warning("Node at %s missing required flag", path)
-
-            # Recurse into nested parameters and subcomponents
-            for child_key in ("parameters", "subcomponents"):
-                if child_key in node:
-                    child_group = node[child_key]
-                    if isinstance(child_group, dict):
-                        logging.debug("Descending into '%s' at %s", child_key, path)
-                        for name, child_node in child_group.items():
-                            traverse(child_node, path + [name])
-                    else:
-                        logging.warning(
-                            "Expected dict for '%s' at %s but got %s",
-                            child_key,
-                            path,
-                            type(child_group).__name__,
-                        )
-
-        # Validate top-level schema
-        if not isinstance(schema, dict):
-            logging.error("Schema root is not a dict: %r", schema)
-            raise ValueError("Schema must be a dictionary of definitions.")
-
-        # Iterate top-level definitions
-        for entry_name, entry_def in schema.items():
-            logging.debug(
-                "Processing top-level entry: %s (type: %s)",
-                entry_name,
-                type(entry_def).__name__,
-            )
-            if not isinstance(entry_def, dict):
-                logging.warning("Skipping entry '%s': not a dict", entry_name)
-                continue
-            params = entry_def.get("parameters")
-            if not isinstance(params, dict):
-                logging.warning(
-                    "Entry '%s' has no 'parameters' dict or it is not a dict (type: %s)",
-                    entry_name,
-                    type(params).__name__,
-                )
-                continue
-            for name, param_node in params.items():
-                traverse(param_node, [entry_name, name])
-
-        logging.info(
-            "Extraction complete: found %d required fields", len(required_fields)
-        )
-        return required_fields
+        return extract_required_fields(schema)
@@ -0,0 +1,93 @@
+"""Отдельный пул потоков для синхронных вызовов LLM и autogen.
+
+Синхронные initiate_chat и generate выполняются в собственном пуле
+ограниченного размера, а не в пуле по умолчанию asyncio. Медленные вызовы LLM
+не занимают потоки, нужные чтению сессий и снимку, а цикл событий остаётся
+свободным для /, /clear и /metrics. Глубина очереди пула и ожидание потока
+видны в метриках.
+"""
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from .metrics import BLOCKING_ACTIVE, BLOCKING_QUEUE_WAIT, BLOCKING_QUEUED
+
+
+class BlockingExecutor:
+    """Пул потоков с учётом очереди и занятых потоков.
+
+    Args:
+        max_workers (int): Число потоков, то есть одновременных вызовов.
+        name (str): Префикс имён потоков.
+    """
+
+    def __init__(self, max_workers: int, name: str = "llm"):
+        if max_workers < 1:
+            raise ValueError("Размер пула потоков должен быть не меньше 1")
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._active = 0
+
+    @property
+    def queued(self) -> int:
+        """Вызовы, ждущие свободного потока."""
+        return self._queued
+
+    @property
+    def active(self) -> int:
+        """Вызовы, которые выполняются сейчас."""
+        return self._active
+
+    async def run(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """Выполняет func в пуле, как asyncio.to_thread, с копией контекста.
+
+        Если ожидание отменили раньше, чем вызов получил поток, вызов не
+        выполняется.
+        """
+        context = contextvars.copy_context()
+        call = functools.partial(context.run, func, *args, **kwargs)
+        submitted = time.perf_counter()
+        queued = [True]
+        with self._lock:
+            self._queued += 1
+        BLOCKING_QUEUED.inc()
+
+        def dequeue() -> None:
+            # Вызывается из потока при старте и из цикла при отмене, счётчик
+            # очереди уменьшает тот, кто успел первым
+            with self._lock:
+                if not queued[0]:
+                    return
+                queued[0] = False
+                self._queued -= 1
+            BLOCKING_QUEUED.dec()
+
+        def worker() -> Any:
+            dequeue()
+            with self._lock:
+                self._active += 1
+            BLOCKING_ACTIVE.inc()
+            BLOCKING_QUEUE_WAIT.observe(time.perf_counter() - submitted)
+            try:
+                return call()
+            finally:
+                with self._lock:
+                    self._active -= 1
+                BLOCKING_ACTIVE.dec()
+
+        future = asyncio.get_running_loop().run_in_executor(self._executor, worker)
+        try:
+            return await future
+        finally:
+            if future.cancelled():
+                dequeue()
+
+    def shutdown(self) -> None:
+        """Останавливает пул, не дожидаясь вызовов в очереди."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
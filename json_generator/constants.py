@@ -3,6 +3,79 @@ import os
 
 API_URL = os.environ.get("API_URL", "https://api.gpt.mws.ru")
 MODEL_NAME = os.environ.get("MODEL_NAME", "llama-3.3-70b-instruct")
+# Режим уточняющего агента: "agent" - диалог autogen с вызовом инструмента,
+# "fast" - поиск напрямую в Python и один вызов со structured output.
+CLARIFIER_MODE = os.environ.get("CLARIFIER_MODE", "agent")
+CLARIFIER_MODES = ("agent", "fast")
+# Сколько диалогов агента-уточнителя autogen может идти одновременно: каждый
+# берёт из пула свою пару агентов (режим "agent").
+CLARIFIER_POOL_SIZE = int(os.environ.get("CLARIFIER_POOL_SIZE", "4"))
+# Число потоков для синхронных вызовов LLM и autogen: больше одновременных
+# вызовов ждут в очереди пула.
+BLOCKING_POOL_SIZE = int(os.environ.get("BLOCKING_POOL_SIZE", "16"))
+# Допуск к конвейеру: сколько ходов диалога выполняется одновременно (0 - без
+# ограничения) и сколько может ждать в очереди. При заполненной очереди /chat
+# сразу отвечает 503 с Retry-After.
+MAX_CONCURRENT_CHATS = int(os.environ.get("MAX_CONCURRENT_CHATS", "32"))
+CHAT_QUEUE_SIZE = int(os.environ.get("CHAT_QUEUE_SIZE", "64"))
+# Темп вызовов апстрима LLM в секунду (0 - без ограничения) и сколько вызовов
+# можно сделать подряд. Вызов ждёт бюджета в пределах дедлайна, иначе /chat
+# отвечает 429 с Retry-After.
+UPSTREAM_RATE_LIMIT = float(os.environ.get("UPSTREAM_RATE_LIMIT", "0"))
+UPSTREAM_BURST = float(os.environ.get("UPSTREAM_BURST", "10"))
+# Повторы вызовов LLM и автоматический выключатель апстрима
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "3"))
+LLM_RETRY_BASE_DELAY = float(os.environ.get("LLM_RETRY_BASE_DELAY", "1"))
+LLM_RETRY_MAX_DELAY = float(os.environ.get("LLM_RETRY_MAX_DELAY", "30"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get("CIRCUIT_RESET_TIMEOUT", "30"))
+# Бюджет времени на обработку одного запроса /chat в секундах. Клиент может
+# сократить его заголовком REQUEST_TIMEOUT_HEADER.
+REQUEST_TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT", "300"))
+REQUEST_TIMEOUT_HEADER = "X-Request-Timeout"
+# Сколько последних сообщений сессии попадает в промпт целиком и сколько
+# (приблизительно) токенов они могут занимать, прежде чем старые сообщения
+# будут свёрнуты в краткое содержание.
+HISTORY_MAX_TURNS = int(os.environ.get("HISTORY_MAX_TURNS", "6"))
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "2000"))
+# Ограничения хранилища сессий: число сессий, суммарный размер в байтах и
+# время простоя в секундах, после которого сессия удаляется. 0 отключает
+# ограничение. Простаивающие сессии удаляются раз в SESSION_EVICTION_INTERVAL.
+SESSION_MAX_COUNT = int(os.environ.get("SESSION_MAX_COUNT", "10000"))
+SESSION_MAX_BYTES = int(os.environ.get("SESSION_MAX_BYTES", str(256 * 1024 * 1024)))
+SESSION_IDLE_TTL = float(os.environ.get("SESSION_IDLE_TTL", "3600"))
+SESSION_EVICTION_INTERVAL = float(os.environ.get("SESSION_EVICTION_INTERVAL", "60"))
+# Внешнее хранилище сессий для нескольких воркеров: memory (только память
+# процесса), sqlite (SESSION_BACKEND_URL - путь к файлу) или redis
+# (SESSION_BACKEND_URL - redis://host:port/db). Изменённые сессии
+# записываются пачками раз в SESSION_FLUSH_INTERVAL секунд.
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "memory")
+SESSION_BACKEND_URL = os.environ.get("SESSION_BACKEND_URL", "")
+SESSION_FLUSH_INTERVAL = float(os.environ.get("SESSION_FLUSH_INTERVAL", "0.05"))
+# Число воркеров uvicorn при запуске python -m json_generator.
+WORKERS = int(os.environ.get("WORKERS", "1"))
+# Файл снимка сессий: при остановке сессии из памяти записываются в него, при
+# запуске восстанавливаются по мере обращения. Пустое значение отключает
+# снимок; при внешнем хранилище (SESSION_BACKEND) он не нужен, при WORKERS > 1
+# не используется: воркеры делили бы один файл.
+SESSION_SNAPSHOT_PATH = os.environ.get("SESSION_SNAPSHOT_PATH", "")
+# Запросы одной сессии выполняются по очереди. Сколько разных запросов сессии
+# может ждать, пока выполняется текущий (0 - без ограничения); остальные
+# получают 429. Одинаковые запросы в очереди объединяются.
+SESSION_MAX_PENDING = int(os.environ.get("SESSION_MAX_PENDING", "2"))
+# Бюджеты токенов LLM (по usage ответов API). Если предыдущий ход сессии
+# потратил на промпты больше SESSION_COMPACT_TOKENS, история сворачивается
+# принудительно. Сессия, израсходовавшая SESSION_TOKEN_BUDGET, получает отказ
+# (очистка сессии расход не обнуляет). 0 отключает ограничение.
+SESSION_COMPACT_TOKENS = int(os.environ.get("SESSION_COMPACT_TOKENS", "0"))
+SESSION_TOKEN_BUDGET = int(os.environ.get("SESSION_TOKEN_BUDGET", "0"))
+# Сколько раз исправлять ошибки сгенерированной схемы точечным вызовом LLM
+# вместо полной повторной генерации. 0 отключает исправление.
+SCHEMA_REPAIR_ATTEMPTS = int(os.environ.get("SCHEMA_REPAIR_ATTEMPTS", "1"))
+# Схема собирается по шаблону из дерева правил, если после заполнения из
+# collected_params LLM осталось дописать не больше стольких полей.
+# Иначе схема генерируется целиком. -1 отключает сборку по шаблону.
+TEMPLATE_MAX_LLM_FIELDS = int(os.environ.get("TEMPLATE_MAX_LLM_FIELDS", "3"))
 SYSTEM_JSON_CREATOR = (
     "Используя документацию и json-schema,"
     "тебе нужно создать Json схему. Ответ должен"
@@ -102,7 +175,11 @@ JSON_TASK = (
     }
 }
 """
-    + " Информация: "
+    + " Информация от пользователя приведена в его сообщении."
+)
+JSON_ONLY_TASK = (
+    "В ответе должен быть только Json, без ``` и других подобных символов,"
+    " по приведённой в сообщении схеме."
 )
 SYSTEM_CLARIFIER = (
     "Тебе нужно составить запрос для агента для создания схемы, но "
@@ -121,7 +198,7 @@ SYSTEM_CLARIFIER_WITHOUT_TERMINATE = (
 )
 CLARIFIER_DESCRIPTION = "Бот уточняет недостающие поля для создания Json-схемы."
 CLARIFIER_TASK = (
-    "Выше сообщения пользователя. По сообщению пользователя и документации"
+    "Ниже сообщения пользователя. По сообщению пользователя и документации"
     " тебе нужно определить, для каких полей не хватает информации. Документация"
     " состоит из json-схемы. "
     "Составь список полей, по которым нужна дополнительная информация, и сообщение "
@@ -131,7 +208,8 @@ CLARIFIER_TASK = (
     "то можешь использовать вызов функции retrieve_documents для поиска. "
 )
 CLARIFY_JSON_TASK = (
-    "До этого общий список полей, которые должны быть. По приведённому рассуждению составь ответ "
+    "В сообщении приведён общий список полей, которые должны быть. По приведённому"
+    " рассуждению составь ответ "
     " . Поля, по которым пользователь написал информацию, необходимую для заполнения,"
     " занеси в mentioned_params в виде словаря с ключом и значением. В mentiond_params вноси"
     " ТОЛЬКО ключи из обязательных полей, по которым пользователь сообщил информацию! "
@@ -144,6 +222,35 @@ CLARIFY_JSON_TASK = (
     "предыдущих сообщениях поля были, то в can_generate true. Если"
     "пользователь привёл большой список параметров, то делай true. "
 )
+SYSTEM_HISTORY_SUMMARIZER = (
+    "Ты сжимаешь историю диалога о создании json-схемы. Сохрани все значения "
+    "параметров, названия систем, топиков, адресов и требования пользователя. "
+    "Не добавляй ничего от себя."
+)
+HISTORY_SUMMARY_TASK = (
+    "Обнови краткое содержание диалога с учётом новых сообщений. Ответ - "
+    "только краткое содержание без комментариев."
+)
+SYSTEM_SCHEMA_EDITOR = (
+    "Ты вносишь правки в готовую json-схему. Меняй только то, что просит "
+    "пользователь, остальные поля оставляй как есть."
+)
+SCHEMA_EDIT_TASK = (
+    "Ниже текущая схема и сообщения пользователя. Верни только json-объект "
+    'с правкой последнего запроса: {"patch": [...]} - операции JSON Patch '
+    "(RFC 6902: add, remove, replace, move, copy, test; path в формате "
+    '/compiled/activities/0/id) или {"merge_patch": {...}} - merge patch '
+    "(RFC 7386, null удаляет поле). Не повторяй схему целиком."
+)
+SYSTEM_SCHEMA_REPAIR = (
+    "Ты исправляешь отдельные поля json-схемы. Не меняй и не повторяй поля, "
+    "о которых не спрашивают."
+)
+SCHEMA_REPAIR_TASK = (
+    "Ниже ошибки в сгенерированной схеме: путь до поля, что не так и описание "
+    "поля. Верни только json-объект, где ключ - путь из списка, а значение - "
+    "исправленное значение этого поля. Значения бери из сообщений пользователя."
+)
 CONTEXT_TOKENS = 131072
 COMPLETION_TOKENS = 131072
 JSON_OUTPUT = True
@@ -0,0 +1,82 @@
+"""Дедлайн запроса, общий для всех этапов обработки сообщения."""
+import time
+from typing import Callable, Optional
+
+
+class DeadlineExceededError(Exception):
+    """Время на обработку запроса истекло."""
+
+    def __init__(self, stage: str):
+        super().__init__(f"Истекло время на обработку запроса (этап {stage})")
+        self.stage = stage
+
+
+class Deadline:
+    """Абсолютный срок завершения запроса.
+
+    Каждый этап перед началом работы проверяет дедлайн и получает от него
+    оставшееся время как таймаут для своих вызовов.
+
+    Attributes:
+        timeout (float): Исходный бюджет времени в секундах.
+        expires_at (float): Момент истечения по часам clock.
+    """
+
+    def __init__(self, timeout: float, clock: Callable[[], float] = time.monotonic):
+        self.timeout = timeout
+        self._clock = clock
+        self.expires_at = clock() + timeout
+
+    @classmethod
+    def from_header(cls, value: Optional[str], default: float) -> "Deadline":
+        """Создаёт дедлайн из заголовка запроса.
+
+        Заголовок может только сократить бюджет относительно настройки сервера,
+        некорректное значение игнорируется.
+
+        Args:
+            value (Optional[str]): Значение заголовка в секундах.
+            default (float): Бюджет из конфигурации.
+
+        Returns:
+            Deadline: Дедлайн запроса.
+        """
+        timeout = default
+        if value:
+            try:
+                requested = float(value)
+            except ValueError:
+                requested = default
+            if requested > 0:
+                timeout = min(requested, default)
+        return cls(timeout)
+
+    def remaining(self) -> float:
+        """Оставшееся время в секундах, не меньше нуля."""
+        return max(self.expires_at - self._clock(), 0.0)
+
+    @property
+    def expired(self) -> bool:
+        """Истёк ли дедлайн."""
+        return self.remaining() <= 0
+
+    def check(self, stage: str) -> None:
+        """Бросает DeadlineExceededError, если дедлайн истёк.
+
+        Args:
+            stage (str): Название этапа для сообщения об ошибке.
+        """
+        if self.expired:
+            raise DeadlineExceededError(stage)
+
+    def timeout_for(self, stage: str) -> float:
+        """Проверяет дедлайн и возвращает оставшееся время как таймаут этапа.
+
+        Args:
+            stage (str): Название этапа.
+
+        Returns:
+            float: Таймаут в секундах.
+        """
+        self.check(stage)
+        return self.remaining()
@@ -0,0 +1,233 @@
+"""Извлечение json-объекта из ответа модели.
+
+JsonScanner находит внешний сбалансированный объект в тексте, в том числе
+по частям потокового ответа, и сообщает, когда объект закрылся. repair_json
+исправляет типичные синтаксические ошибки моделей без повторного вызова LLM.
+"""
+import json
+import logging
+import re
+from typing import List, Optional
+
+FENCE_RE = re.compile(r"```[a-zA-Z0-9_-]*[ \t]*\n?(.*?)```", re.DOTALL)
+PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+CLOSING = {"{": "}", "[": "]"}
+
+
+def strip_code_fences(text: str) -> str:
+    """Возвращает содержимое первого блока ```...``` с json, если он есть.
+
+    Незакрытый блок (обрезанный ответ) тоже снимается.
+    """
+    for match in FENCE_RE.finditer(text):
+        if "{" in match.group(1):
+            return match.group(1)
+    start = text.find("```")
+    if start != -1 and text.count("```") == 1:
+        body = text[start + 3 :]
+        newline = body.find("\n")
+        return body[newline + 1 :] if newline != -1 else body
+    return text
+
+
+class JsonScanner:
+    """Инкрементальный поиск первого внешнего json-объекта.
+
+    Текст до первой "{" пропускается, скобки внутри строк не учитываются.
+    Строки в одинарных кавычках тоже распознаются, чтобы их содержимое не
+    ломало подсчёт скобок.
+
+    Пример:
+        scanner = JsonScanner()
+        for chunk in stream:
+            if scanner.feed(chunk) is not None:
+                break
+        obj = scanner.result
+    """
+
+    def __init__(self):
+        self._parts: List[str] = []
+        self._stack: List[str] = []
+        self._quote: Optional[str] = None
+        self._escape = False
+        self.result: Optional[str] = None
+
+    @property
+    def done(self) -> bool:
+        """Объект закрылся."""
+        return self.result is not None
+
+    def feed(self, chunk: str) -> Optional[str]:
+        """Обрабатывает очередной фрагмент текста.
+
+        Returns:
+            Optional[str]: Текст объекта, если он закрылся, иначе None.
+        """
+        if self.done:
+            return self.result
+        start = 0 if self._stack else None
+        for index, char in enumerate(chunk):
+            if not self._stack:
+                if char == "{":
+                    self._stack.append(char)
+                    start = index
+                continue
+            if self._quote is not None:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == self._quote:
+                    self._quote = None
+                continue
+            if char in "\"'":
+                self._quote = char
+            elif char in "{[":
+                self._stack.append(char)
+            elif char in "}]":
+                self._stack.pop()
+                if not self._stack:
+                    self._parts.append(chunk[start : index + 1])
+                    self.result = "".join(self._parts)
+                    return self.result
+        if start is not None:
+            self._parts.append(chunk[start:])
+        return None
+
+    def partial(self) -> str:
+        """Текст объекта, прочитанный на данный момент."""
+        return self.result if self.done else "".join(self._parts)
+
+
+def _last_significant(out: List[str]) -> str:
+    for part in reversed(out):
+        stripped = part.rstrip()
+        if stripped:
+            return stripped[-1]
+    return ""
+
+
+def _drop_trailing_comma(out: List[str]) -> None:
+    while out and not out[-1].strip():
+        out.pop()
+    if out and out[-1].rstrip().endswith(","):
+        out[-1] = out[-1].rstrip()[:-1]
+
+
+def repair_json(text: str) -> str:
+    """Исправляет типичные синтаксические ошибки json из ответа модели.
+
+    Исправляются: комментарии, висячие запятые, пропущенные запятые между
+    элементами, строки в одинарных кавычках, переводы строк внутри строк,
+    литералы Python (True/False/None), а также обрезанный конец объекта -
+    незакрытые строки и скобки.
+
+    Args:
+        text (str): Текст объекта, начиная с "{".
+
+    Returns:
+        str: Исправленный текст. Если исправить не удалось, json.loads на нём
+            всё равно упадёт.
+    """
+    out: List[str] = []
+    stack: List[str] = []
+    i, length = 0, len(text)
+    while i < length:
+        char = text[i]
+        if char in "\"'":
+            if _last_significant(out) in '"}]0123456789el' and stack:
+                out.append(",")
+            quote, i = char, i + 1
+            buf = ['"']
+            while i < length and text[i] != quote:
+                if text[i] == "\\" and i + 1 < length:
+                    if text[i + 1] == "'":
+                        buf.append("'")
+                    else:
+                        buf.append(text[i : i + 2])
+                    i += 2
+                    continue
+                if text[i] == '"':
+                    buf.append('\\"')
+                elif text[i] == "\n":
+                    buf.append("\\n")
+                elif text[i] == "\t":
+                    buf.append("\\t")
+                else:
+                    buf.append(text[i])
+                i += 1
+            buf.append('"')
+            out.append("".join(buf))
+            i += 1
+            continue
+        if text.startswith("//", i):
+            newline = text.find("\n", i)
+            i = length if newline == -1 else newline
+            continue
+        if text.startswith("/*", i):
+            end = text.find("*/", i + 2)
+            i = length if end == -1 else end + 2
+            continue
+        if char in "{[":
+            if _last_significant(out) in '"}]0123456789el' and stack:
+                out.append(",")
+            stack.append(char)
+            out.append(char)
+        elif char in "}]":
+            _drop_trailing_comma(out)
+            if stack:
+                out.append(CLOSING[stack.pop()])
+        elif char.isalpha() or char == "_":
+            end = i
+            while end < length and (text[end].isalnum() or text[end] == "_"):
+                end += 1
+            word = text[i:end]
+            if text[end:].lstrip().startswith(":"):
+                # Ключ без кавычек
+                word = f'"{word}"'
+            out.append(PYTHON_LITERALS.get(word, word))
+            i = end
+            continue
+        else:
+            out.append(char)
+        i += 1
+    if _last_significant(out) == ":":
+        out.append(" null")
+    _drop_trailing_comma(out)
+    while stack:
+        _drop_trailing_comma(out)
+        out.append(CLOSING[stack.pop()])
+    return "".join(out)
+
+
+def extract_json(text: str) -> str:
+    """Возвращает json-объект из ответа модели.
+
+    Снимает блоки ```json, берёт внешний сбалансированный объект и, если он
+    не разбирается, пытается исправить его локально.
+
+    Args:
+        text (str): Ответ модели.
+
+    Returns:
+        str: Текст объекта (исправленный, если понадобилось). Если объекта в
+            ответе нет, возвращается исходный текст.
+    """
+    scanner = JsonScanner()
+    scanner.feed(strip_code_fences(text))
+    candidate = scanner.partial()
+    if not candidate:
+        return text
+    try:
+        json.loads(candidate)
+        return candidate
+    except json.JSONDecodeError:
+        pass
+    repaired = repair_json(candidate)
+    try:
+        json.loads(repaired)
+    except json.JSONDecodeError as e:
+        logging.warning(f"Не удалось исправить json из ответа модели: {e}")
+        return candidate
+    logging.info("Json из ответа модели исправлен локально")
+    return repaired
@@ -0,0 +1,425 @@
+"""Метрики сервиса в текстовом формате Prometheus.
+
+Небольшая реализация счётчиков, гейджей и гистограмм с метками без внешних
+зависимостей. Все метрики регистрируются в REGISTRY и отдаются эндпоинтом
+/metrics.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from .usage import current_usage
+
+try:
+    import resource
+except ImportError:
+    # Модуль есть только в Unix; без него и без /proc RSS не отдаётся
+    resource = None
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Этап конвейера, к которому относится текущий вызов LLM. Переменная
+# контекста копируется в поток пула вместе с остальным контекстом.
+current_stage: ContextVar[str] = ContextVar("current_stage", default="unknown")
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(str(v))}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    """Общая часть метрик: имя, описание и метки."""
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.label_names):
+            raise ValueError(
+                f"Метрика {self.name} ожидает метки {', '.join(self.label_names)}"
+            )
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def header(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Монотонно растущий счётчик."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.label_names, key)} {_format_value(v)}"
+            for key, v in items
+        ]
+
+
+class Gauge(_Metric):
+    """Значение, которое может расти и уменьшаться.
+
+    Если передан callback, значение без меток вычисляется при каждом сборе.
+    """
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        callback: Optional[Callable[[], float]] = None,
+    ):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+        self.callback = callback
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set_function(self, callback: Callable[[], float]) -> None:
+        """Задаёт функцию, вычисляющую значение при сборе метрик."""
+        self.callback = callback
+
+    def value(self, **labels: str) -> float:
+        if self.callback is not None and not self.label_names:
+            return self.callback()
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        if self.callback is not None and not self.label_names:
+            return self.header() + [f"{self.name} {_format_value(self.callback())}"]
+        with self._lock:
+            items = list(self._values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.label_names, key)} {_format_value(v)}"
+            for key, v in items
+        ]
+
+
+class Histogram(_Metric):
+    """Гистограмма с накопительными корзинами."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._counts: Dict[LabelValues, List[int]] = {}
+        self._sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * len(self.buckets))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._sums[key] = self._sums.get(key, 0.0) + value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Измеряет длительность блока, в том числе завершившегося ошибкой."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels: str) -> int:
+        with self._lock:
+            counts = self._counts.get(self._key(labels))
+            return counts[-1] if counts else 0
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        with self._lock:
+            items = [(k, list(c), self._sums[k]) for k, c in self._counts.items()]
+        for key, counts, total in items:
+            for bound, count in zip(self.buckets, counts):
+                labels = _format_labels(
+                    self.label_names + ("le",), key + (_format_value(bound),)
+                )
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {counts[-1]}")
+        return lines
+
+
+class Registry:
+    """Набор метрик, отдаваемых одним эндпоинтом."""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Текст всех метрик в формате Prometheus."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: List[str] = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUEST_DURATION = REGISTRY.register(
+    Histogram(
+        "json_generator_request_duration_seconds",
+        "Длительность обработки HTTP-запроса.",
+        ("endpoint", "status"),
+    )
+)
+REQUESTS_IN_FLIGHT = REGISTRY.register(
+    Gauge(
+        "json_generator_requests_in_flight",
+        "Число запросов, обрабатываемых сейчас.",
+        ("endpoint",),
+    )
+)
+STAGE_DURATION = REGISTRY.register(
+    Histogram(
+        "json_generator_stage_duration_seconds",
+        "Длительность этапов конвейера handle_message.",
+        ("stage",),
+    )
+)
+LLM_CALLS = REGISTRY.register(
+    Counter(
+        "json_generator_llm_calls_total",
+        "Число вызовов LLM по этапам и моделям.",
+        ("stage", "model", "outcome"),
+    )
+)
+LLM_CALL_DURATION = REGISTRY.register(
+    Histogram(
+        "json_generator_llm_call_duration_seconds",
+        "Длительность одного вызова LLM.",
+        ("stage", "model"),
+    )
+)
+LLM_TOKENS = REGISTRY.register(
+    Counter(
+        "json_generator_llm_tokens_total",
+        "Токены запросов и ответов LLM по этапам и моделям.",
+        ("stage", "model", "kind"),
+    )
+)
+RETRIEVAL_DURATION = REGISTRY.register(
+    Histogram(
+        "json_generator_retrieval_duration_seconds",
+        "Длительность гибридного поиска документации.",
+        buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    )
+)
+VALIDATOR_CACHE = REGISTRY.register(
+    Counter(
+        "json_generator_validator_cache_total",
+        "Обращения к кэшу скомпилированных валидаторов схем.",
+        ("result",),
+    )
+)
+SCHEMA_EDITS = REGISTRY.register(
+    Counter(
+        "json_generator_schema_edits_total",
+        "Правки готовой схемы: applied - правка применена, fallback - схема"
+        " сгенерирована заново.",
+        ("outcome",),
+    )
+)
+ACTIVE_SESSIONS = REGISTRY.register(
+    Gauge("json_generator_active_sessions", "Число сессий в памяти процесса.")
+)
+SESSION_STORE_BYTES = REGISTRY.register(
+    Gauge(
+        "json_generator_session_store_bytes",
+        "Оценка суммарного размера сессий в памяти.",
+    )
+)
+SESSION_EVICTIONS = REGISTRY.register(
+    Counter(
+        "json_generator_session_evictions_total",
+        "Вытесненные сессии: count и bytes - по лимитам, idle - по простою.",
+        ("reason",),
+    )
+)
+
+SESSION_REQUESTS = REGISTRY.register(
+    Counter(
+        "json_generator_session_requests_total",
+        "Запросы /chat по сессиям: executed - выполнены, coalesced - получили"
+        " результат такого же запроса, rejected - очередь сессии заполнена.",
+        ("outcome",),
+    )
+)
+
+AGENT_POOL_IN_USE = REGISTRY.register(
+    Gauge(
+        "json_generator_agent_pool_in_use",
+        "Пары агентов autogen, занятые диалогом уточнения.",
+    )
+)
+AGENT_POOL_WAIT = REGISTRY.register(
+    Histogram(
+        "json_generator_agent_pool_wait_seconds",
+        "Ожидание свободной пары агентов autogen.",
+        buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30),
+    )
+)
+
+BLOCKING_QUEUED = REGISTRY.register(
+    Gauge(
+        "json_generator_blocking_queue_depth",
+        "Синхронные вызовы LLM и autogen, ждущие свободного потока.",
+    )
+)
+BLOCKING_ACTIVE = REGISTRY.register(
+    Gauge(
+        "json_generator_blocking_active",
+        "Синхронные вызовы LLM и autogen, которые выполняются сейчас.",
+    )
+)
+BLOCKING_QUEUE_WAIT = REGISTRY.register(
+    Histogram(
+        "json_generator_blocking_queue_wait_seconds",
+        "Ожидание свободного потока синхронным вызовом.",
+        buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30),
+    )
+)
+
+ADMISSION = REGISTRY.register(
+    Counter(
+        "json_generator_admission_total",
+        "Допуск ходов к конвейеру: admitted - сразу, queued - после очереди,"
+        " rejected - очередь заполнена, timeout - не дождались места.",
+        ("outcome",),
+    )
+)
+ADMISSION_ACTIVE = REGISTRY.register(
+    Gauge("json_generator_admission_active", "Ходы, которые выполняются сейчас.")
+)
+ADMISSION_QUEUED = REGISTRY.register(
+    Gauge("json_generator_admission_queued", "Ходы, ждущие места в очереди.")
+)
+UPSTREAM_THROTTLE_WAIT = REGISTRY.register(
+    Histogram(
+        "json_generator_upstream_throttle_wait_seconds",
+        "Ожидание бюджета вызовов апстрима (UPSTREAM_RATE_LIMIT).",
+        buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+    )
+)
+
+
+def resident_memory_bytes() -> float:
+    """Текущий RSS процесса; где /proc недоступен - пиковый RSS."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss в Linux в килобайтах
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+PROCESS_RESIDENT_MEMORY: Optional[Gauge] = None
+if resource is not None or os.path.exists("/proc/self/statm"):
+    PROCESS_RESIDENT_MEMORY = REGISTRY.register(
+        Gauge(
+            "process_resident_memory_bytes",
+            "Резидентная память процесса в байтах.",
+            callback=resident_memory_bytes,
+        )
+    )
+
+
+def record_llm_usage(
+    model: str, prompt_tokens: int, completion_tokens: int, stage: str = ""
+) -> None:
+    """Учитывает токены вызова LLM для текущего этапа и текущей сессии.
+
+    Args:
+        model (str): Модель вызова.
+        prompt_tokens (int): Токены запроса.
+        completion_tokens (int): Токены ответа.
+        stage (str): Этап. По умолчанию берётся из current_stage.
+    """
+    stage = stage or current_stage.get()
+    LLM_TOKENS.inc(prompt_tokens, stage=stage, model=model, kind="prompt")
+    LLM_TOKENS.inc(completion_tokens, stage=stage, model=model, kind="completion")
+    usage = current_usage.get()
+    if usage is not None:
+        usage.add(stage, prompt_tokens, completion_tokens)
@@ -0,0 +1,148 @@
+"""Применение правок к json-схеме: JSON Patch (RFC 6902) и merge patch (RFC 7386).
+
+Правки применяются к копии документа: если любая операция не выполнилась,
+исходная схема остаётся без изменений.
+"""
+import copy
+from typing import Any, Dict, List, Tuple
+
+
+class PatchError(ValueError):
+    """Правку нельзя применить к документу."""
+
+
+def parse_pointer(pointer: str) -> List[str]:
+    """Разбирает JSON Pointer (RFC 6901) на части.
+
+    Raises:
+        PatchError: Если указатель не начинается с "/".
+    """
+    if pointer == "":
+        return []
+    if not pointer.startswith("/"):
+        raise PatchError(f"Некорректный путь {pointer!r}")
+    return [
+        part.replace("~1", "/").replace("~0", "~") for part in pointer[1:].split("/")
+    ]
+
+
+def _index(container: List[Any], part: str, allow_end: bool) -> int:
+    if allow_end and part == "-":
+        return len(container)
+    if not part.isdigit() or (len(part) > 1 and part.startswith("0")):
+        raise PatchError(f"Некорректный индекс массива {part!r}")
+    index = int(part)
+    if index > len(container) or (index == len(container) and not allow_end):
+        raise PatchError(f"Индекс {index} за пределами массива")
+    return index
+
+
+def _resolve(document: Any, parts: List[str]) -> Any:
+    node = document
+    for part in parts:
+        if isinstance(node, dict):
+            if part not in node:
+                raise PatchError(f"Нет поля {part!r}")
+            node = node[part]
+        elif isinstance(node, list):
+            node = node[_index(node, part, allow_end=False)]
+        else:
+            raise PatchError(f"Путь проходит через значение {node!r}")
+    return node
+
+
+def _parent(document: Any, pointer: str) -> Tuple[Any, str]:
+    parts = parse_pointer(pointer)
+    if not parts:
+        raise PatchError("Операция над корнем документа не поддерживается")
+    return _resolve(document, parts[:-1]), parts[-1]
+
+
+def _get(document: Any, pointer: str) -> Any:
+    return _resolve(document, parse_pointer(pointer))
+
+
+def _add(document: Any, pointer: str, value: Any) -> None:
+    parent, key = _parent(document, pointer)
+    if isinstance(parent, dict):
+        parent[key] = value
+    elif isinstance(parent, list):
+        parent.insert(_index(parent, key, allow_end=True), value)
+    else:
+        raise PatchError(f"Нельзя добавить {pointer!r}")
+
+
+def _remove(document: Any, pointer: str) -> Any:
+    parent, key = _parent(document, pointer)
+    if isinstance(parent, dict):
+        if key not in parent:
+            raise PatchError(f"Нет поля {pointer!r}")
+        return parent.pop(key)
+    if isinstance(parent, list):
+        return parent.pop(_index(parent, key, allow_end=False))
+    raise PatchError(f"Нельзя удалить {pointer!r}")
+
+
+def apply_json_patch(document: Any, operations: List[Dict[str, Any]]) -> Any:
+    """Применяет JSON Patch (RFC 6902).
+
+    Args:
+        document (Any): Исходный документ, не изменяется.
+        operations (List[Dict[str, Any]]): Операции add, remove, replace,
+            move, copy и test.
+
+    Returns:
+        Any: Новый документ.
+
+    Raises:
+        PatchError: Если операция некорректна или не применяется.
+    """
+    if not isinstance(operations, list):
+        raise PatchError("JSON Patch должен быть массивом операций")
+    result = copy.deepcopy(document)
+    for operation in operations:
+        if not isinstance(operation, dict) or "path" not in operation:
+            raise PatchError(f"Некорректная операция {operation!r}")
+        op, path = operation.get("op"), operation["path"]
+        if op in ("add", "replace", "test") and "value" not in operation:
+            raise PatchError(f"Операции {op} нужно значение")
+        if op == "add":
+            _add(result, path, copy.deepcopy(operation["value"]))
+        elif op == "remove":
+            _remove(result, path)
+        elif op == "replace":
+            _remove(result, path)
+            _add(result, path, copy.deepcopy(operation["value"]))
+        elif op == "move":
+            if path.startswith(operation.get("from", "") + "/"):
+                raise PatchError("Нельзя переместить значение внутрь себя")
+            _add(result, path, _remove(result, operation.get("from", "")))
+        elif op == "copy":
+            _add(result, path, copy.deepcopy(_get(result, operation.get("from", ""))))
+        elif op == "test":
+            if _get(result, path) != operation["value"]:
+                raise PatchError(f"Проверка {path!r} не прошла")
+        else:
+            raise PatchError(f"Неизвестная операция {op!r}")
+    return result
+
+
+def apply_merge_patch(document: Any, patch: Any) -> Any:
+    """Применяет merge patch (RFC 7386): null удаляет поле, объекты сливаются.
+
+    Args:
+        document (Any): Исходный документ, не изменяется.
+        patch (Any): Merge patch.
+
+    Returns:
+        Any: Новый документ.
+    """
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    result = copy.deepcopy(document) if isinstance(document, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = apply_merge_patch(result.get(key), value)
+    return result
@@ -0,0 +1,73 @@
+"""Выполнение этапов конвейера как небольшого графа зависимостей.
+
+Этапы, которые не зависят друг от друга, запускаются одновременно через
+asyncio.gather, каждый этап ждёт только результаты своих зависимостей.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Tuple
+
+StageFunc = Callable[..., Awaitable[Any]]
+
+
+class StageGraph:
+    """Граф этапов с зависимостями.
+
+    Функция этапа получает результаты зависимостей именованными аргументами
+    с именами этих этапов.
+
+    Пример:
+        graph = StageGraph()
+        graph.add("retrieval", retrieve)
+        graph.add("history", compact)
+        graph.add("answer", answer, deps=("retrieval", "history"))
+        results = await graph.run()
+    """
+
+    def __init__(self):
+        self._stages: Dict[str, Tuple[StageFunc, Tuple[str, ...]]] = {}
+
+    def add(self, name: str, func: StageFunc, deps: Iterable[str] = ()) -> None:
+        """Добавляет этап.
+
+        Args:
+            name (str): Имя этапа.
+            func (StageFunc): Корутинная функция этапа.
+            deps (Iterable[str]): Имена этапов, результаты которых нужны func.
+
+        Raises:
+            ValueError: Если этап уже добавлен или зависимость неизвестна.
+        """
+        if name in self._stages:
+            raise ValueError(f"Этап {name} уже добавлен")
+        deps = tuple(deps)
+        for dep in deps:
+            if dep not in self._stages:
+                raise ValueError(f"Этап {name} зависит от неизвестного этапа {dep}")
+        self._stages[name] = (func, deps)
+
+    async def run(self) -> Dict[str, Any]:
+        """Выполняет все этапы с максимальным параллелизмом.
+
+        Зависимости добавляются раньше зависящих этапов, поэтому циклов нет.
+        Если этап падает, остальные незавершённые этапы отменяются.
+
+        Returns:
+            Dict[str, Any]: Результат каждого этапа по имени.
+        """
+        tasks: Dict[str, asyncio.Future] = {}
+
+        async def run_stage(func: StageFunc, deps: Tuple[str, ...]) -> Any:
+            results = await asyncio.gather(*(tasks[dep] for dep in deps))
+            return await func(**dict(zip(deps, results)))
+
+        for name, (func, deps) in self._stages.items():
+            tasks[name] = asyncio.ensure_future(run_stage(func, deps))
+        pending: List[asyncio.Future] = list(tasks.values())
+        try:
+            await asyncio.gather(*pending)
+        finally:
+            for task in pending:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        return {name: task.result() for name, task in tasks.items()}
@@ -0,0 +1,131 @@
+"""Сборка промптов со стабильным префиксом.
+
+Каждый этап собирает сообщения в одном порядке: сначала системный промпт и
+статические блоки (инструкции, примеры), затем данные конкретной сессии.
+Так одинаковые для всех вызовов токены всегда стоят в начале запроса и
+серверы с кэшированием префикса не кодируют их заново.
+"""
+import logging
+import threading
+from typing import Dict, List
+
+Messages = List[Dict[str, str]]
+
+
+def _common_prefix_length(first: str, second: str) -> int:
+    """Длина общего префикса двух строк."""
+    limit = min(len(first), len(second))
+    index = 0
+    while index < limit and first[index] == second[index]:
+        index += 1
+    return index
+
+
+def _flatten(messages: Messages) -> str:
+    """Склеивает сообщения в строку в том порядке, в котором их видит модель."""
+    return "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+
+
+class PrefixCacheReport:
+    """Локальная статистика общего префикса между вызовами одного этапа.
+
+    Для каждого этапа запоминается предыдущий промпт и считается, какая доля
+    символов нового промпта совпадает с ним с начала. Это оценка того, сколько
+    мог бы сэкономить сервер с кэшированием префикса.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last: Dict[str, str] = {}
+        self._shared: Dict[str, int] = {}
+        self._total: Dict[str, int] = {}
+        self._calls: Dict[str, int] = {}
+
+    def record(self, stage: str, messages: Messages) -> float:
+        """Учитывает промпт этапа.
+
+        Args:
+            stage (str): Название этапа.
+            messages (Messages): Сообщения, отправляемые модели.
+
+        Returns:
+            float: Доля общего префикса с предыдущим промптом этапа.
+        """
+        text = _flatten(messages)
+        with self._lock:
+            shared = _common_prefix_length(self._last.get(stage, ""), text)
+            self._last[stage] = text
+            self._shared[stage] = self._shared.get(stage, 0) + shared
+            self._total[stage] = self._total.get(stage, 0) + len(text)
+            self._calls[stage] = self._calls.get(stage, 0) + 1
+        ratio = shared / len(text) if text else 0.0
+        logging.debug("Общий префикс промпта %s: %.1f%%", stage, ratio * 100)
+        return ratio
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        """Возвращает накопленную статистику по этапам.
+
+        Returns:
+            Dict[str, Dict[str, float]]: Для каждого этапа число вызовов и доля
+                общего префикса по всем вызовам.
+        """
+        with self._lock:
+            return {
+                stage: {
+                    "calls": self._calls[stage],
+                    "shared_prefix_ratio": (
+                        self._shared[stage] / self._total[stage]
+                        if self._total[stage]
+                        else 0.0
+                    ),
+                }
+                for stage in self._calls
+            }
+
+
+prefix_report = PrefixCacheReport()
+
+
+class PromptBuilder:
+    """Собирает сообщения этапа: статический префикс, затем данные сессии.
+
+    Пример:
+        messages = (
+            PromptBuilder("generation", SYSTEM_JSON_CREATOR)
+            .static(JSON_TASK)
+            .dynamic(history)
+            .build()
+        )
+    """
+
+    def __init__(self, stage: str, system_prompt: str):
+        self.stage = stage
+        self.system_prompt = system_prompt
+        self._static: List[str] = []
+        self._dynamic: List[str] = []
+
+    def static(self, *parts: str) -> "PromptBuilder":
+        """Добавляет блоки, одинаковые для всех вызовов этапа."""
+        self._static.extend(part for part in parts if part)
+        return self
+
+    def dynamic(self, *parts: str) -> "PromptBuilder":
+        """Добавляет блоки, зависящие от сессии."""
+        self._dynamic.extend(part for part in parts if part)
+        return self
+
+    def build(self) -> Messages:
+        """Возвращает сообщения для модели и учитывает их в prefix_report.
+
+        Статические блоки идут в системное сообщение сразу после системного
+        промпта, данные сессии - в сообщение пользователя.
+        """
+        messages = [
+            {
+                "role": "system",
+                "content": "\n\n".join([self.system_prompt, *self._static]),
+            },
+            {"role": "user", "content": "\n\n".join(self._dynamic)},
+        ]
+        prefix_report.record(self.stage, messages)
+        return messages
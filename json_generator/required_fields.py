@@ -0,0 +1,105 @@
+"""Извлечение обязательных полей из дерева правил workflow.
+
+Используется при построении индекса: для каждого определения заранее
+считается плоский список обязательных полей и текст для промпта, чтобы
+во время запроса не обходить схему и не звать LLM.
+"""
+import json
+import logging
+from typing import Any, Dict, Iterator, List, Tuple
+
+REQUIRED_PROMPT_HEADER = "Список обязательных полей"
+
+
+def _iter_required(node: Any, path: List[str]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Обходит узел дерева правил и возвращает обязательные поля.
+
+    Args:
+        node (Any): Узел дерева правил (описание параметра).
+        path (List[str]): Путь до узла.
+
+    Yields:
+        Tuple[str, Dict[str, Any]]: Путь через точку и сам узел обязательного поля.
+    """
+    if not isinstance(node, dict):
+        return
+    if node.get("required") is True and "description" in node:
+        yield ".".join(path), node
+    for child_key in ("parameters", "subcomponents"):
+        child_group = node.get(child_key)
+        if isinstance(child_group, dict):
+            for name, child_node in child_group.items():
+                yield from _iter_required(child_node, path + [name])
+
+
+def _iter_definitions(
+    definitions: Dict[str, Any],
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Обходит все определения верхнего уровня и их обязательные поля."""
+    if not isinstance(definitions, dict):
+        raise ValueError("Schema must be a dictionary of definitions.")
+    for entry_name, entry_def in definitions.items():
+        if not isinstance(entry_def, dict):
+            logging.warning("Skipping entry '%s': not a dict", entry_name)
+            continue
+        params = entry_def.get("parameters")
+        if not isinstance(params, dict):
+            logging.warning("Entry '%s' has no 'parameters' dict", entry_name)
+            continue
+        for name, param_node in params.items():
+            yield from _iter_required(param_node, [entry_name, name])
+
+
+def extract_required_fields(definitions: Dict[str, Any]) -> Dict[str, str]:
+    """Рекурсивно извлекает все обязательные поля из определений.
+
+    Args:
+        definitions (Dict[str, Any]): Словарь определений с вложенными
+            parameters и subcomponents.
+
+    Returns:
+        Dict[str, str]: Путь до поля через точку -> описание поля.
+    """
+    return {path: node["description"] for path, node in _iter_definitions(definitions)}
+
+
+def render_required_prompt(definitions: Dict[str, Any]) -> str:
+    """Формирует текст со списком обязательных полей для промпта.
+
+    Формат совпадает с тем, что раньше выписывала LLM в get_required_fields:
+    ``путь (обязательно, если <условие>) — описание``.
+
+    Args:
+        definitions (Dict[str, Any]): Словарь определений.
+
+    Returns:
+        str: Готовый текст для вставки в промпт.
+    """
+    lines = [REQUIRED_PROMPT_HEADER + ":"]
+    for path, node in _iter_definitions(definitions):
+        condition = node.get("required_cond") or node.get("condition")
+        marker = f"обязательно, если {condition}" if condition else "обязательно"
+        lines.append(f"{path} ({marker}) — {node['description']}")
+    return "\n".join(lines)
+
+
+def build_catalog(key: str, value: Any) -> Dict[str, str]:
+    """Строит каталог обязательных полей для одного чанка индекса.
+
+    Args:
+        key (str): Имя определения верхнего уровня.
+        value (Any): Тело определения.
+
+    Returns:
+        Dict[str, str]: Колонки ``required_fields`` (JSON) и ``required_prompt``.
+    """
+    definitions = {key: value}
+    try:
+        fields = extract_required_fields(definitions)
+        prompt = render_required_prompt(definitions)
+    except ValueError:
+        fields, prompt = {}, ""
+    return {
+        "required_fields": json.dumps(fields, ensure_ascii=False),
+        "required_prompt": prompt if fields else "",
+    }
@@ -0,0 +1,241 @@
+"""Политика повторов и автоматический выключатель для вызовов LLM.
+
+Повторы выполняются с экспоненциальной задержкой, случайным разбросом
+(full jitter) и учётом заголовка Retry-After. Выключатель после серии
+ошибок апстрима перестаёт пропускать вызовы и отвечает ошибкой сразу,
+пока не истечёт время восстановления.
+"""
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Callable, Optional
+
+import openai
+
+from .deadline import Deadline
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Выключатель разомкнут: апстрим недоступен, вызов не выполнялся."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Апстрим LLM недоступен, повторите через {retry_after:.0f}с")
+        self.retry_after = retry_after
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Проверяет, имеет ли смысл повторять вызов после ошибки.
+
+    Повторяются сетевые ошибки, таймауты, 408, 409, 429 и ответы 5xx.
+    Ошибки запроса (400, 401, 403, 404, 422) повторять бесполезно.
+    """
+    if isinstance(exc, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code in (408, 409, 429) or exc.status_code >= 500
+    return False
+
+
+def retry_after_seconds(exc: BaseException) -> Optional[float]:
+    """Достаёт из ответа апстрима заголовок Retry-After в секундах."""
+    response = getattr(exc, "response", None)
+    if response is None:
+        return None
+    for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        value = response.headers.get(header)
+        if value is None:
+            continue
+        try:
+            return max(float(value) * scale, 0.0)
+        except ValueError:
+            continue
+    return None
+
+
+class CircuitBreaker:
+    """Автоматический выключатель для апстрима LLM.
+
+    Attributes:
+        failure_threshold (int): Число вызовов подряд, завершившихся ошибкой
+            апстрима после всех повторов, после которого выключатель
+            размыкается.
+        reset_timeout (float): Через сколько секунд пропустить пробный вызов.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        """Текущее состояние: closed, open или half_open."""
+        if self._opened_at is None:
+            return CLOSED
+        if self._clock() - self._opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return OPEN
+
+    def before_call(self) -> bool:
+        """Пропускает вызов или бросает CircuitOpenError.
+
+        Returns:
+            bool: True, если это пробный вызов полуоткрытого выключателя.
+
+        Raises:
+            CircuitOpenError: Если выключатель разомкнут или пробный вызов
+                уже выполняется.
+        """
+        state = self.state
+        if state == CLOSED:
+            return False
+        if state == HALF_OPEN and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        remaining = self.reset_timeout - (self._clock() - self._opened_at)
+        raise CircuitOpenError(max(remaining, 1.0))
+
+    def record_success(self) -> None:
+        """Замыкает выключатель после успешного вызова."""
+        if self._opened_at is not None:
+            logging.info("Апстрим LLM восстановился, выключатель замкнут")
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    def release(self) -> None:
+        """Освобождает пробный вызов, ошибка которого не связана с апстримом."""
+        self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        """Учитывает ошибку апстрима и при необходимости размыкает выключатель."""
+        self._failures += 1
+        if self._trial_in_flight or self._failures >= self.failure_threshold:
+            if self._opened_at is None or self._trial_in_flight:
+                logging.error(
+                    "Апстрим LLM недоступен (%d ошибок подряд), выключатель разомкнут",
+                    self._failures,
+                )
+            self._opened_at = self._clock()
+        self._trial_in_flight = False
+
+
+class RetryPolicy:
+    """Асинхронная политика повторов с экспоненциальной задержкой.
+
+    Attributes:
+        max_attempts (int): Максимальное число попыток, включая первую.
+        base_delay (float): Базовая задержка в секундах.
+        max_delay (float): Верхняя граница задержки в секундах.
+        breaker (Optional[CircuitBreaker]): Выключатель, общий для всех вызовов.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 3,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker
+
+    def compute_delay(self, attempt: int, exc: BaseException) -> float:
+        """Считает задержку перед следующей попыткой.
+
+        Args:
+            attempt (int): Номер неудачной попытки, начиная с 0.
+            exc (BaseException): Ошибка этой попытки.
+
+        Returns:
+            float: Задержка в секундах.
+        """
+        retry_after = retry_after_seconds(exc)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        ceiling = min(self.max_delay, self.base_delay * 2**attempt)
+        return random.uniform(0, ceiling)
+
+    async def run(
+        self,
+        func: Callable[..., Any],
+        *args,
+        deadline: Optional[Deadline] = None,
+        **kwargs,
+    ) -> Any:
+        """Выполняет вызов с повторами.
+
+        Выключатель учитывает одну ошибку на вызов, когда повторы исчерпаны:
+        иначе один медленный запрос с max_attempts не меньше порога
+        выключателя размыкал бы его для всех сессий. Неудачный пробный вызов
+        размыкает выключатель сразу.
+
+        Args:
+            func (Callable[..., Any]): Синхронная функция или корутинная функция.
+            *args: Позиционные аргументы для func.
+            deadline (Optional[Deadline]): Дедлайн запроса. Повтор не
+                выполняется, если задержка не укладывается в оставшееся время.
+            **kwargs: Именованные аргументы для func.
+
+        Returns:
+            Any: Результат func.
+
+        Raises:
+            CircuitOpenError: Если выключатель разомкнут.
+            Exception: Последняя ошибка, если попытки исчерпаны или ошибка
+                не подлежит повтору.
+        """
+        for attempt in range(self.max_attempts):
+            trial = False
+            if self.breaker is not None:
+                trial = self.breaker.before_call()
+            try:
+                result = func(*args, **kwargs)
+                if asyncio.iscoroutine(result):
+                    result = await result
+            except asyncio.CancelledError:
+                if self.breaker is not None:
+                    self.breaker.release()
+                raise
+            except Exception as e:
+                retryable = is_retryable(e)
+                if not retryable:
+                    if self.breaker is not None:
+                        self.breaker.release()
+                    raise
+                final = attempt == self.max_attempts - 1
+                if final:
+                    logging.error("Все попытки подключения к API исчерпаны")
+                else:
+                    delay = self.compute_delay(attempt, e)
+                    if deadline is not None and delay >= deadline.remaining():
+                        logging.error("Повтор не укладывается в дедлайн запроса")
+                        final = True
+                if self.breaker is not None and (final or trial):
+                    self.breaker.record_failure()
+                if final:
+                    raise
+                logging.warning(
+                    f"Ошибка API (попытка {attempt + 1}): {str(e)}. "
+                    f"Повтор через {delay:.1f}с"
+                )
+                await asyncio.sleep(delay)
+            else:
+                if self.breaker is not None:
+                    self.breaker.record_success()
+                return result
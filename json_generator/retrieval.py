@@ -23,6 +23,7 @@ from rank_bm25 import BM25Okapi
 
 from .WorkflowRuleTreePython import workflow_rule_tree
 from .constants import API_URL
+from .required_fields import build_catalog
 from .utils import SECRET_TOKEN
 
 
@@ -38,6 +39,8 @@ def split_json(json_data: dict[Any]) -> List[Dict[str, Any]]:
             - content: текстовое представление данных
             - original_key: оригинальный ключ из JSON
             - original_value: оригинальное значение в формате JSON
+            - required_fields: обязательные поля определения в формате JSON
+            - required_prompt: готовый текст со списком обязательных полей
     """
     result = []
     for key, value in json_data.items():
@@ -56,6 +59,7 @@ def split_json(json_data: dict[Any]) -> List[Dict[str, Any]]:
             "content": content,
             "original_key": key,
             "original_value": json.dumps(value),
+            **build_catalog(key, value),
         }
         result.append(doc)
     return result
@@ -140,6 +144,8 @@ class JsonToLanceDB:
             "vector": vectors,
             "original_key": [obj["original_key"] for obj in objects],
             "original_value": [obj["original_value"] for obj in objects],
+            "required_fields": [obj.get("required_fields", "{}") for obj in objects],
+            "required_prompt": [obj.get("required_prompt", "") for obj in objects],
         }
         df = pd.DataFrame(data)
 
@@ -254,6 +260,8 @@ class SimpleRetrievalAgent:
         tokenized_docs (List[List[str]]): Токенизированные документы.
         original_docs (pd.DataFrame): Оригинальные документы.
         vector_store (LanceDB): Векторное хранилище для поиска.
+        catalog (Dict[str, Dict[str, Any]]): Предрассчитанные обязательные поля
+            по original_value документа.
     """
 
     def __init__(self, db_path: str, table_name: str, top_k: int = 5):
@@ -314,6 +322,34 @@ class SimpleRetrievalAgent:
 
         self.bm25 = BM25Okapi(self.tokenized_docs)
         self.original_docs = docs
+        self._init_catalog()
+
+    def _init_catalog(self):
+        """Загружает предрассчитанные каталоги обязательных полей из таблицы."""
+        self.catalog: Dict[str, Dict[str, Any]] = {}
+        docs = self.original_docs
+        if "required_prompt" not in docs.columns:
+            logging.warning("В таблице нет каталога обязательных полей")
+            return
+        for _, doc in docs.iterrows():
+            if not doc["required_prompt"]:
+                continue
+            self.catalog[doc["original_value"]] = {
+                "required_fields": json.loads(doc["required_fields"]),
+                "required_prompt": doc["required_prompt"],
+            }
+
+    def get_catalog(self, original_value: str) -> Dict[str, Any] | None:
+        """Возвращает каталог обязательных полей для найденного документа.
+
+        Args:
+            original_value (str): Значение документа, которое вернул поиск.
+
+        Returns:
+            Dict[str, Any] | None: Словарь с required_fields и required_prompt
+                или None, если документ не из индекса.
+        """
+        return self.catalog.get(original_value)
 
     def hybrid_search(self, query: str, alpha: float = 0.3) -> List[Dict[str, Any]]:
         """Выполняет гибридный поиск по документам.
@@ -382,6 +418,8 @@ class SimpleRetrievalAgent:
                             "id": doc["id"],
                             "original_key": doc["original_key"],
                             "original_value": doc["original_value"],
+                            "required_fields": doc.get("required_fields", "{}"),
+                            "required_prompt": doc.get("required_prompt", ""),
                         },
                     }
                 )
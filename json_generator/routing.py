@@ -0,0 +1,134 @@
+"""Маршрутизация этапов конвейера по моделям.
+
+Каждому этапу назначается своя модель, max_tokens и temperature. Значения
+по умолчанию задаются в STAGE_DEFAULTS и переопределяются переменными
+окружения вида STAGE_<ЭТАП>_MODEL, STAGE_<ЭТАП>_MAX_TOKENS и
+STAGE_<ЭТАП>_TEMPERATURE, например STAGE_REQUIRED_FIELDS_MODEL.
+"""
+import logging
+import os
+import threading
+from typing import Dict, Mapping, Optional, Tuple
+
+from pydantic import BaseModel
+
+from .constants import MODEL_NAME
+from .metrics import LLM_CALL_DURATION, LLM_CALLS
+
+# Модель, которую раньше использовали все вызовы utils.generate
+DEFAULT_STAGE_MODEL = os.environ.get("STAGE_MODEL", "gemma-3-27b-it")
+
+CLARIFIER_TOOL_STAGE = "clarifier_tool"
+REQUIRED_FIELDS_STAGE = "required_fields"
+CLARIFIER_STAGE = "clarifier"
+GENERATION_STAGE = "generation"
+HISTORY_SUMMARY_STAGE = "history_summary"
+SCHEMA_REPAIR_STAGE = "schema_repair"
+SCHEMA_EDIT_STAGE = "schema_edit"
+
+
+class StageConfig(BaseModel):
+    """Параметры вызова модели для одного этапа."""
+
+    model: str
+    max_tokens: Optional[int] = None
+    temperature: float = 0.4
+
+
+STAGE_DEFAULTS: Dict[str, StageConfig] = {
+    CLARIFIER_TOOL_STAGE: StageConfig(model=MODEL_NAME),
+    REQUIRED_FIELDS_STAGE: StageConfig(model=DEFAULT_STAGE_MODEL),
+    CLARIFIER_STAGE: StageConfig(model=DEFAULT_STAGE_MODEL),
+    GENERATION_STAGE: StageConfig(model=DEFAULT_STAGE_MODEL),
+    HISTORY_SUMMARY_STAGE: StageConfig(model=DEFAULT_STAGE_MODEL),
+    SCHEMA_REPAIR_STAGE: StageConfig(model=DEFAULT_STAGE_MODEL),
+    SCHEMA_EDIT_STAGE: StageConfig(model=DEFAULT_STAGE_MODEL),
+}
+
+
+def load_stage_configs(
+    env: Mapping[str, str] = os.environ,
+) -> Dict[str, StageConfig]:
+    """Собирает таблицу маршрутизации с учётом переменных окружения.
+
+    Args:
+        env (Mapping[str, str]): Источник переопределений.
+
+    Returns:
+        Dict[str, StageConfig]: Параметры модели для каждого этапа.
+    """
+    configs = {}
+    for stage, default in STAGE_DEFAULTS.items():
+        prefix = f"STAGE_{stage.upper()}_"
+        overrides = {}
+        if env.get(prefix + "MODEL"):
+            overrides["model"] = env[prefix + "MODEL"]
+        if env.get(prefix + "MAX_TOKENS"):
+            overrides["max_tokens"] = int(env[prefix + "MAX_TOKENS"])
+        if env.get(prefix + "TEMPERATURE"):
+            overrides["temperature"] = float(env[prefix + "TEMPERATURE"])
+        configs[stage] = default.model_copy(update=overrides)
+    return configs
+
+
+class ModelRouter:
+    """Таблица маршрутизации и статистика задержек по этапам и моделям.
+
+    Attributes:
+        stages (Dict[str, StageConfig]): Параметры модели для каждого этапа.
+    """
+
+    def __init__(self, stages: Optional[Dict[str, StageConfig]] = None):
+        self.stages = stages if stages is not None else load_stage_configs()
+        self._lock = threading.Lock()
+        self._latency: Dict[Tuple[str, str], Dict[str, float]] = {}
+        for stage, config in self.stages.items():
+            logging.info(
+                "Этап %s: модель %s, max_tokens=%s, temperature=%s",
+                stage,
+                config.model,
+                config.max_tokens,
+                config.temperature,
+            )
+
+    def config_for(self, stage: str) -> StageConfig:
+        """Возвращает параметры модели для этапа.
+
+        Raises:
+            KeyError: Если этап не описан в таблице маршрутизации.
+        """
+        return self.stages[stage]
+
+    def record(self, stage: str, model: str, seconds: float) -> None:
+        """Учитывает длительность вызова модели на этапе."""
+        with self._lock:
+            stats = self._latency.setdefault(
+                (stage, model), {"calls": 0, "total_s": 0.0, "max_s": 0.0}
+            )
+            stats["calls"] += 1
+            stats["total_s"] += seconds
+            stats["max_s"] = max(stats["max_s"], seconds)
+        LLM_CALLS.inc(stage=stage, model=model, outcome="ok")
+        LLM_CALL_DURATION.observe(seconds, stage=stage, model=model)
+        logging.info("Этап %s (%s) занял %.2fс", stage, model, seconds)
+
+    def record_error(self, stage: str, model: str) -> None:
+        """Учитывает неудачный вызов модели на этапе."""
+        LLM_CALLS.inc(stage=stage, model=model, outcome="error")
+
+    def latency_report(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        """Возвращает задержки по этапам и моделям.
+
+        Returns:
+            Dict[str, Dict[str, Dict[str, float]]]: этап -> модель -> число
+                вызовов, средняя и максимальная длительность в секундах.
+        """
+        report: Dict[str, Dict[str, Dict[str, float]]] = {}
+        with self._lock:
+            for (stage, model), stats in self._latency.items():
+                report.setdefault(stage, {})[model] = {
+                    "calls": stats["calls"],
+                    "mean_s": stats["total_s"] / stats["calls"],
+                    "max_s": stats["max_s"],
+                }
+        return report
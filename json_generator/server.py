@@ -1,13 +1,84 @@
+import asyncio
 import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Dict, List, Union
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel
 
+from .admission import OverloadedError, RateLimitedError
 from .agents import ChatManager
+from .constants import (
+    REQUEST_TIMEOUT,
+    REQUEST_TIMEOUT_HEADER,
+    SESSION_EVICTION_INTERVAL,
+    SESSION_IDLE_TTL,
+)
+from .deadline import Deadline, DeadlineExceededError
+from .metrics import (
+    ACTIVE_SESSIONS,
+    ADMISSION_ACTIVE,
+    ADMISSION_QUEUED,
+    CONTENT_TYPE,
+    REGISTRY,
+    REQUEST_DURATION,
+    REQUESTS_IN_FLIGHT,
+    SESSION_STORE_BYTES,
+)
+from .prompts import prefix_report
+from .resilience import CircuitOpenError
+from .session_gate import SessionBusyError
+from .usage import TokenBudgetExceededError
+from .validation import ValidationIssue, validator_cache
+
+chat_manager = ChatManager()
+ACTIVE_SESSIONS.set_function(lambda: len(chat_manager.sessions))
+SESSION_STORE_BYTES.set_function(lambda: chat_manager.sessions.size_bytes)
+ADMISSION_ACTIVE.set_function(lambda: chat_manager.admission.active)
+ADMISSION_QUEUED.set_function(lambda: chat_manager.admission.queued)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Запускает фоновое вытеснение простаивающих сессий и запись сессий во
+    внешнее хранилище. При остановке оставшиеся сессии записываются, без
+    внешнего хранилища - в снимок, который читается при следующем запуске."""
+    tasks = []
+    writer = chat_manager.session_writer
+    if chat_manager.sessions.idle_ttl and SESSION_EVICTION_INTERVAL > 0:
+        tasks.append(
+            asyncio.create_task(
+                chat_manager.sessions.run_evictor(SESSION_EVICTION_INTERVAL)
+            )
+        )
+        if writer is not None:
+            tasks.append(
+                asyncio.create_task(
+                    writer.run_expirer(SESSION_IDLE_TTL, SESSION_EVICTION_INTERVAL)
+                )
+            )
+    if writer is not None:
+        tasks.append(asyncio.create_task(writer.run()))
+    await asyncio.to_thread(chat_manager.restore_snapshot)
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if writer is not None:
+            writer.backend.close()
+        chat_manager.executor.shutdown()
+        try:
+            await asyncio.to_thread(chat_manager.save_snapshot)
+        except Exception as e:
+            logging.error(f"Не удалось записать снимок сессий: {e}")
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # можно указать список доменов
@@ -15,7 +86,63 @@ app.add_middleware(
     allow_methods=["*"],  # GET, POST и др.
     allow_headers=["*"],  # Заголовки, например Content-Type
 )
-chat_manager = ChatManager()
+DISCONNECT_POLL_INTERVAL = 0.5
+KNOWN_PATHS = {
+    "/",
+    "/chat",
+    "/clear",
+    "/stats/prompt-prefix",
+    "/stats/stages",
+    "/stats/usage",
+    "/validate",
+}
+
+
+class ClientDisconnectedError(Exception):
+    """Клиент закрыл соединение, не дождавшись ответа."""
+
+
+async def run_until_disconnect(request: Request, work: Awaitable[Any]) -> Any:
+    """Выполняет обработку запроса и отменяет её, если клиент отключился.
+
+    Raises:
+        ClientDisconnectedError: Если клиент закрыл соединение раньше ответа.
+    """
+    task = asyncio.ensure_future(work)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                logging.warning("Клиент отключился, обработка запроса отменена")
+                raise ClientDisconnectedError()
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+@app.middleware("http")
+async def track_requests(request: Request, call_next):
+    """Учитывает число и длительность запросов по эндпоинтам."""
+    endpoint = request.url.path
+    if endpoint == "/metrics":
+        return await call_next(request)
+    if endpoint not in KNOWN_PATHS:
+        # Неизвестные пути не размножают ряды метрик
+        endpoint = "other"
+    REQUESTS_IN_FLIGHT.inc(endpoint=endpoint)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        REQUESTS_IN_FLIGHT.dec(endpoint=endpoint)
+        REQUEST_DURATION.observe(
+            time.perf_counter() - started, endpoint=endpoint, status=str(status)
+        )
 
 
 @app.get("/")
@@ -23,6 +150,30 @@ async def root():
     return {"message": "Json generator API is working"}
 
 
+@app.get("/metrics")
+async def metrics():
+    """Метрики сервиса в текстовом формате Prometheus."""
+    return PlainTextResponse(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
+@app.get("/stats/prompt-prefix")
+async def prompt_prefix_stats():
+    """Доля общего префикса промптов между вызовами по этапам."""
+    return prefix_report.report()
+
+
+@app.get("/stats/stages")
+async def stage_stats():
+    """Задержки вызовов моделей по этапам и моделям."""
+    return chat_manager.router.latency_report()
+
+
+@app.get("/stats/usage")
+async def usage_stats(limit: int = 20):
+    """Расход токенов LLM по самым затратным сессиям и их этапам."""
+    return chat_manager.usage_report(limit)
+
+
 class ChatRequest(BaseModel):
     session_id: str
     message: str
@@ -39,23 +190,98 @@ class ChatResponse(BaseModel):
 
 
 @app.post("/chat", response_model=ChatResponse)
-async def chat_endpoint(req: ChatRequest):
+async def chat_endpoint(req: ChatRequest, request: Request):
+    deadline = Deadline.from_header(
+        request.headers.get(REQUEST_TIMEOUT_HEADER), REQUEST_TIMEOUT
+    )
     try:
-        res = await chat_manager.handle_message(req.session_id, req.message)
+        res = await run_until_disconnect(
+            request,
+            chat_manager.handle_message(req.session_id, req.message, deadline),
+        )
         return ChatResponse(
             session_id=req.session_id,
             response=res["message"],
             json_schema=res["json_schema"],
         )
+    except CircuitOpenError as e:
+        logging.warning(e)
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(int(e.retry_after))},
+        ) from e
+    except DeadlineExceededError as e:
+        logging.warning(e)
+        raise HTTPException(status_code=504, detail=str(e)) from e
+    except TokenBudgetExceededError as e:
+        logging.warning(e)
+        raise HTTPException(status_code=429, detail=str(e)) from e
+    except OverloadedError as e:
+        logging.warning(e)
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(int(e.retry_after))},
+        ) from e
+    except (SessionBusyError, RateLimitedError) as e:
+        logging.warning(e)
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(int(e.retry_after))},
+        ) from e
+    except ClientDisconnectedError as e:
+        raise HTTPException(status_code=499, detail="Client closed request") from e
     except Exception as e:
         logging.error(e)
         raise HTTPException(status_code=500, detail=str(e)) from e
 
 
+class ValidateRequest(BaseModel):
+    definition: Union[str, Dict[str, Any]]
+    documents: List[Any]
+
+
+class ValidateResult(BaseModel):
+    valid: bool
+    issues: List[ValidationIssue]
+
+
+class ValidateResponse(BaseModel):
+    valid: int
+    invalid: int
+    results: List[ValidateResult]
+
+
+@app.post("/validate", response_model=ValidateResponse)
+def validate_documents(req: ValidateRequest):
+    """Проверяет документы по определению из дерева правил.
+
+    definition - имя определения (wf_definition, starter_kafkaConsumer, ...)
+    или само определение. Валидатор компилируется один раз и берётся из кэша.
+    """
+    try:
+        if isinstance(req.definition, str):
+            validator = validator_cache.by_name(req.definition)
+        else:
+            validator = validator_cache.get(req.definition)
+    except KeyError as e:
+        raise HTTPException(
+            status_code=404, detail=f"Определение {req.definition} не найдено"
+        ) from e
+    results = []
+    for document in req.documents:
+        issues = validator.validate(document)
+        results.append(ValidateResult(valid=not issues, issues=issues))
+    valid = sum(result.valid for result in results)
+    return ValidateResponse(valid=valid, invalid=len(results) - valid, results=results)
+
+
 @app.post("/clear")
 async def clear(session_id: SessionID):
     try:
-        res = chat_manager.clear_messages(session_id.session_id)
+        res = await chat_manager.clear_messages(session_id.session_id)
         if res:
             return JSONResponse(
                 content={"detail": "Messages cleared successfully"}, status_code=200
@@ -0,0 +1,440 @@
+"""Внешние хранилища сессий для нескольких воркеров и реплик.
+
+Хранилище (backend) работает с уже сериализованными сессиями: ключ -
+session_id, значение - байты из dumps_session. Реализации:
+
+- MemoryBackend - словарь в памяти процесса, сессии не переживают перезапуск
+  и не видны другим воркерам;
+- SQLiteBackend - файл SQLite в режиме WAL, общий для воркеров одного хоста;
+- RedisBackend - любой сервер с протоколом Redis (RESP), общий для реплик.
+
+Запись идёт пачками через SessionWriter: сессии, изменённые за время
+SESSION_FLUSH_INTERVAL, сохраняются одной транзакцией или одним пайплайном.
+"""
+import asyncio
+import json
+import logging
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+from urllib.parse import unquote, urlparse
+
+from .sessions import SessionContext
+
+# Первый байт значения: формат сериализации
+RAW_JSON = b"j"
+ZLIB_JSON = b"z"
+# Значения короче этого не сжимаются: выигрыш меньше накладных расходов
+COMPRESS_MIN_BYTES = 512
+REDIS_KEY_PREFIX = "json_generator:session:"
+
+
+def dumps_session(session: SessionContext) -> bytes:
+    """Сериализует сессию в компактный json, длинные значения сжимаются zlib."""
+    raw = json.dumps(
+        session.to_dict(), ensure_ascii=False, separators=(",", ":")
+    ).encode("utf-8")
+    if len(raw) >= COMPRESS_MIN_BYTES:
+        return ZLIB_JSON + zlib.compress(raw, 1)
+    return RAW_JSON + raw
+
+
+def loads_session(data: bytes) -> SessionContext:
+    """Восстанавливает сессию из dumps_session.
+
+    Raises:
+        ValueError: Если формат значения неизвестен.
+    """
+    kind, body = data[:1], data[1:]
+    if kind == ZLIB_JSON:
+        body = zlib.decompress(body)
+    elif kind != RAW_JSON:
+        raise ValueError(f"Неизвестный формат сессии {kind!r}")
+    return SessionContext.from_dict(json.loads(body.decode("utf-8")))
+
+
+class SessionBackend:
+    """Интерфейс внешнего хранилища сессий.
+
+    Attributes:
+        shared (bool): Хранилище видно другим процессам, поэтому сессию нужно
+            читать из него в начале каждого запроса.
+    """
+
+    shared = False
+
+    def load(self, session_id: str) -> Optional[bytes]:
+        """Сериализованная сессия или None, если её нет."""
+        raise NotImplementedError
+
+    def save_many(self, items: Mapping[str, Optional[bytes]]) -> None:
+        """Сохраняет пачку сессий за одну операцию. None удаляет сессию."""
+        raise NotImplementedError
+
+    def expire(self, idle_ttl: float) -> int:
+        """Удаляет сессии без изменений дольше idle_ttl секунд."""
+        return 0
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryBackend(SessionBackend):
+    """Хранилище в памяти процесса."""
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._items: Dict[str, Tuple[bytes, float]] = {}
+        self._lock = threading.Lock()
+
+    def load(self, session_id: str) -> Optional[bytes]:
+        with self._lock:
+            item = self._items.get(session_id)
+        return item[0] if item else None
+
+    def save_many(self, items: Mapping[str, Optional[bytes]]) -> None:
+        now = self._clock()
+        with self._lock:
+            for session_id, data in items.items():
+                if data is None:
+                    self._items.pop(session_id, None)
+                else:
+                    self._items[session_id] = (data, now)
+
+    def expire(self, idle_ttl: float) -> int:
+        deadline = self._clock() - idle_ttl
+        with self._lock:
+            expired = [k for k, (_, saved) in self._items.items() if saved < deadline]
+            for session_id in expired:
+                del self._items[session_id]
+        return len(expired)
+
+
+class SQLiteBackend(SessionBackend):
+    """Хранилище в файле SQLite в режиме WAL.
+
+    WAL позволяет воркерам одного хоста читать сессии параллельно с записью,
+    запись пачки идёт одной транзакцией.
+
+    Args:
+        path (str): Путь к файлу базы.
+    """
+
+    shared = True
+
+    def __init__(self, path: str, clock=time.time):
+        self.path = path
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id TEXT PRIMARY KEY, data BLOB NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS sessions_updated_at "
+                "ON sessions (updated_at)"
+            )
+
+    def load(self, session_id: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+        return bytes(row[0]) if row else None
+
+    def save_many(self, items: Mapping[str, Optional[bytes]]) -> None:
+        now = self._clock()
+        upserts = [(k, v, now) for k, v in items.items() if v is not None]
+        deletes = [(k,) for k, v in items.items() if v is None]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO sessions (id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET "
+                "data = excluded.data, updated_at = excluded.updated_at",
+                upserts,
+            )
+            self._conn.executemany("DELETE FROM sessions WHERE id = ?", deletes)
+
+    def expire(self, idle_ttl: float) -> int:
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "DELETE FROM sessions WHERE updated_at < ?",
+                (self._clock() - idle_ttl,),
+            )
+        return cursor.rowcount
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class RedisError(Exception):
+    """Ошибка, которую вернул сервер Redis."""
+
+
+class RedisBackend(SessionBackend):
+    """Хранилище на сервере с протоколом Redis.
+
+    Небольшой клиент RESP поверх сокета: GET, SET с EX и DEL, пачка
+    отправляется пайплайном. Время жизни сессий задаёт сам Redis через EX.
+
+    Args:
+        url (str): Адрес вида redis://[:password@]host:port/db.
+        idle_ttl (float): Время жизни сессии без изменений, 0 - бессрочно.
+        timeout (float): Таймаут сокета в секундах.
+    """
+
+    shared = True
+
+    def __init__(self, url: str, idle_ttl: float = 0, timeout: float = 5):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.idle_ttl = idle_ttl
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._sock: Optional[socket.socket] = None
+        self._reader = None
+
+    def _connect(self) -> None:
+        self._sock = socket.create_connection((self.host, self.port), self.timeout)
+        self._reader = self._sock.makefile("rb")
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", str(self.db)))
+        if setup:
+            self._send(setup)
+
+    def _disconnect(self) -> None:
+        if self._sock is not None:
+            try:
+                self._reader.close()
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = self._reader = None
+
+    @staticmethod
+    def _encode(command: Tuple[Any, ...]) -> bytes:
+        parts = [b"*%d\r\n" % len(command)]
+        for arg in command:
+            if isinstance(arg, str):
+                arg = arg.encode("utf-8")
+            elif not isinstance(arg, bytes):
+                arg = str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(parts)
+
+    def _read_reply(self) -> Any:
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError("Соединение с Redis закрыто")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise RedisError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self._reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(rest)
+            return None if length < 0 else [self._read_reply() for _ in range(length)]
+        raise RedisError(f"Неизвестный ответ {line!r}")
+
+    def _send(self, commands: List[Tuple[Any, ...]]) -> List[Any]:
+        self._sock.sendall(b"".join(self._encode(c) for c in commands))
+        return [self._read_reply() for _ in commands]
+
+    def execute(self, commands: List[Tuple[Any, ...]]) -> List[Any]:
+        """Выполняет команды одним пайплайном.
+
+        При обрыве соединения пайплайн повторяется один раз на новом
+        соединении: GET, SET и DEL можно безопасно повторить.
+        """
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    return self._send(commands)
+                except OSError:
+                    self._disconnect()
+                    if attempt:
+                        raise
+        return []
+
+    def load(self, session_id: str) -> Optional[bytes]:
+        return self.execute([("GET", REDIS_KEY_PREFIX + session_id)])[0]
+
+    def save_many(self, items: Mapping[str, Optional[bytes]]) -> None:
+        commands = []
+        for session_id, data in items.items():
+            key = REDIS_KEY_PREFIX + session_id
+            if data is None:
+                commands.append(("DEL", key))
+            elif self.idle_ttl:
+                commands.append(("SET", key, data, "EX", int(self.idle_ttl)))
+            else:
+                commands.append(("SET", key, data))
+        if commands:
+            self.execute(commands)
+
+    def close(self) -> None:
+        with self._lock:
+            self._disconnect()
+
+
+def create_backend(kind: str, url: str = "", idle_ttl: float = 0) -> SessionBackend:
+    """Создаёт хранилище по имени из SESSION_BACKEND.
+
+    Raises:
+        ValueError: Если тип хранилища неизвестен.
+    """
+    if kind == "memory":
+        return MemoryBackend()
+    if kind == "sqlite":
+        return SQLiteBackend(url or "sessions.db")
+    if kind == "redis":
+        return RedisBackend(url or "redis://localhost:6379/0", idle_ttl=idle_ttl)
+    raise ValueError(
+        f"Неизвестное хранилище сессий {kind}, допустимые: memory, sqlite, redis"
+    )
+
+
+class SessionWriter:
+    """Пакетная запись сессий в хранилище.
+
+    save ставит сессию в очередь, фоновая задача run раз в flush_interval
+    записывает все накопившиеся изменения одной пачкой. Несколько изменений
+    одной сессии за интервал записываются один раз. Пока пачка не записана,
+    load отдаёт сессию из очереди.
+
+    Args:
+        backend (SessionBackend): Хранилище.
+        flush_interval (float): Сколько секунд накапливать изменения.
+    """
+
+    # Предел паузы между повторами записи, пока хранилище недоступно
+    MAX_RETRY_DELAY = 5.0
+
+    def __init__(self, backend: SessionBackend, flush_interval: float = 0.05):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self._pending: Dict[str, Optional[bytes]] = {}
+        self._inflight: Dict[str, Optional[bytes]] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def save(self, session_id: str, data: Optional[bytes]) -> None:
+        """Ставит сессию в очередь на запись. None удаляет сессию.
+
+        Если фоновая запись run не запущена, пачка записывается сразу: из
+        цикла событий - в пуле потоков, чтобы не блокировать цикл, без цикла -
+        синхронно.
+        """
+        with self._lock:
+            self._pending[session_id] = data
+        if self._wakeup is not None:
+            self._wakeup.set()
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        loop.run_in_executor(None, self._flush_logged)
+
+    def load(self, session_id: str) -> Optional[bytes]:
+        """Сессия из очереди на запись или из хранилища."""
+        with self._lock:
+            for batch in (self._pending, self._inflight):
+                if session_id in batch:
+                    return batch[session_id]
+        return self.backend.load(session_id)
+
+    def flush(self) -> int:
+        """Записывает накопившиеся изменения. Возвращает размер пачки."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                self._inflight = batch
+            if not batch:
+                return 0
+            try:
+                self.backend.save_many(batch)
+            except Exception:
+                # Вернуть пачку в очередь, не затирая более новые изменения
+                with self._lock:
+                    self._pending = {**batch, **self._pending}
+                raise
+            finally:
+                with self._lock:
+                    self._inflight = {}
+            return len(batch)
+
+    def _flush_logged(self) -> None:
+        # Пачка при ошибке остаётся в очереди и уйдёт со следующей записью
+        try:
+            self.flush()
+        except Exception as e:
+            logging.error(f"Не удалось записать сессии: {e}")
+
+    async def run(self) -> None:
+        """Фоновая запись пачек, пока задачу не отменят.
+
+        Если хранилище недоступно, запись повторяется с паузой, которая
+        удваивается до MAX_RETRY_DELAY и сбрасывается после успешной записи.
+        При отмене оставшиеся изменения записываются.
+        """
+        self._wakeup = asyncio.Event()
+        retry_delay = 0.0
+        try:
+            while True:
+                await self._wakeup.wait()
+                await asyncio.sleep(max(self.flush_interval, retry_delay))
+                self._wakeup.clear()
+                try:
+                    await asyncio.to_thread(self.flush)
+                    retry_delay = 0.0
+                except Exception as e:
+                    retry_delay = min(
+                        self.MAX_RETRY_DELAY,
+                        retry_delay * 2 or max(self.flush_interval, 0.1),
+                    )
+                    logging.error(
+                        f"Не удалось записать сессии: {e},"
+                        f" повтор через {retry_delay:.1f}с"
+                    )
+                    self._wakeup.set()
+        finally:
+            self._wakeup = None
+            self.flush()
+
+    async def run_expirer(self, idle_ttl: float, interval: float) -> None:
+        """Периодически удаляет из хранилища простаивающие сессии."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                expired = await asyncio.to_thread(self.backend.expire, idle_ttl)
+                if expired:
+                    logging.info("Из хранилища удалено сессий: %s", expired)
+            except Exception as e:
+                logging.error(f"Ошибка удаления сессий из хранилища: {e}")
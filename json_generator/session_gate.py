@@ -0,0 +1,120 @@
+"""Последовательная обработка запросов одной сессии.
+
+Запросы одной сессии меняют один SessionContext, поэтому выполняются по
+очереди под asyncio.Lock сессии. Очередь ограничена: лишние запросы сразу
+получают SessionBusyError. Одинаковый запрос (та же сессия и то же сообщение),
+пока предыдущий такой же ещё в очереди или выполняется, не запускает
+конвейер повторно, а получает его результат - так двойной клик на фронтенде
+не тратит LLM дважды.
+
+Блокировки действуют в пределах процесса: запросы одной сессии на разных
+воркерах не упорядочиваются.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from .metrics import SESSION_REQUESTS
+
+
+class SessionBusyError(Exception):
+    """Очередь запросов сессии заполнена."""
+
+    def __init__(self, session_id: str, retry_after: float = 1):
+        super().__init__(
+            f"Сессия {session_id} уже обрабатывает запросы, повторите позже"
+        )
+        self.session_id = session_id
+        self.retry_after = retry_after
+
+
+class _Call:
+    """Выполнение запроса, результат которого ждут один или несколько клиентов."""
+
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: "asyncio.Task[Any]"):
+        self.task = task
+        self.waiters = 0
+
+
+class _Slot:
+    __slots__ = ("lock", "calls")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        # ключ запроса -> выполнение в очереди или в работе
+        self.calls: Dict[Hashable, _Call] = {}
+
+
+class SessionGate:
+    """Блокировки сессий с ограниченной очередью и объединением запросов.
+
+    Args:
+        max_pending (int): Сколько разных запросов сессии может ждать, пока
+            выполняется текущий. 0 - без ограничения.
+    """
+
+    def __init__(self, max_pending: int = 0):
+        self.max_pending = max_pending
+        self._slots: Dict[str, _Slot] = {}
+
+    def __len__(self) -> int:
+        """Число сессий, у которых есть запросы в работе или в очереди."""
+        return len(self._slots)
+
+    def pending(self, session_id: str) -> int:
+        """Число разных запросов сессии в работе и в очереди."""
+        slot = self._slots.get(session_id)
+        return len(slot.calls) if slot else 0
+
+    async def run(
+        self,
+        session_id: str,
+        key: Hashable,
+        work: Callable[[], Awaitable[Any]],
+    ) -> Any:
+        """Выполняет work под блокировкой сессии или присоединяется к
+        такому же запросу, который уже в очереди или выполняется.
+
+        Если все ожидающие клиенты отменили запрос, выполнение отменяется.
+
+        Raises:
+            SessionBusyError: Если очередь сессии заполнена.
+        """
+        slot = self._slots.get(session_id)
+        call: Optional[_Call] = slot.calls.get(key) if slot else None
+        if call is not None:
+            SESSION_REQUESTS.inc(outcome="coalesced")
+        else:
+            if slot is None:
+                slot = self._slots[session_id] = _Slot()
+            elif self.max_pending and len(slot.calls) > self.max_pending:
+                SESSION_REQUESTS.inc(outcome="rejected")
+                raise SessionBusyError(session_id)
+            SESSION_REQUESTS.inc(outcome="executed")
+            call = _Call(asyncio.ensure_future(self._locked(slot, work)))
+            call.task.add_done_callback(
+                lambda _: self._release(session_id, slot, key, call)
+            )
+            slot.calls[key] = call
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if not call.waiters and not call.task.done():
+                call.task.cancel()
+
+    @staticmethod
+    async def _locked(slot: _Slot, work: Callable[[], Awaitable[Any]]) -> Any:
+        async with slot.lock:
+            return await work()
+
+    def _release(self, session_id: str, slot: _Slot, key: Hashable, call: _Call):
+        if slot.calls.get(key) is call:
+            del slot.calls[key]
+        if not slot.calls and self._slots.get(session_id) is slot:
+            del self._slots[session_id]
+        if not call.task.cancelled():
+            # Исключение получают ожидающие, asyncio не должен логировать его
+            call.task.exception()
@@ -0,0 +1,165 @@
+"""Снимок сессий на диске для перезапуска без потери диалогов.
+
+При плавной остановке сессии из памяти записываются в файл потоком, по одной,
+в формате dumps_session. При запуске читаются только заголовки записей:
+индекс session_id -> смещение в файле. Сама сессия читается при первом
+запросе к ней, вместе с контекстом из базы и собранными параметрами, поэтому
+продолжение диалога не повторяет поиск.
+
+Формат: MAGIC, затем записи из заголовка RECORD (длина session_id, длина
+данных, время последнего обращения), session_id в utf-8 и данных.
+"""
+import logging
+import os
+import struct
+import threading
+import time
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+from .session_backends import loads_session
+from .sessions import SessionContext
+
+MAGIC = b"JGSNAP2\n"
+RECORD = struct.Struct("<IId")
+
+
+class SessionSnapshot:
+    """Файл снимка сессий с ленивым чтением.
+
+    Args:
+        path (str): Путь к файлу снимка.
+        clock (Callable[[], float]): Источник времени (время по стенным часам,
+            так как снимок переживает перезапуск).
+    """
+
+    def __init__(self, path: str, clock=time.time):
+        self.path = path
+        self._clock = clock
+        self._lock = threading.Lock()
+        # session_id -> (смещение данных, длина данных, время обращения)
+        self._index: Dict[str, Tuple[int, int, float]] = {}
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._index
+
+    def open(self, idle_ttl: float = 0) -> int:
+        """Читает заголовки записей снимка, не загружая сами сессии.
+
+        Args:
+            idle_ttl (float): Сессии без обращений дольше стольких секунд не
+                восстанавливаются, 0 - восстанавливать все.
+
+        Returns:
+            int: Число сессий, доступных для восстановления.
+        """
+        index = {}
+        deadline = self._clock() - idle_ttl if idle_ttl else None
+        try:
+            with open(self.path, "rb") as file:
+                if file.read(len(MAGIC)) != MAGIC:
+                    logging.warning("Файл %s не является снимком сессий", self.path)
+                    return 0
+                for session_id, offset, length, touched in self._scan(file):
+                    if deadline is None or touched >= deadline:
+                        index[session_id] = (offset, length, touched)
+        except FileNotFoundError:
+            return 0
+        with self._lock:
+            self._index = index
+        return len(index)
+
+    @staticmethod
+    def _scan(file) -> Iterator[Tuple[str, int, int, float]]:
+        while True:
+            header = file.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            id_length, length, touched = RECORD.unpack(header)
+            session_id = file.read(id_length).decode("utf-8")
+            offset = file.tell()
+            file.seek(length, os.SEEK_CUR)
+            yield session_id, offset, length, touched
+
+    def _read(self, offset: int, length: int) -> Optional[bytes]:
+        with open(self.path, "rb") as file:
+            file.seek(offset)
+            data = file.read(length)
+        return data if len(data) == length else None
+
+    def pop(self, session_id: str) -> Optional[SessionContext]:
+        """Восстанавливает сессию из снимка и убирает её из индекса."""
+        with self._lock:
+            entry = self._index.pop(session_id, None)
+        if entry is None:
+            return None
+        try:
+            data = self._read(entry[0], entry[1])
+            return loads_session(data) if data else None
+        except (OSError, ValueError) as e:
+            logging.error(f"Не удалось восстановить сессию {session_id}: {e}")
+            return None
+
+    def write(self, items: Iterable[Tuple[str, bytes, float]]) -> int:
+        """Записывает снимок потоком и атомарно заменяет прежний файл.
+
+        Сессии прежнего снимка, которые так и не запросили, переносятся в
+        новый, если их нет среди items.
+
+        Args:
+            items (Iterable[Tuple[str, bytes, float]]): session_id, данные
+                dumps_session и время последнего обращения.
+
+        Returns:
+            int: Число записанных сессий.
+        """
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        written = set()
+        with self._lock:
+            remaining = dict(self._index)
+        try:
+            with open(tmp_path, "wb") as out:
+                out.write(MAGIC)
+                for session_id, data, touched in items:
+                    if self._write_record(out, session_id, data, touched):
+                        written.add(session_id)
+                if remaining:
+                    with open(self.path, "rb") as old:
+                        for session_id, entry in remaining.items():
+                            if session_id in written:
+                                continue
+                            offset, length, touched = entry
+                            old.seek(offset)
+                            data = old.read(length)
+                            if self._write_record(out, session_id, data, touched):
+                                written.add(session_id)
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            self._index = {}
+        return len(written)
+
+    @staticmethod
+    def _write_record(out, session_id: str, data: bytes, touched: float) -> bool:
+        """Пишет одну запись. Сессия, которую нельзя записать (например,
+        session_id не кодируется в utf-8), пропускается, а не срывает весь
+        снимок."""
+        try:
+            key = session_id.encode("utf-8")
+            header = RECORD.pack(len(key), len(data), touched)
+        except (UnicodeEncodeError, struct.error) as e:
+            logging.error(f"Сессия {session_id[:64]!r} пропущена в снимке: {e}")
+            return False
+        out.write(header)
+        out.write(key)
+        out.write(data)
+        return True
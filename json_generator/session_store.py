@@ -0,0 +1,167 @@
+"""Ограниченное хранилище сессий с вытеснением по LRU, объёму и простою.
+
+Сессии лежат в OrderedDict в порядке последнего обращения. При превышении
+числа сессий или суммарного размера вытесняются самые давние, сессии без
+обращений дольше idle_ttl удаляются фоновой задачей run_evictor.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from .metrics import SESSION_EVICTIONS
+from .sessions import SessionContext
+
+
+class SessionStore:
+    """Хранилище сессий ChatManager.
+
+    Args:
+        max_sessions (int): Максимальное число сессий, 0 - без ограничения.
+        max_bytes (int): Максимальный суммарный размер сессий в байтах
+            (оценка SessionContext.estimate_size), 0 - без ограничения.
+        idle_ttl (float): Через сколько секунд без обращений сессия
+            удаляется, 0 - не удалять.
+        clock (Callable[[], float]): Источник времени.
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = 0,
+        max_bytes: int = 0,
+        idle_ttl: float = 0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        # session_id -> (сессия, размер в байтах, время последнего обращения)
+        self._entries: "OrderedDict[str, Tuple[SessionContext, int, float]]" = (
+            OrderedDict()
+        )
+        self._bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._entries
+
+    @property
+    def size_bytes(self) -> int:
+        """Суммарный размер сессий в байтах."""
+        return self._bytes
+
+    def get(self, session_id: str) -> Optional[SessionContext]:
+        """Возвращает сессию и отмечает обращение, не создавая новую."""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            self._entries[session_id] = (entry[0], entry[1], self._clock())
+            self._entries.move_to_end(session_id)
+            return entry[0]
+
+    def get_or_create(self, session_id: str) -> SessionContext:
+        """Возвращает сессию, создавая пустую при первом обращении."""
+        session = self.get(session_id)
+        if session is None:
+            session = SessionContext()
+            self.put(session_id, session)
+        return session
+
+    def put(self, session_id: str, session: SessionContext) -> None:
+        """Сохраняет сессию, пересчитывает её размер и применяет ограничения.
+
+        Вызывается после каждого изменения сессии. Если сессию успели
+        вытеснить во время обработки запроса, она возвращается в хранилище.
+        """
+        size = session.estimate_size()
+        with self._lock:
+            previous = self._entries.pop(session_id, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[session_id] = (session, size, self._clock())
+            self._bytes += size
+            evicted = self._enforce_limits()
+        self._log_evicted(evicted)
+
+    def delete(self, session_id: str) -> bool:
+        """Удаляет сессию. Возвращает False, если её не было."""
+        with self._lock:
+            entry = self._entries.pop(session_id, None)
+            if entry is None:
+                return False
+            self._bytes -= entry[1]
+            return True
+
+    def items(self) -> List[Tuple[str, SessionContext]]:
+        """Снимок пар (session_id, сессия)."""
+        with self._lock:
+            return [(key, entry[0]) for key, entry in self._entries.items()]
+
+    def idle_items(self) -> List[Tuple[str, SessionContext, float]]:
+        """Снимок сессий со временем простоя в секундах."""
+        now = self._clock()
+        with self._lock:
+            return [
+                (key, entry[0], now - entry[2]) for key, entry in self._entries.items()
+            ]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter([key for key, _ in self.items()])
+
+    def _pop_oldest(self, reason: str) -> str:
+        session_id, entry = self._entries.popitem(last=False)
+        self._bytes -= entry[1]
+        SESSION_EVICTIONS.inc(reason=reason)
+        return session_id
+
+    def _enforce_limits(self) -> List[Tuple[str, str]]:
+        # Последняя сессия только что использовалась и не вытесняется
+        evicted = []
+        while self.max_sessions and len(self._entries) > self.max_sessions:
+            evicted.append((self._pop_oldest("count"), "count"))
+        while (
+            self.max_bytes and self._bytes > self.max_bytes and len(self._entries) > 1
+        ):
+            evicted.append((self._pop_oldest("bytes"), "bytes"))
+        return evicted
+
+    def evict_expired(self) -> int:
+        """Удаляет сессии без обращений дольше idle_ttl.
+
+        Returns:
+            int: Число удалённых сессий.
+        """
+        if not self.idle_ttl:
+            return 0
+        deadline = self._clock() - self.idle_ttl
+        evicted = []
+        with self._lock:
+            # Порядок OrderedDict совпадает с порядком обращений
+            while self._entries:
+                _, _, touched = next(iter(self._entries.values()))
+                if touched > deadline:
+                    break
+                evicted.append((self._pop_oldest("idle"), "idle"))
+        self._log_evicted(evicted)
+        return len(evicted)
+
+    @staticmethod
+    def _log_evicted(evicted: List[Tuple[str, str]]) -> None:
+        for session_id, reason in evicted:
+            logging.info("Сессия %s вытеснена (%s)", session_id, reason)
+
+    async def run_evictor(self, interval: float) -> None:
+        """Периодически удаляет простаивающие сессии, пока задачу не отменят."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.evict_expired()
+            except Exception as e:
+                logging.error(f"Ошибка фонового вытеснения сессий: {e}")
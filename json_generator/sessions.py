@@ -1,29 +1,294 @@
-from typing import Any, Dict, List, Optional
+import json
+import threading
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Union
+
+from .usage import TokenUsage
+
+USER_ROLE = "user"
+ASSISTANT_ROLE = "assistant"
+# Роль сообщения хранится одним байтом: индексом в ROLES
+ROLES = (USER_ROLE, ASSISTANT_ROLE)
+ROLE_TAGS = {role: tag for tag, role in enumerate(ROLES)}
+SUMMARY_PREFIX = "Краткое содержание предыдущего диалога: "
+ASSISTANT_PREFIX = "[Ассистент]: "
+# Грубая оценка числа токенов по длине текста, без токенизатора модели
+CHARS_PER_TOKEN = 3
+# Оценка накладных расходов на объект сессии и на одно сообщение в байтах
+SESSION_OVERHEAD_BYTES = 600
+MESSAGE_OVERHEAD_BYTES = 60
+EMPTY_PARAMS: Mapping[str, Any] = MappingProxyType({})
+# Сколько разных контекстов из базы хранится общими копиями
+SHARED_CONTEXTS_MAX = 64
+
+
+def estimate_tokens(text: str) -> int:
+    """Приблизительно оценивает число токенов в тексте."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+_shared_contexts: "OrderedDict[str, str]" = OrderedDict()
+_shared_lock = threading.Lock()
+
+
+def share_context(text: str) -> str:
+    """Общая копия контекста из базы: определений немного, и одинаковые
+    контексты разных сессий хранятся в памяти один раз.
+
+    Словарь ограничен SHARED_CONTEXTS_MAX последними контекстами, поэтому, в
+    отличие от sys.intern, вытесненные сессии не удерживают строки навсегда.
+    """
+    if not text:
+        return text
+    with _shared_lock:
+        shared = _shared_contexts.get(text)
+        if shared is None:
+            shared = _shared_contexts[text] = text
+            if len(_shared_contexts) > SHARED_CONTEXTS_MAX:
+                _shared_contexts.popitem(last=False)
+        else:
+            _shared_contexts.move_to_end(text)
+        return shared
+
+
+class ListView(Sequence):
+    """Представление списка только для чтения, без копирования."""
+
+    __slots__ = ("_items",)
+
+    def __init__(self, items: list):
+        self._items = items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __getitem__(self, index):
+        return self._items[index]
+
+    def __iter__(self):
+        return iter(self._items)
+
+
+class MessagesView(Sequence):
+    """Сообщения сессии парами (роль, текст), без копирования."""
+
+    __slots__ = ("_roles", "_texts")
+
+    def __init__(self, roles: bytearray, texts: List[str]):
+        self._roles = roles
+        self._texts = texts
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(
+                zip((ROLES[tag] for tag in self._roles[index]), self._texts[index])
+            )
+        return ROLES[self._roles[index]], self._texts[index]
+
+    def __iter__(self):
+        return zip((ROLES[tag] for tag in self._roles), self._texts)
 
 
 class SessionContext:
     """
     Хранит данные сессии: сообщения, собранные параметры, схема, состояние.
+
+    Старые сообщения сворачиваются в краткое содержание (summary), в промпт
+    попадают только оно и последние сообщения после summarized_count.
+
+    Сессий в памяти воркера много, поэтому представление компактное: роли
+    сообщений хранятся байтами, контекст из базы - общей копией строки
+    (см. share_context), собранные параметры и расход токенов создаются при первой записи.
+    Чтение сообщений и параметров возвращает представления без копирования.
     """
 
+    __slots__ = (
+        "_roles",
+        "_texts",
+        "summary",
+        "summarized_count",
+        "_params",
+        "missing_fields",
+        "_bd_context",
+        "_schema",
+        "awaiting_clarification",
+        "_usage",
+    )
+
     def __init__(self):
-        self.messages: List[str] = []
-        self.collected_params: Dict[str, Any] = {}
-        self.missing_fields: List[str] = []
-        self.bd_context: str = ""
-        self.current_schema: Optional[dict] = None
+        self._roles = bytearray()
+        self._texts: List[str] = []
+        self.summary: str = ""
+        self.summarized_count: int = 0
+        self._params: Optional[Dict[str, Any]] = None
+        self.missing_fields: Sequence[str] = ()
+        self._bd_context: str = ""
+        self._schema: Optional[str] = None
         self.awaiting_clarification: bool = False
+        self._usage: Optional[TokenUsage] = None
 
     def __len__(self) -> int:
         """Возвращает количество сообщений в сессии."""
-        return len(self.messages)
+        return len(self._texts)
+
+    @property
+    def messages(self) -> MessagesView:
+        """Сообщения парами (роль, текст)."""
+        return MessagesView(self._roles, self._texts)
+
+    @property
+    def collected_params(self) -> Mapping[str, Any]:
+        """Собранные параметры, только для чтения (запись - add_collected_param)."""
+        return EMPTY_PARAMS if self._params is None else MappingProxyType(self._params)
+
+    @collected_params.setter
+    def collected_params(self, params: Mapping[str, Any]):
+        self._params = dict(params) or None
+
+    @property
+    def bd_context(self) -> str:
+        return self._bd_context
+
+    @bd_context.setter
+    def bd_context(self, bd_context: str):
+        self._bd_context = share_context(bd_context)
+
+    @property
+    def current_schema(self) -> Optional[str]:
+        """Текущая схема json-строкой."""
+        return self._schema
+
+    @current_schema.setter
+    def current_schema(self, schema: Union[str, Dict[str, Any], None]):
+        if isinstance(schema, dict):
+            schema = json.dumps(schema, ensure_ascii=False)
+        self._schema = schema
+
+    @property
+    def token_usage(self) -> TokenUsage:
+        if self._usage is None:
+            self._usage = TokenUsage()
+        return self._usage
+
+    @token_usage.setter
+    def token_usage(self, usage: TokenUsage):
+        self._usage = usage
+
+    def estimate_size(self) -> int:
+        """
+        Приблизительный размер сессии в байтах: строки считаются по длине,
+        к ним добавляются накладные расходы на объекты.
+        Контекст из базы считается целиком, хотя одинаковые копии разных
+        сессий общие, поэтому оценка сверху.
+        """
+        size = SESSION_OVERHEAD_BYTES + len(self.summary) + len(self._bd_context)
+        size += len(self._schema or "")
+        for text in self._texts:
+            size += MESSAGE_OVERHEAD_BYTES + len(text)
+        for key, value in (self._params or {}).items():
+            size += MESSAGE_OVERHEAD_BYTES + len(key) + len(str(value))
+        return size
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Состояние сессии для сохранения во внешнем хранилище."""
+        return {
+            "messages": [list(message) for message in self.messages],
+            "summary": self.summary,
+            "summarized_count": self.summarized_count,
+            "collected_params": dict(self._params or {}),
+            "missing_fields": list(self.missing_fields),
+            "bd_context": self._bd_context,
+            "current_schema": self._schema,
+            "awaiting_clarification": self.awaiting_clarification,
+            "token_usage": self._usage.to_dict() if self._usage else {},
+        }
 
-    def get_messages(self) -> List[str]:
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "SessionContext":
+        """Восстанавливает сессию из to_dict."""
+        session = cls()
+        for role, text in data.get("messages", []):
+            session._roles.append(ROLE_TAGS[role])
+            session._texts.append(text)
+        session.summary = data.get("summary", "")
+        session.summarized_count = data.get("summarized_count", 0)
+        session.collected_params = data.get("collected_params", {})
+        session.missing_fields = tuple(data.get("missing_fields", ()))
+        session.bd_context = data.get("bd_context", "")
+        session.current_schema = data.get("current_schema")
+        session.awaiting_clarification = data.get("awaiting_clarification", False)
+        if data.get("token_usage"):
+            session.token_usage = TokenUsage.from_dict(data["token_usage"])
+        return session
+
+    def get_messages(self) -> Sequence[str]:
+        """Возвращает тексты всех сообщений сессии (представление, без копии)."""
+        return ListView(self._texts)
+
+    def get_prompt_history(self) -> List[str]:
+        """
+        Возвращает историю для промпта: краткое содержание старых сообщений
+        и последние сообщения целиком. Ответы ассистента помечаются.
+        """
         history = []
-        for i in self.messages:
-            history.append(i)
+        if self.summary:
+            history.append(SUMMARY_PREFIX + self.summary)
+        history.extend(self._render_range(self.summarized_count, len(self._texts)))
         return history
 
+    def _render_range(self, start: int, end: int) -> List[str]:
+        """Форматирует сообщения для промпта с пометкой роли ассистента."""
+        assistant = ROLE_TAGS[ASSISTANT_ROLE]
+        return [
+            ASSISTANT_PREFIX + self._texts[i]
+            if self._roles[i] == assistant
+            else self._texts[i]
+            for i in range(start, end)
+        ]
+
+    def needs_compaction(
+        self, max_turns: int, token_budget: int, keep_turns: int = 1
+    ) -> bool:
+        """
+        Проверяет, пора ли сворачивать историю: несвёрнутых сообщений больше
+        max_turns или их оценка в токенах превышает token_budget.
+
+        Последние keep_turns сообщений get_messages_to_compact оставляет
+        целиком, поэтому свёртка не нужна, если до них нечего сворачивать.
+        Если эти сообщения сами не укладываются в token_budget, свёртка по
+        токенам ничего не даст и выполняется только по числу сообщений:
+        иначе длинные последние сообщения вызывали бы её на каждом ходу.
+        """
+        keep = max(keep_turns, 1)
+        recent = len(self._texts) - self.summarized_count
+        if recent <= keep:
+            return False
+        if recent > max_turns:
+            return True
+        kept = sum(estimate_tokens(text) for text in self._texts[-keep:])
+        if kept > token_budget:
+            return False
+        start, end = self.summarized_count, len(self._texts) - keep
+        older = sum(estimate_tokens(text) for text in self._texts[start:end])
+        return kept + older > token_budget
+
+    def get_messages_to_compact(self, keep_turns: int) -> List[str]:
+        """
+        Возвращает несвёрнутые сообщения, которые нужно сложить в summary,
+        оставляя последние keep_turns сообщений (и хотя бы одно) целиком.
+        """
+        end = max(len(self._texts) - max(keep_turns, 1), self.summarized_count)
+        return self._render_range(self.summarized_count, end)
+
+    def apply_summary(self, summary: str, compacted: int):
+        """Сохраняет новое краткое содержание и сдвигает границу свёрнутых сообщений."""
+        self.summary = summary
+        self.summarized_count = min(self.summarized_count + compacted, len(self._texts))
+
     def update_with_bd_context(
         self,
         bd_context: str,
@@ -32,43 +297,56 @@ class SessionContext:
         self.bd_context = bd_context
 
     def update_with_user(self, message: str):
-        """Добавляет сообщение в сессию."""
-        self.messages.append(message)
+        """Добавляет сообщение пользователя в сессию."""
+        self._roles.append(ROLE_TAGS[USER_ROLE])
+        self._texts.append(message)
+
+    def update_with_assistant(self, message: str):
+        """Добавляет ответ ассистента в сессию."""
+        self._roles.append(ROLE_TAGS[ASSISTANT_ROLE])
+        self._texts.append(message)
 
     def set_missing(self, fields: List[str]):
         """Устанавливает недостающие поля и состояние ожидания уточнения."""
-        self.missing_fields = fields
+        self.missing_fields = tuple(fields)
         self.awaiting_clarification = bool(fields)
 
     def clear_missing(self):
         """Очищает недостающие поля и состояние ожидания уточнения."""
-        self.missing_fields = []
+        self.missing_fields = ()
         self.awaiting_clarification = False
 
-    def set_schema(self, schema: dict):
-        """Json-schema"""
+    def set_schema(self, schema: Union[str, Dict[str, Any]]):
+        """Json-schema (словарь сохраняется json-строкой)"""
         self.current_schema = schema
 
     def clear_session(self):
         """Очищает данные сессии."""
-        self.messages.clear()
-        self.bd_context = ""
-        self.collected_params.clear()
-        self.missing_fields.clear()
-        self.current_schema = None
+        self._roles.clear()
+        self._texts.clear()
+        self.summary = ""
+        self.summarized_count = 0
+        self._bd_context = ""
+        self._params = None
+        self.missing_fields = ()
+        self._schema = None
         self.awaiting_clarification = False
+        if self._usage is not None:
+            self._usage.reset_turns()
 
     def add_collected_param(self, key: str, value: Any):
         """
         Добавляет параметр в коллекцию collected_params.
         Если ключ уже существует, перезаписывает его новым значением.
         """
-        self.collected_params[key] = value
+        if self._params is None:
+            self._params = {}
+        self._params[key] = value
 
     def get_collected_params_as_str(self) -> str:
         """
         Возвращает все собранные параметры в виде удобочитаемой строки вида:
         "param_name1=value1\nparam_name2=value2\n..."
         """
-        params_str = "\n".join([f"{k}: {v}" for k, v in self.collected_params.items()])
+        params_str = "\n".join(f"{k}: {v}" for k, v in (self._params or {}).items())
         return params_str
@@ -0,0 +1,122 @@
+"""Сборка схемы по шаблону из дерева правил без генерации LLM.
+
+Каркас строится по определению, найденному для сессии (wf_definition,
+starter_kafkaConsumer и т.д.), и заполняется значениями из collected_params.
+Фиксированные значения (value) и значения по умолчанию (default) берутся из
+дерева правил. Поля, которые заполнить не удалось, остаются пустыми: их
+находит SchemaValidator, и LLM дописывает только их.
+"""
+import json
+import re
+from collections import Counter
+from typing import Any, Dict, List, Tuple
+
+from .validation import FieldRule, compile_fields
+
+INT_RE = re.compile(r"^-?\d+$")
+
+
+def index_params(
+    params: Dict[str, Any], fields: Dict[str, FieldRule]
+) -> Dict[str, Any]:
+    """Приводит ключи collected_params к путям относительно определения.
+
+    Уточняющий агент называет поля по списку обязательных полей, где путь
+    начинается с имени определения (``starter_kafkaConsumer.kafkaConsumer.topic``).
+    Такое имя отбрасывается.
+    """
+    by_path = {}
+    for key, value in params.items():
+        parts = [part for part in str(key).strip().split(".") if part]
+        if len(parts) > 1 and parts[0] not in fields:
+            parts = parts[1:]
+        if parts:
+            by_path[".".join(parts)] = value
+    return by_path
+
+
+def _count_names(fields: Dict[str, FieldRule], names: Counter) -> None:
+    for name, rule in fields.items():
+        names[name] += 1
+        _count_names(rule.children, names)
+
+
+def coerce_value(rule: FieldRule, value: Any) -> Any:
+    """Приводит значение из диалога к типу поля из дерева правил."""
+    if isinstance(value, str):
+        text = value.strip()
+        if rule.kind == "integer" and INT_RE.match(text):
+            return int(text)
+        if rule.kind == "number":
+            try:
+                return float(text)
+            except ValueError:
+                return value
+        if rule.kind in ("object", "array") and text[:1] in "{[":
+            try:
+                return json.loads(text)
+            except json.JSONDecodeError:
+                return value
+        if rule.valid_values is not None:
+            for valid in rule.valid_values:
+                if str(valid).lower() == text.lower():
+                    return valid
+        return text
+    if rule.kind == "string" and isinstance(value, (int, float)):
+        return str(value)
+    return value
+
+
+class _Builder:
+    def __init__(self, by_path: Dict[str, Any], names: Counter):
+        self.by_path = by_path
+        self.names = names
+        self.used = 0
+
+    def lookup(self, path: List[str]) -> Tuple[bool, Any]:
+        key = ".".join(path)
+        if key in self.by_path:
+            return True, self.by_path[key]
+        leaf = path[-1]
+        # Короткое имя поля принимается, только если оно однозначно
+        if self.names[leaf] == 1 and leaf in self.by_path:
+            return True, self.by_path[leaf]
+        return False, None
+
+    def build(self, fields: Dict[str, FieldRule], path: List[str]) -> Dict[str, Any]:
+        obj: Dict[str, Any] = {}
+        # Сначала значения: от них зависят условия обязательности вложенных полей
+        for name, rule in fields.items():
+            found, value = self.lookup(path + [name])
+            if found:
+                obj[name] = coerce_value(rule, value)
+                self.used += 1
+            elif rule.default is not None:
+                obj[name] = rule.default
+        for name, rule in fields.items():
+            if name in obj or not rule.children:
+                continue
+            child = self.build(rule.children, path + [name])
+            if child or rule.is_required(obj):
+                obj[name] = child
+        return obj
+
+
+def assemble_schema(
+    definition: Dict[str, Any], params: Dict[str, Any]
+) -> Tuple[Dict[str, Any], int]:
+    """Собирает схему по определению из дерева правил.
+
+    Args:
+        definition (Dict[str, Any]): Определение с полем parameters.
+        params (Dict[str, Any]): Собранные в диалоге параметры.
+
+    Returns:
+        Tuple[Dict[str, Any], int]: Схема и число полей, заполненных из params.
+    """
+    fields = compile_fields(definition.get("parameters"))
+    names: Counter = Counter()
+    _count_names(fields, names)
+    builder = _Builder(index_params(params, fields), names)
+    document = builder.build(fields, [])
+    return document, builder.used
@@ -0,0 +1,133 @@
+"""Учёт токенов LLM по сессиям и этапам.
+
+Каждая сессия хранит свой TokenUsage. На время обработки сообщения он
+кладётся в переменную контекста current_usage, и все вызовы LLM этого
+запроса (в том числе из потоков пула BlockingExecutor) добавляют в него токены.
+"""
+import threading
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+
+class TokenBudgetExceededError(Exception):
+    """Сессия израсходовала свой бюджет токенов."""
+
+    def __init__(self, used: int, budget: int):
+        super().__init__(
+            f"Сессия израсходовала бюджет токенов ({used} из {budget}),"
+            " продолжите в новой сессии"
+        )
+        self.used = used
+        self.budget = budget
+
+
+class TokenUsage:
+    """Накопленные токены запросов и ответов LLM по этапам.
+
+    Attributes:
+        stages (Dict[str, List[int]]): этап -> [число вызовов, токены
+            запроса, токены ответа].
+        turn_prompt_tokens (int): Токены запросов текущего хода.
+        last_turn_prompt_tokens (int): Токены запросов предыдущего хода.
+    """
+
+    __slots__ = ("_lock", "stages", "turn_prompt_tokens", "last_turn_prompt_tokens")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages: Dict[str, List[int]] = {}
+        self.turn_prompt_tokens = 0
+        self.last_turn_prompt_tokens = 0
+
+    def add(self, stage: str, prompt_tokens: int, completion_tokens: int) -> None:
+        """Добавляет токены одного вызова LLM."""
+        with self._lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = [0, 0, 0]
+            stats[0] += 1
+            stats[1] += prompt_tokens
+            stats[2] += completion_tokens
+            self.turn_prompt_tokens += prompt_tokens
+
+    def start_turn(self) -> None:
+        """Начинает новый ход: токены текущего хода становятся предыдущими."""
+        with self._lock:
+            self.last_turn_prompt_tokens = self.turn_prompt_tokens
+            self.turn_prompt_tokens = 0
+
+    @property
+    def prompt_tokens(self) -> int:
+        with self._lock:
+            return sum(s[1] for s in self.stages.values())
+
+    @property
+    def completion_tokens(self) -> int:
+        with self._lock:
+            return sum(s[2] for s in self.stages.values())
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def report(self) -> Dict[str, Any]:
+        """Итоги по сессии и по этапам."""
+        with self._lock:
+            stages = {stage: self._stats(stats) for stage, stats in self.stages.items()}
+        prompt = sum(s["prompt_tokens"] for s in stages.values())
+        completion = sum(s["completion_tokens"] for s in stages.values())
+        return {
+            "prompt_tokens": prompt,
+            "completion_tokens": completion,
+            "total_tokens": prompt + completion,
+            "stages": stages,
+        }
+
+    @staticmethod
+    def _stats(stats: List[int]) -> Dict[str, int]:
+        return {
+            "calls": stats[0],
+            "prompt_tokens": stats[1],
+            "completion_tokens": stats[2],
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Состояние для сохранения вместе с сессией."""
+        with self._lock:
+            return {
+                "stages": {
+                    stage: self._stats(stats) for stage, stats in self.stages.items()
+                },
+                "turn": self.turn_prompt_tokens,
+                "last_turn": self.last_turn_prompt_tokens,
+            }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "TokenUsage":
+        usage = cls()
+        usage.stages = {
+            stage: [
+                stats.get("calls", 0),
+                stats.get("prompt_tokens", 0),
+                stats.get("completion_tokens", 0),
+            ]
+            for stage, stats in data.get("stages", {}).items()
+        }
+        usage.turn_prompt_tokens = data.get("turn", 0)
+        usage.last_turn_prompt_tokens = data.get("last_turn", 0)
+        return usage
+
+    def reset_turns(self) -> None:
+        """Сбрасывает токены ходов после очистки истории.
+
+        Накопленные по этапам токены сохраняются: очистка сессии не обнуляет
+        расход и не обходит бюджет сессии.
+        """
+        with self._lock:
+            self.turn_prompt_tokens = 0
+            self.last_turn_prompt_tokens = 0
+
+
+current_usage: ContextVar[Optional[TokenUsage]] = ContextVar(
+    "current_usage", default=None
+)
@@ -8,6 +8,9 @@ from openai import OpenAIError
 from pydantic import BaseModel, Field
 
 from .constants import API_URL, MODEL_NAME
+from .json_extract import JsonScanner, extract_json
+from .metrics import record_llm_usage
+from .sessions import estimate_tokens
 
 try:
     from .private_api import SECRET_TOKEN
@@ -72,11 +75,40 @@ FUNCTION_DEFINITIONS = [
 ]
 
 
+def _build_messages(
+    input_data: Union[str, List[Dict[str, Any]]], system_prompt: str
+) -> List[Dict[str, Any]]:
+    """Приводит текст или историю сообщений к списку сообщений для API.
+
+    Raises:
+        TypeError: Возникает, если тип данных не поддерживается.
+    """
+    if isinstance(input_data, str):
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": input_data},
+        ]
+    if isinstance(input_data, list):
+        return input_data
+    error_msg = "Неверный тип данных. Должен быть string или list of dictionaries."
+    logging.error(error_msg)
+    raise TypeError(error_msg)
+
+
+def _given(value: Any) -> Any:
+    """None заменяется на NOT_GIVEN: явный None в SDK OpenAI отключает
+    таймауты клиента, а max_tokens уходит в запрос как null."""
+    return openai.NOT_GIVEN if value is None else value
+
+
 def generate(
     input_data: Union[str, List[Dict[str, Any]]],
     model: str = MODEL_NAME,
     system_prompt: str = "Ты ассистент для помощи пользователю.",
     json_schema: Optional[Dict] = None,
+    timeout: Optional[float] = None,
+    temperature: float = 0.4,
+    max_tokens: Optional[int] = None,
 ) -> str:
     """Генерирует ответ на основании введённых данных (текста или истории разговоров).
 
@@ -89,38 +121,38 @@ def generate(
             Системный промпт для модели
         json_schema (Optional[Dict]):
             Json-схема для форматирования ответа. Если не указана, то не используется.
+        timeout (Optional[float]):
+            Таймаут запроса в секундах. Если не указан, используется таймаут
+            клиента (None не передаётся в SDK, иначе таймауты отключаются).
+        temperature (float):
+            Температура генерации.
+        max_tokens (Optional[int]):
+            Ограничение длины ответа. Если не указано, не передаётся.
 
     Raises:
         TypeError: Возникает, если тип данных не поддерживается.
         OpenAIError: Исключение, возникающее при проблемах взаимодействия с API OpenAI.
 
     Returns:
-        str: Генерируемый ответ модели или сообщение об ошибке.
+        str: Генерируемый ответ модели.
     """
-    if isinstance(input_data, str):
-        request_messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": input_data},
-        ]
-    elif isinstance(input_data, list):
-        request_messages = input_data
-    else:
-        error_msg = "Неверный тип данных. Должен быть string или list of dictionaries."
-        logging.error(error_msg)
-        raise TypeError(error_msg)
-
+    request_messages = _build_messages(input_data, system_prompt)
     try:
         if json_schema is None:
             response = client.chat.completions.create(
                 messages=request_messages,
                 model=model,
-                temperature=0.4,
+                temperature=temperature,
+                max_tokens=_given(max_tokens),
+                timeout=_given(timeout),
             )
         else:
             response = client.chat.completions.create(
                 messages=request_messages,
                 model=model,
-                temperature=0.4,
+                temperature=temperature,
+                max_tokens=_given(max_tokens),
+                timeout=_given(timeout),
                 response_format={
                     "type": "json_schema",
                     "json_schema": {
@@ -130,7 +162,81 @@ def generate(
                     },
                 },
             )
+        if response.usage is not None:
+            record_llm_usage(
+                model, response.usage.prompt_tokens, response.usage.completion_tokens
+            )
         answer = response.choices[0].message.content
         return answer
     except OpenAIError as e:
-        return f"Произошла ошибка при обращении к API: {str(e)}"
+        logging.error(f"Произошла ошибка при обращении к API: {str(e)}")
+        raise
+
+
+def generate_json(
+    input_data: Union[str, List[Dict[str, Any]]],
+    model: str = MODEL_NAME,
+    system_prompt: str = "Ты ассистент для помощи пользователю.",
+    timeout: Optional[float] = None,
+    temperature: float = 0.4,
+    max_tokens: Optional[int] = None,
+) -> str:
+    """Генерирует json-объект без structured output, читая ответ потоком.
+
+    Чтение потока прекращается, как только внешний объект закрылся, поэтому
+    пояснения модели после json не генерируются впустую. Ответ проходит
+    через extract_json: снимаются блоки ```json и исправляется синтаксис.
+
+    Args:
+        input_data (Union[str, List[Dict[str, Any]]]): Текст или история сообщений.
+        model (str): название модели
+        system_prompt (str): Системный промпт для модели
+        timeout (Optional[float]): Таймаут запроса в секундах. Если не указан,
+            используется таймаут клиента.
+        temperature (float): Температура генерации.
+        max_tokens (Optional[int]): Ограничение длины ответа. Если не
+            указано, не передаётся.
+
+    Raises:
+        TypeError: Возникает, если тип данных не поддерживается.
+        OpenAIError: Исключение, возникающее при проблемах взаимодействия с API OpenAI.
+
+    Returns:
+        str: Текст json-объекта из ответа модели.
+    """
+    request_messages = _build_messages(input_data, system_prompt)
+    scanner = JsonScanner()
+    parts: List[str] = []
+    usage = None
+    try:
+        stream = client.chat.completions.create(
+            messages=request_messages,
+            model=model,
+            temperature=temperature,
+            max_tokens=_given(max_tokens),
+            timeout=_given(timeout),
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        try:
+            for chunk in stream:
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                parts.append(chunk.choices[0].delta.content)
+                if scanner.feed(parts[-1]) is not None:
+                    break
+        finally:
+            stream.close()
+    except OpenAIError as e:
+        logging.error(f"Произошла ошибка при обращении к API: {str(e)}")
+        raise
+    answer = "".join(parts)
+    if usage is not None:
+        record_llm_usage(model, usage.prompt_tokens, usage.completion_tokens)
+    else:
+        # Поток остановлен до итогового чанка с usage, токены оцениваются
+        prompt = " ".join(str(m.get("content", "")) for m in request_messages)
+        record_llm_usage(model, estimate_tokens(prompt), estimate_tokens(answer))
+    return extract_json(scanner.result or answer)
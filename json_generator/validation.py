@@ -0,0 +1,393 @@
+"""Локальная проверка сгенерированной схемы по дереву правил workflow.
+
+Определение из дерева правил один раз компилируется в SchemaValidator:
+для каждого поля заранее разбираются тип, допустимые значения и условие
+обязательности. Проверка возвращает список проблем с путями до полей,
+чтобы на исправление отправлять только их, а не генерировать схему заново.
+
+Скомпилированные валидаторы кэшируются в validator_cache по хэшу
+содержимого определения и переиспользуются между запросами.
+"""
+import hashlib
+import json
+import logging
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from pydantic import BaseModel
+
+from .metrics import VALIDATOR_CACHE
+from .WorkflowRuleTreePython import workflow_rule_tree
+
+STRING_TYPE_RE = re.compile(r"^String(\d+)?$")
+STRING_TYPES = {"String-UUID", "Date"}
+CONDITION_EQ_RE = re.compile(r"^(\w+)\s*(==|!=)\s*'([^']*)'$")
+CONDITION_ABSENT_RE = re.compile(r"^!(\w+)$")
+CONDITION_PRESENT_RE = re.compile(r"^(\w+)\s+(?:present|exists)$")
+PATH_TOKEN_RE = re.compile(r"([^.\[\]]+)|\[(\d+)\]")
+
+Condition = Callable[[Dict[str, Any]], bool]
+PathPart = Union[str, int]
+
+
+class ValidationIssue(BaseModel):
+    """Проблема в схеме.
+
+    Attributes:
+        path (str): Путь до поля, например ``details.starters[0].type``.
+        message (str): Что не так.
+        description (str): Описание поля из дерева правил.
+    """
+
+    path: str
+    message: str
+    description: str = ""
+
+
+def compile_condition(text: Any) -> Optional[Condition]:
+    """Разбирает условие обязательности из дерева правил.
+
+    Поддерживаются ``field == 'v'``, ``field != 'v'``, ``!field`` (поля нет),
+    ``field present``/``field exists`` и их сочетания через ``or``/``||`` и
+    ``and``/``&&``. Условие проверяется на объекте, где лежит поле.
+
+    Returns:
+        Optional[Condition]: Предикат или None, если условие не разобрано.
+    """
+    if not isinstance(text, str):
+        return None
+    text = text.strip()
+    for separator, combine in ((" or ", any), ("||", any), (" and ", all), ("&&", all)):
+        if separator in text:
+            parts = [compile_condition(part) for part in text.split(separator)]
+            if any(part is None for part in parts):
+                return None
+            return lambda obj: combine(part(obj) for part in parts)
+    match = CONDITION_EQ_RE.match(text)
+    if match:
+        field, operator, value = match.groups()
+        if operator == "==":
+            return lambda obj: str(obj.get(field)) == value
+        return lambda obj: str(obj.get(field)) != value
+    match = CONDITION_ABSENT_RE.match(text)
+    if match:
+        field = match.group(1)
+        return lambda obj: obj.get(field) is None
+    match = CONDITION_PRESENT_RE.match(text)
+    if match:
+        field = match.group(1)
+        return lambda obj: obj.get(field) is not None
+    return None
+
+
+def split_path(path: str) -> List[PathPart]:
+    """Разбивает путь ``a.b[0].c`` на части: ``["a", "b", 0, "c"]``."""
+    return [
+        int(index) if index else name for name, index in PATH_TOKEN_RE.findall(path)
+    ]
+
+
+def join_path(parts: List[PathPart]) -> str:
+    """Собирает путь из частей, обратная операция к split_path."""
+    path = ""
+    for part in parts:
+        if isinstance(part, int):
+            path += f"[{part}]"
+        else:
+            path += f".{part}" if path else part
+    return path
+
+
+class FieldRule:
+    """Скомпилированное правило одного поля.
+
+    Attributes:
+        name (str): Имя поля.
+        description (str): Описание из дерева правил.
+        required (bool): Поле обязательно (с учётом condition).
+        condition (Optional[Condition]): Условие обязательности.
+        kind (Optional[str]): string, integer, number, object, array или None
+            для типов, которые не проверяются.
+        max_length (Optional[int]): Ограничение длины строки.
+        valid_values (Optional[Tuple[str, ...]]): Допустимые значения.
+        children (Dict[str, FieldRule]): Правила вложенных полей.
+        item_type (Optional[str]): Имя определения элементов массива.
+        default (Any): Фиксированное значение (value) или значение по
+            умолчанию (default) из дерева правил.
+    """
+
+    def __init__(self, name: str, node: Dict[str, Any]):
+        self.name = name
+        self.description = node.get("description", "")
+        self.required = node.get("required") is True
+        condition_text = node.get("required_cond") or node.get("condition")
+        self.condition = compile_condition(condition_text) if self.required else None
+        if self.required and condition_text and self.condition is None:
+            # Неразобранное условие не проверяем, чтобы не требовать лишнего
+            logging.debug("Условие '%s' поля %s не разобрано", condition_text, name)
+            self.required = False
+        values = node.get("valid_values") or node.get("values")
+        self.valid_values = tuple(values) if isinstance(values, list) else None
+        default = node.get("value", node.get("default"))
+        self.default = default if isinstance(default, (str, int, float)) else None
+        self.children = compile_fields(node.get("subcomponents"))
+        self.kind, self.max_length, self.item_type = self._kind(
+            str(node.get("type", ""))
+        )
+
+    def _kind(self, type_name: str) -> Tuple[Optional[str], Optional[int], Any]:
+        match = STRING_TYPE_RE.match(type_name)
+        if match:
+            return "string", int(match.group(1)) if match.group(1) else None, None
+        if type_name in STRING_TYPES:
+            return "string", None, None
+        if type_name == "Int":
+            return "integer", None, None
+        if type_name == "Float":
+            return "number", None, None
+        if type_name == "JsonObject" or self.children:
+            return "object", None, None
+        if type_name == "Array":
+            return "array", None, None
+        if type_name.endswith(" array"):
+            return "array", None, type_name[: -len(" array")]
+        return None, None, None
+
+    def is_required(self, parent: Dict[str, Any]) -> bool:
+        if not self.required:
+            return False
+        return self.condition is None or self.condition(parent)
+
+
+def compile_fields(group: Any) -> Dict[str, FieldRule]:
+    """Компилирует группу parameters или subcomponents."""
+    if not isinstance(group, dict):
+        return {}
+    return {
+        name: FieldRule(name, node)
+        for name, node in group.items()
+        if isinstance(node, dict)
+    }
+
+
+class SchemaValidator:
+    """Проверка документа по одному определению дерева правил.
+
+    Args:
+        definition (Dict[str, Any]): Определение с полем parameters, например
+            workflow_rule_tree["wf_definition"].
+        definitions (Optional[Dict[str, Any]]): Всё дерево правил, из него
+            берутся определения элементов массивов вида "Activity array".
+    """
+
+    def __init__(
+        self,
+        definition: Dict[str, Any],
+        definitions: Optional[Dict[str, Any]] = None,
+    ):
+        self.fields = compile_fields(definition.get("parameters"))
+        self._definitions = {
+            name.lower(): body for name, body in (definitions or {}).items()
+        }
+        self._items: Dict[str, Optional[Dict[str, FieldRule]]] = {}
+
+    def _item_fields(self, item_type: str) -> Optional[Dict[str, FieldRule]]:
+        """Правила элементов массива, компилируются при первом обращении."""
+        key = item_type.lower()
+        if key not in self._items:
+            body = self._definitions.get(key) or self._definitions.get(key + "s")
+            self._items[key] = (
+                compile_fields(body.get("parameters"))
+                if isinstance(body, dict)
+                else None
+            )
+        return self._items[key]
+
+    def validate(self, document: Any) -> List[ValidationIssue]:
+        """Проверяет документ.
+
+        Returns:
+            List[ValidationIssue]: Найденные проблемы, пустой список - документ
+                корректен.
+        """
+        issues: List[ValidationIssue] = []
+        if not isinstance(document, dict):
+            issues.append(ValidationIssue(path="", message="ожидается json-объект"))
+            return issues
+        self._check_object(self.fields, document, [], issues)
+        return issues
+
+    def _check_object(
+        self,
+        fields: Dict[str, FieldRule],
+        obj: Dict[str, Any],
+        path: List[PathPart],
+        issues: List[ValidationIssue],
+    ) -> None:
+        for name, rule in fields.items():
+            field_path = path + [name]
+            value = obj.get(name)
+            if name not in obj:
+                if rule.is_required(obj):
+                    issues.append(
+                        ValidationIssue(
+                            path=join_path(field_path),
+                            message="обязательное поле отсутствует",
+                            description=rule.description,
+                        )
+                    )
+                continue
+            if value is not None:
+                self._check_value(rule, value, field_path, issues)
+
+    def _check_value(
+        self,
+        rule: FieldRule,
+        value: Any,
+        path: List[PathPart],
+        issues: List[ValidationIssue],
+    ) -> None:
+        def issue(message: str) -> None:
+            issues.append(
+                ValidationIssue(
+                    path=join_path(path), message=message, description=rule.description
+                )
+            )
+
+        if rule.kind == "string" and not isinstance(value, str):
+            issue("ожидается строка")
+        elif rule.kind == "integer" and (
+            isinstance(value, bool) or not isinstance(value, int)
+        ):
+            issue("ожидается целое число")
+        elif rule.kind == "number" and (
+            isinstance(value, bool) or not isinstance(value, (int, float))
+        ):
+            issue("ожидается число")
+        elif rule.kind == "object" and not isinstance(value, dict):
+            issue("ожидается объект")
+        elif rule.kind == "array" and not isinstance(value, list):
+            issue("ожидается массив")
+        elif rule.max_length is not None and len(value) > rule.max_length:
+            issue(f"строка длиннее {rule.max_length} символов")
+        elif rule.valid_values is not None and value not in rule.valid_values:
+            issue("допустимые значения: " + ", ".join(rule.valid_values))
+        elif isinstance(value, dict) and rule.children:
+            self._check_object(rule.children, value, path, issues)
+        elif isinstance(value, list) and rule.item_type:
+            items = self._item_fields(rule.item_type)
+            if items is None:
+                return
+            for index, item in enumerate(value):
+                if isinstance(item, dict):
+                    self._check_object(items, item, path + [index], issues)
+                else:
+                    issues.append(
+                        ValidationIssue(
+                            path=join_path(path + [index]),
+                            message="ожидается объект",
+                            description=rule.description,
+                        )
+                    )
+
+
+class ValidatorCache:
+    """Скомпилированные валидаторы по хэшу содержимого определения.
+
+    Args:
+        definitions (Dict[str, Any]): Дерево правил: определения по имени и
+            источник определений элементов массивов.
+        max_size (int): Сколько валидаторов хранить, самые давние по
+            использованию вытесняются.
+    """
+
+    def __init__(self, definitions: Dict[str, Any], max_size: int = 256):
+        self.definitions = definitions
+        self.max_size = max_size
+        self._validators: "OrderedDict[str, SchemaValidator]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def definition_hash(definition: Dict[str, Any]) -> str:
+        """Хэш содержимого определения, не зависящий от порядка ключей."""
+        canonical = json.dumps(definition, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def get(self, definition: Dict[str, Any]) -> SchemaValidator:
+        """Возвращает валидатор определения, компилируя его при первом обращении."""
+        key = self.definition_hash(definition)
+        with self._lock:
+            validator = self._validators.get(key)
+            if validator is not None:
+                self._validators.move_to_end(key)
+                VALIDATOR_CACHE.inc(result="hit")
+                return validator
+        VALIDATOR_CACHE.inc(result="miss")
+        validator = SchemaValidator(definition, self.definitions)
+        with self._lock:
+            self._validators[key] = validator
+            while len(self._validators) > self.max_size:
+                self._validators.popitem(last=False)
+        return validator
+
+    def by_name(self, name: str) -> SchemaValidator:
+        """Валидатор определения из дерева правил по имени.
+
+        Raises:
+            KeyError: Если определения с таким именем нет.
+        """
+        definition = self.definitions.get(name)
+        if not isinstance(definition, dict):
+            raise KeyError(name)
+        return self.get(definition)
+
+    def __len__(self) -> int:
+        return len(self._validators)
+
+
+validator_cache = ValidatorCache(workflow_rule_tree)
+
+
+def get_path(document: Any, path: str) -> Any:
+    """Значение по пути или None, если пути нет."""
+    node = document
+    for part in split_path(path):
+        try:
+            node = node[part]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return node
+
+
+def set_path(document: Dict[str, Any], path: str, value: Any) -> None:
+    """Записывает значение по пути, создавая недостающие объекты.
+
+    Raises:
+        ValueError: Если путь проходит через значение, которое не является
+            объектом или массивом подходящей длины.
+    """
+    parts = split_path(path)
+    if not parts:
+        raise ValueError("Пустой путь")
+    node: Any = document
+    for part, following in zip(parts, parts[1:]):
+        if isinstance(node, dict):
+            if not isinstance(node.get(part), (dict, list)):
+                node[part] = [] if isinstance(following, int) else {}
+            node = node[part]
+        elif isinstance(node, list) and isinstance(part, int) and part < len(node):
+            node = node[part]
+        else:
+            raise ValueError(f"Путь {path} не найден в документе")
+    last = parts[-1]
+    if isinstance(node, dict) and isinstance(last, str):
+        node[last] = value
+    elif isinstance(node, list) and isinstance(last, int) and last <= len(node):
+        if last == len(node):
+            node.append(value)
+        else:
+            node[last] = value
+    else:
+        raise ValueError(f"Путь {path} не найден в документе")